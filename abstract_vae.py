@@ -14,6 +14,9 @@ from helpers.layers import View, flatten_layers, Identity, EMA, \
 from helpers.distributions import nll_activation as nll_activation_fn
 from helpers.distributions import nll as nll_fn
 from helpers.distributions import nll_has_variance
+from .codebook import is_one_hot, install_codebook_linear
+from .normalization import with_frozen_normalization, scoped_eval
+from .reparameterizers.prior_sampler import module_version
 
 
 class VarianceProjector(nn.Module):
@@ -77,6 +80,10 @@ class AbstractVAE(nn.Module):
         # grab the activation nn.Module from the string
         self.activation_fn = str_to_activ_module(self.config['activation'])
 
+        # decoded outputs of every discrete code, see decoder_lookup_table
+        self._decoder_lut = None
+        self._decoder_lut_version = None
+
     def get_reparameterizer_scalars(self):
         """ return the reparameterization scalars (eg: tau in gumbel)
 
@@ -129,9 +136,31 @@ class AbstractVAE(nn.Module):
         decoder = get_decoder(self.config, reupsample)(input_size=self.reparameterizer.output_size,
                                                        output_shape=self.input_shape,
                                                        activation_fn=self.activation_fn)
+
+        # one-hot / binary codes are a gather / sum of the first layer at inference
+        discrete_offset = self._discrete_input_offset()
+        if discrete_offset is not None:
+            install_codebook_linear(decoder, self.reparameterizer.output_size, discrete_offset)
+
         # append the variance as necessary
         return self._append_variance_projection(decoder)
 
+    def _discrete_input_offset(self):
+        """ Index of the first discrete (one-hot / binary) feature of the latent,
+            None if the latent has no (trailing) discrete part.
+
+        :returns: offset or None
+        :rtype: int
+
+        """
+        if self.config['reparam_type'] in ['discrete', 'bernoulli']:
+            return 0
+
+        if 'mixture' in self.config['reparam_type'] and hasattr(self.reparameterizer, 'continuous'):
+            return self.reparameterizer.continuous.output_size  # z = [continuous, discrete]
+
+        return None
+
     def _append_variance_projection(self, decoder):
         """ Appends a decoder variance for gaussian, etc.
 
@@ -235,21 +264,69 @@ class AbstractVAE(nn.Module):
         return rescaling_inv(decoded)
         # return decoded
 
+    def sample_prior(self, batch_size, **kwargs):
+        """ Sample the latent prior, over-ride this (rather than patching
+            the reparameterizer) to change what generation decodes.
+
+        :param batch_size: the number of samples to generate.
+        :returns: prior samples
+        :rtype: torch.Tensor
+
+        """
+        return self.reparameterizer.prior(batch_size, **kwargs)
+
+    def _decoder_lut_applies(self, z_samples):
+        """ The lookup table serves pure discrete, non-autoregressive, eval-mode decodes. """
+        return self.config['reparam_type'] == 'discrete' \
+            and self.config['decoder_layer_type'] != 'pixelcnn' \
+            and not self.training \
+            and z_samples.dim() == 2 \
+            and z_samples.size(-1) == self.reparameterizer.output_size \
+            and is_one_hot(z_samples)
+
+    def decoder_lookup_table(self):
+        """ Activated decoder outputs for all discrete_size one-hot codes,
+            decoded once (in batch_size chunks) per weight version of the model:
+            decode can run modules outside self.decoder (eg: MSGVAE gates).
+
+        :returns: [discrete_size, *input_shape] tensor
+        :rtype: torch.Tensor
+
+        """
+        version = module_version(self)
+        if self._decoder_lut is None or self._decoder_lut_version != version:
+            weight = next(self.decoder.parameters())
+            codes = torch.eye(self.reparameterizer.output_size,
+                              device=weight.device, dtype=weight.dtype)
+            with torch.no_grad():
+                self._decoder_lut = torch.cat([
+                    self.nll_activation(self.decode(codes_i))
+                    for codes_i in torch.split(codes, self.config['batch_size'], dim=0)
+                ], 0)
+
+            self._decoder_lut_version = version
+
+        return self._decoder_lut
+
+    @with_frozen_normalization
     def generate_synthetic_samples(self, batch_size, **kwargs):
-        """ Generates samples with VAE.
+        """ Generates samples with VAE. Normalization layers use their running
+            statistics, so the cost only depends on batch_size.
 
         :param batch_size: the number of samples to generate.
         :returns: decoded logits
         :rtype: torch.Tensor
 
         """
-        if 'use_aggregate_posterior' in kwargs and kwargs['use_aggregate_posterior']:
+        if kwargs.get('z_samples', None) is not None:
+            z_samples = kwargs['z_samples']
+        elif 'use_aggregate_posterior' in kwargs and kwargs['use_aggregate_posterior']:
             training_tmp = self.reparameterizer.training
             self.reparameterizer.train(False)
             z_samples, _ = self.reparameterize(self.aggregate_posterior.ema_val)
             self.reparameterizer.train(training_tmp)
         else:
-            z_samples = self.reparameterizer.prior(
+            z_samples = self.sample_prior(
                     batch_size, scale_var=self.config['generative_scale_var'], **kwargs
             )
 
@@ -266,6 +343,10 @@ class AbstractVAE(nn.Module):
             self.decoder = full_decoder
             return self.generate_pixel_cnn(batch_size, decoded)
 
+        # discrete codes are served from the (cached) decoded outputs
+        if self._decoder_lut_applies(z_samples):
+            return self.decoder_lookup_table()[torch.argmax(z_samples, dim=-1)]
+
         # in the normal case just decode and activate
         return self.nll_activation(self.decode(z_samples))
 
@@ -290,7 +371,6 @@ class AbstractVAE(nn.Module):
                                                num_original_discrete))])
         discrete_indices = discrete_indices.reshape(-1)
 
-        self.eval() # lock BN / Dropout, etc
         with torch.no_grad():
             z_samples = Variable(torch.from_numpy(
                 one_hot_np(self.reparameterizer.config['discrete_size'],
@@ -298,27 +378,15 @@ class AbstractVAE(nn.Module):
             )
             z_samples = z_samples.type(float_type(self.config['cuda']))
 
-            if self.config['reparam_type'] == 'mixture' and self.config['vae_type'] != 'sequential':
+            if 'mixture' in self.config['reparam_type'] and self.config['vae_type'] != 'sequential':
                 ''' add in the gaussian prior '''
                 z_cont = self.reparameterizer.continuous.prior(z_samples.size(0))
                 z_samples = torch.cat([z_cont, z_samples], dim=-1)
 
-            # the below is to handle the issues with BN
-            # pad the z to be full batch size
-            number_to_return = z_samples.shape[0] # original generate number
-            number_batches_z = int(max(1, np.ceil(
-                float(self.config['batch_size']) / float(number_to_return))))
-            z_padded = torch.cat(
-                [z_samples for _ in range(number_batches_z)], 0
-            )[0:self.config['batch_size']]
-
-            # generate and return the requested number
-            number_batches_to_generate = int(max(1, np.ceil(
-                float(number_to_return) / float(self.config['batch_size']))))
-            generated = torch.cat([self.generate_synthetic_samples(
-                self.config['batch_size'], z_samples=z_padded
-            ) for _ in range(number_batches_to_generate)], 0)
-            return generated[0:number_to_return] # only return num_requested
+        # normalization is frozen in generation, so no padding to batch_size is needed,
+        # and dropout is disabled for the decode without leaving the model in eval mode
+        with torch.no_grad(), scoped_eval(self):
+            return self.generate_synthetic_samples(z_samples.size(0), z_samples=z_samples)
 
     def nll_activation(self, logits):
         """ Activates the logits
@@ -339,7 +407,7 @@ class AbstractVAE(nn.Module):
         :rtype: bool
 
         """
-        return self.config['reparam_type'] == 'mixture' \
+        return 'mixture' in self.config['reparam_type'] \
             or self.config['reparam_type'] == 'discrete'
 
 
@@ -352,10 +420,55 @@ class AbstractVAE(nn.Module):
 
         """
         z, params = self.posterior(x)
+        if self._is_enumerated(params):
+            return self._decode_enumerated(z, params)
+
         decoded_logits = self.decode(z)
         params = self._compute_mi_params(decoded_logits, params)
         return decoded_logits, params
 
+    @staticmethod
+    def _is_enumerated(params):
+        """ True if the (discrete) latent was enumerated rather than sampled. """
+        return isinstance(params, dict) and 'discrete' in params \
+            and params['discrete'].get('enumerated', False)
+
+    def _decode_enumerated(self, z, params):
+        """ Decodes all [K, B, K] one-hot codes as a single [K * B] batch.
+            The logits of every code are kept in the params for the loss,
+            the reconstruction of the most likely code is returned.
+
+        :param z: the enumerated codes
+        :param params: the reparam dict
+        :returns: decoded logits of the mode and the reparam dict
+        :rtype: torch.Tensor, dict
+
+        """
+        num_categories, batch_size = z.size(0), z.size(1)
+        decoded_logits = self.decode(z.contiguous().view(num_categories * batch_size, -1))
+        decoded_logits = decoded_logits.view(num_categories, batch_size, *decoded_logits.shape[1:])
+        mode = torch.argmax(params['discrete']['logits'], dim=-1)
+        params['discrete']['enumerated_logits'] = decoded_logits
+        return decoded_logits[mode, torch.arange(batch_size, device=mode.device)], params
+
+    def _enumerated_nll(self, x, params):
+        """ E_q(z|x)[-log p(x|z)] computed exactly over all enumerated codes.
+
+        :param x: input tensor.
+        :param params: the reparam dict (with enumerated_logits).
+        :returns: batch_size tensor of nll
+        :rtype: torch.Tensor
+
+        """
+        decoded_logits = params['discrete']['enumerated_logits']
+        num_categories, batch_size = decoded_logits.size(0), decoded_logits.size(1)
+        x_expanded = x.unsqueeze(0).expand(num_categories, *x.shape).contiguous()
+        nll = nll_fn(x_expanded.view(num_categories * batch_size, *x.shape[1:]),
+                     decoded_logits.view(num_categories * batch_size, *decoded_logits.shape[2:]),
+                     self.config['nll_type']).view(num_categories, batch_size)
+        q_z = torch.exp(params['discrete']['log_q_z']).transpose(0, 1)  # [K, B]
+        return torch.sum(q_z * nll, 0)
+
     def loss_function(self, recon_x, x, params):
         """ Produces ELBO, handles mutual info and proxy loss terms too.
 
@@ -370,7 +483,8 @@ class AbstractVAE(nn.Module):
         if self.config['decoder_layer_type'] == 'pixelcnn':
             x = (x - .5) * 2.
 
-        nll = nll_fn(x, recon_x, self.config['nll_type'])
+        nll = self._enumerated_nll(x, params) if self._is_enumerated(params) \
+            else nll_fn(x, recon_x, self.config['nll_type'])
         nan_check_and_break(nll, "nll")
         kld = self.kld(params)
         nan_check_and_break(kld, "kld")
@@ -416,12 +530,17 @@ class AbstractVAE(nn.Module):
 
     def reparameterize(self, logits):
         """ Reparameterize the logits and returns a dict.
+            Small categorical latents may be enumerated instead (see GumbelSoftmax.should_enumerate).
 
         :param logits: unactivated encoded logits.
         :returns: reparam dict
         :rtype: dict
 
         """
+        if hasattr(self.reparameterizer, 'should_enumerate') \
+           and self.reparameterizer.should_enumerate(logits.size(0)):
+            return self.reparameterizer.enumerate(logits)
+
         return self.reparameterizer(logits)
 
     def decode(self, z):
@@ -448,6 +567,32 @@ class AbstractVAE(nn.Module):
 
         return self.reparameterize(z_logits)    # return reparameterized value
 
+    def inference_posterior(self, x):
+        """ Deterministic and side-effect free q(z|x) for serving: no sampling,
+            no aggregate posterior update and no reparameterizer annealing.
+            NOTE: call .eval() once beforehand to lock BN / Dropout.
+
+        :param x: input tensor
+        :returns: latent tensor and (minimal) params
+        :rtype: torch.Tensor, dict
+
+        """
+        with torch.no_grad():
+            return self.reparameterizer.inference(self.encode(x))
+
+    def inference_reconstruct(self, x):
+        """ Deterministic and side-effect free reconstruction, safe to call from
+            many threads on a shared model (after a single call to .eval()).
+
+        :param x: input tensor
+        :returns: activated reconstruction
+        :rtype: torch.Tensor
+
+        """
+        z, _ = self.inference_posterior(x)
+        with torch.no_grad():
+            return self.nll_activation(self.decode(z))
+
     def encode(self, x):
         """ Encodes a tensor x to a set of logits.
 
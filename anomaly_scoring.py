@@ -0,0 +1,251 @@
+from __future__ import print_function
+import csv
+import queue
+import threading
+import numpy as np
+import torch
+
+from .reparameterizers.isotropic_gaussian import IsotropicGaussian
+from .reparameterizers.prior_sampler import stochastic_sampling, hard_samples
+from helpers.distributions import nll as nll_fn
+from helpers.distributions import nll_activation as nll_activation_fn
+
+
+class _Prefetcher(object):
+    def __init__(self, loader, cuda=False, depth=4):
+        """ Producer thread iterating the loader (CPU decode / augmentation / IO)
+            and moving batches to the device while the consumer runs the model.
+
+        :param loader: iterable of x or (x, y) batches
+        :param cuda: copy the batches to the gpu (pinned, non-blocking)
+        :param depth: max number of batches buffered
+        :returns: _Prefetcher object
+        :rtype: object
+
+        """
+        self.loader = loader
+        self.cuda = cuda
+        self._queue = queue.Queue(maxsize=depth)
+        self._done = object()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._produce, daemon=True)
+        self._thread.start()
+
+    def _put(self, item, timeout=0.1):
+        """ Blocking put that gives up once the consumer is closed, returns True if queued. """
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=timeout)
+                return True
+            except queue.Full:
+                continue
+
+        return False
+
+    def _produce(self):
+        try:
+            for batch in self.loader:
+                x, y = batch if isinstance(batch, (list, tuple)) else (batch, None)
+                if self.cuda:
+                    x = x.pin_memory().cuda(non_blocking=True)
+
+                if not self._put((x, y)):
+                    return
+
+            self._put(self._done)
+        except Exception as e:  # re-raised on the consumer side
+            self._put(e)
+
+    def close(self):
+        """ Stops the producer, eg: when the consumer raised. """
+        self._stop.set()
+
+    def __iter__(self):
+        try:
+            while True:
+                item = self._queue.get()
+                if item is self._done:
+                    return
+                elif isinstance(item, Exception):
+                    raise item
+
+                yield item
+        finally:
+            self.close()
+
+
+class ReservoirPercentiles(object):
+    def __init__(self, size=10000, seed=0):
+        """ Running percentiles of a stream from a uniform reservoir sample (algorithm R).
+
+        :param size: reservoir size
+        :param seed: the seed
+        :returns: ReservoirPercentiles object
+        :rtype: object
+
+        """
+        self.size = size
+        self.count = 0
+        self.reservoir = np.zeros(size, dtype=np.float64)
+        self.rng = np.random.RandomState(seed)
+
+    def update(self, values):
+        for value in np.asarray(values, dtype=np.float64).ravel():
+            if self.count < self.size:
+                self.reservoir[self.count] = value
+            else:
+                slot = self.rng.randint(0, self.count + 1)
+                if slot < self.size:
+                    self.reservoir[slot] = value
+
+            self.count += 1
+
+    def percentile(self, q):
+        if self.count == 0:
+            return np.inf
+
+        return float(np.percentile(self.reservoir[0:min(self.count, self.size)], q))
+
+
+def _sampled_scale_params(params):
+    """ The params (or list of params, eg: concat) with the gaussian scale used by the
+        sampler, exp(logvar / 2): the scores all use the posterior that is sampled.
+
+    :param params: the posterior params
+    :returns: the params with the gaussian scale replaced
+    :rtype: dict or list
+
+    """
+    if isinstance(params, (list, tuple)):
+        return [IsotropicGaussian.sampled_scale_params(p) for p in params]
+
+    return IsotropicGaussian.sampled_scale_params(params)
+
+
+def _prior_params(params):
+    """ The (standard) prior of the reparameterizer in params form, i.e. N(0, 1) for
+        gaussians (logvar = 0, see sampled_scale_params) and uniform logits for gumbel / bernoulli.
+
+    :param params: the posterior params of a single reparameterizer
+    :returns: the prior params
+    :rtype: dict
+
+    """
+    if not isinstance(params, dict) or 'beta' in params or 'kumaraswamy' in params:
+        raise NotImplementedError("IWAE needs a gaussian / discrete / mixture reparameterizer")
+
+    prior = {}
+    if 'gaussian' in params:
+        prior['gaussian'] = {'mu': torch.zeros_like(params['gaussian']['mu']),
+                             'logvar': torch.zeros_like(params['gaussian']['logvar'])}
+
+    if 'discrete' in params:
+        prior['discrete'] = {'logits': torch.zeros_like(params['discrete']['logits'])}
+
+    return prior
+
+
+def iwae_bound(model, x, num_samples=16):
+    """ Per-sample importance weighted bound (Burda et al. 2015):
+        log 1/K sum_k p(x|z_k) p(z_k) / q(z_k|x), z_k ~ q(z|x)
+
+        The K samples are drawn with only the reparameterizer in training mode (the
+        rest of the model, eg: dropout / batchnorm, stays in eval) and the discrete
+        parts are decoded and scored as their exact (hard) samples.
+
+    :param model: an (eval-mode) AbstractVAE
+    :param x: the input tensor
+    :param num_samples: the number of importance samples K
+    :returns: [B] log-likelihood bound
+    :rtype: torch.Tensor
+
+    """
+    with torch.no_grad():
+        batch_size = x.size(0)
+        logits = model.encode(x)
+        with stochastic_sampling(model.reparameterizer):
+            z, params = model.reparameterizer(logits, num_samples=num_samples)
+
+        z = hard_samples(z, params)  # replace the relaxed discrete samples by the hard ones
+        log_q = model.reparameterizer.log_likelihood(z, _sampled_scale_params(params))
+        log_p_z = model.reparameterizer.log_likelihood(z, _sampled_scale_params(_prior_params(params)))
+
+        decoded = model.decode(z.contiguous().view(num_samples * batch_size, -1))
+        x_repeated = x.repeat(num_samples, *[1] * (x.dim() - 1))
+        log_p_x = -nll_fn(x_repeated, decoded, model.config['nll_type']).view(num_samples, batch_size)
+
+        log_w = log_p_x + (log_p_z - log_q).view(num_samples, batch_size, -1).sum(-1)
+        return torch.logsumexp(log_w, 0) - np.log(num_samples)
+
+
+def score_batch(model, x, iwae_samples=0):
+    """ Per-sample anomaly scores of a batch in inference mode. The kl (like the IWAE
+        bound) uses the gaussian posterior that is sampled, N(mu, exp(logvar / 2)).
+
+    :param model: an (eval-mode) AbstractVAE
+    :param x: the input tensor
+    :param iwae_samples: if > 0 also computes the IWAE bound with this many samples
+    :returns: dict of [B] numpy scores: nll, kl, elbo (negative), recon_mse [, iwae_nll]
+    :rtype: dict
+
+    """
+    with torch.no_grad():
+        z, params = model.posterior(x)
+        decoded = model.decode(z)
+        nll = nll_fn(x, decoded, model.config['nll_type'])
+        kl = model.kld(_sampled_scale_params(params))
+        recon = nll_activation_fn(decoded, model.config['nll_type'], chans=model.chans)
+        recon_mse = (recon.view(x.size(0), -1) - x.view(x.size(0), -1)).pow(2).mean(-1)
+        scores = {'nll': nll, 'kl': kl, 'elbo': nll + kl, 'recon_mse': recon_mse}
+        if iwae_samples > 0:
+            scores['iwae_nll'] = -iwae_bound(model, x, iwae_samples)
+
+    return {k: v.cpu().numpy().reshape(-1) for k, v in scores.items()}
+
+
+def score_stream(model, loader, output_path, score='elbo', percentile=99.0,
+                 iwae_samples=0, prefetch=4, reservoir_size=10000):
+    """ Streams batches through the model and incrementally writes a csv of per-sample
+        scores, the running percentile threshold of the chosen score and the flag
+        score > threshold (thresholds use every sample seen so far, incl. the batch).
+
+    :param model: the AbstractVAE (put in eval mode here)
+    :param loader: iterable of x or (x, y) batches
+    :param output_path: the csv path
+    :param score: the score used for thresholding (nll, kl, elbo, recon_mse or iwae_nll)
+    :param percentile: the percentile of the threshold
+    :param iwae_samples: if > 0 also computes the IWAE bound with this many samples
+    :param prefetch: number of batches prefetched by the producer thread
+    :param reservoir_size: size of the reservoir used for the percentiles
+    :returns: the final threshold
+    :rtype: float
+
+    """
+    model.eval()
+    percentiles = ReservoirPercentiles(reservoir_size)
+    prefetcher = _Prefetcher(loader, cuda=model.config['cuda'], depth=prefetch)
+    try:
+        with open(output_path, 'w', newline='') as f:
+            writer, index = None, 0
+            for x, y in prefetcher:
+                scores = score_batch(model, x, iwae_samples=iwae_samples)
+                percentiles.update(scores[score])
+                threshold = percentiles.percentile(percentile)
+                if writer is None:
+                    writer = csv.writer(f)
+                    writer.writerow(['index'] + list(scores.keys())
+                                    + (['label'] if y is not None else [])
+                                    + ['threshold', 'is_anomaly'])
+
+                labels = y.cpu().numpy().reshape(x.size(0), -1)[:, 0] if y is not None else None
+                for i in range(x.size(0)):
+                    writer.writerow([index + i] + [float(v[i]) for v in scores.values()]
+                                    + ([labels[i]] if labels is not None else [])
+                                    + [threshold, int(scores[score][i] > threshold)])
+
+                index += x.size(0)
+                f.flush()
+    finally:
+        prefetcher.close()  # stops the producer if scoring raised
+
+    return percentiles.percentile(percentile)
@@ -0,0 +1,148 @@
+from __future__ import print_function
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+def is_one_hot(x):
+    """ True if every row of x (over the last dim) is an exact one-hot vector.
+
+    :param x: the tensor
+    :returns: True/False
+    :rtype: bool
+
+    """
+    return bool(torch.all(((x == 0) | (x == 1)).all(-1) & (x.sum(-1) == 1)))  # a single host sync
+
+
+def is_binary(x):
+    """ True if every element of x is exactly 0 or 1.
+
+    :param x: the tensor
+    :returns: True/False
+    :rtype: bool
+
+    """
+    return bool(torch.all((x == 0) | (x == 1)))
+
+
+class CodebookLinear(nn.Linear):
+    def __init__(self, in_features, out_features, bias=True, discrete_offset=0, max_density=0.25):
+        """ Linear layer whose inputs [discrete_offset:] are a discrete (one-hot or binary) code.
+            At inference (no grad) the discrete half of the matmul runs against the
+            codebook (a W[:, discrete_offset:]^T view) as:
+              - a row-gather for exact one-hot codes (eg: hard gumbel),
+              - a sum of the gathered rows for sparse binary codes (eg: bernoulli),
+            and falls back to a plain nn.Linear otherwise (eg: soft samples in training).
+
+        :param in_features: input size
+        :param out_features: output size
+        :param bias: use a bias
+        :param discrete_offset: index of the first discrete input feature
+        :param max_density: binary codes denser than this use the dense matmul
+        :returns: CodebookLinear object
+        :rtype: nn.Module
+
+        """
+        super(CodebookLinear, self).__init__(in_features, out_features, bias=bias)
+        self.discrete_offset = discrete_offset
+        self.max_density = max_density
+
+    @classmethod
+    def from_linear(cls, linear, discrete_offset=0):
+        """ Builds a CodebookLinear that shares the params of an nn.Linear.
+
+        :param linear: the nn.Linear
+        :param discrete_offset: index of the first discrete input feature
+        :returns: CodebookLinear
+        :rtype: nn.Module
+
+        """
+        layer = cls(linear.in_features, linear.out_features,
+                    bias=linear.bias is not None, discrete_offset=discrete_offset)
+        layer.weight = linear.weight
+        layer.bias = linear.bias
+        return layer
+
+    def codebook(self):
+        """ Returns the [num_codes, out_features] codebook, a (strided) view of the weight.
+
+        :returns: codebook
+        :rtype: torch.Tensor
+
+        """
+        return self.weight[:, self.discrete_offset:].t()
+
+    def _discrete_matmul(self, codes):
+        """ codes @ W[:, discrete_offset:]^T as a gather / sum, None if codes are not sparse.
+
+        :param codes: the [B, num_codes] discrete inputs
+        :returns: [B, out_features] tensor or None
+        :rtype: torch.Tensor
+
+        """
+        counts = codes.sum(-1)
+        binary, one_hot, num_active = torch.stack([  # a single host sync for all the checks
+            ((codes == 0) | (codes == 1)).all().to(counts.dtype),
+            (counts == 1).all().to(counts.dtype),
+            counts.sum()]).tolist()
+        if not binary:
+            return None
+
+        if one_hot:  # a single row per sample
+            return self.codebook()[torch.argmax(codes, dim=-1)]
+
+        if num_active > self.max_density * codes.numel():
+            return None
+
+        # binary: sum the rows of the active codes
+        rows, cols = codes.nonzero(as_tuple=True)
+        output = torch.zeros(codes.size(0), self.out_features, device=codes.device, dtype=self.weight.dtype)
+        return output.index_add_(0, rows, self.codebook()[cols])
+
+    def forward(self, x):
+        if self.training or torch.is_grad_enabled() or x.dim() != 2:
+            return super(CodebookLinear, self).forward(x)
+
+        output = self._discrete_matmul(x[:, self.discrete_offset:])
+        if output is None:
+            return super(CodebookLinear, self).forward(x)
+
+        if self.discrete_offset > 0:  # the continuous half is a regular (smaller) matmul
+            output = output + F.linear(x[:, 0:self.discrete_offset],
+                                       self.weight[:, 0:self.discrete_offset])
+
+        return output if self.bias is None else output + self.bias
+
+
+def install_codebook_linear(module, input_size, discrete_offset=0):
+    """ Swaps the first nn.Linear of module consuming input_size features
+        for a (parameter sharing) CodebookLinear. No-op if there is none.
+
+    :param module: the network, eg: the decoder
+    :param input_size: the latent size the layer consumes
+    :param discrete_offset: index of the first discrete input feature
+    :returns: True if a layer was swapped
+    :rtype: bool
+
+    """
+    for name, child in module.named_children():
+        if isinstance(child, CodebookLinear):
+            return True
+
+        if isinstance(child, nn.Linear):
+            if child.in_features != input_size:
+                return False  # the first linear does not consume the latent
+
+            setattr(module, name, CodebookLinear.from_linear(child, discrete_offset))
+            return True
+
+        if len(list(child.parameters())) == 0:
+            continue  # eg: View, activations
+
+        if len(list(child.children())) > 0:
+            return install_codebook_linear(child, input_size, discrete_offset)
+
+        return False  # the first parametric layer is not linear, eg: conv
+
+    return False
@@ -0,0 +1,210 @@
+from __future__ import print_function
+import time
+import struct
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from . import rans
+
+
+class LatentCodec(object):
+    def __init__(self, model, quantization_step=0.5, max_abs=6.0, precision=16):
+        """ Lossy image codec: the deterministic posterior of an (eval-mode) VAE is
+            quantized and rANS-coded under the model's prior, decoding runs
+            model.decode + model.nll_activation. Supported latents:
+              - discrete (gumbel): one symbol per sample, uniform categorical prior,
+              - bernoulli: one bit per dim, Bernoulli(0.5) prior,
+              - isotropic_gaussian: mu rounded to quantization_step, coded under the
+                discretized N(0, 1) prior (tails folded into the edge bins),
+              - mixture: [continuous, discrete] as above.
+
+        :param model: an AbstractVAE
+        :param quantization_step: bin width of the gaussian latents (rate / distortion knob)
+        :param max_abs: gaussian latents are clipped to [-max_abs, max_abs]
+        :param precision: number of bits of the rANS frequencies
+        :returns: LatentCodec object
+        :rtype: object
+
+        """
+        self.model = model
+        self.quantization_step = quantization_step
+        self.max_abs = max_abs
+        self.precision = precision
+        self._build_tables()
+
+    def _components(self):
+        """ [(kind, size)] of the latent in z order. """
+        reparam_type, reparameterizer = self.model.config['reparam_type'], self.model.reparameterizer
+        if reparam_type == 'discrete':
+            return [('categorical', reparameterizer.output_size)]
+        elif reparam_type == 'bernoulli':
+            return [('bernoulli', reparameterizer.output_size)]
+        elif reparam_type == 'isotropic_gaussian':
+            return [('gaussian', reparameterizer.output_size)]
+        elif reparam_type == 'mixture' and reparameterizer.continuous_key == 'gaussian':
+            return [('gaussian', reparameterizer.continuous.output_size),
+                    ('categorical', reparameterizer.discrete.output_size)]
+
+        raise NotImplementedError("no entropy model for reparam_type {}".format(reparam_type))
+
+    def _gaussian_pmf(self):
+        """ The N(0, 1) prior integrated over every quantization bin. """
+        max_level = int(np.floor(self.max_abs / self.quantization_step))
+        edges = (np.arange(-max_level, max_level + 2) - 0.5) * self.quantization_step
+        cdf = torch.special.ndtr(torch.from_numpy(edges)).numpy()
+        cdf[0], cdf[-1] = 0.0, 1.0  # fold the tails into the edge bins
+        return np.diff(cdf), max_level
+
+    def _build_tables(self):
+        """ Builds the cdf tables and the per-position table index of the symbol sequence. """
+        cdfs, table_index = [], []
+        for kind, size in self._components():
+            if kind == 'gaussian':
+                pmf, self.max_level = self._gaussian_pmf()
+                cdfs.append(rans.quantize_pmf(pmf, self.precision))
+                table_index.extend([len(cdfs) - 1] * size)
+            elif kind == 'bernoulli':
+                cdfs.append(rans.quantize_pmf(np.full(2, 0.5), self.precision))
+                table_index.extend([len(cdfs) - 1] * size)
+            else:  # a single categorical symbol
+                cdfs.append(rans.quantize_pmf(np.full(size, 1.0 / size), self.precision))
+                table_index.append(len(cdfs) - 1)
+
+        self.cdfs = rans.stack_cdfs(cdfs)
+        self.table_index = np.array(table_index, dtype=np.int64)
+
+    def _to_symbols(self, z):
+        """ [B, latent] z --> [B, T] integer symbols. """
+        z, symbols, offset = z.detach().cpu().numpy(), [], 0
+        for kind, size in self._components():
+            z_i = z[:, offset:offset + size]
+            if kind == 'gaussian':
+                levels = np.clip(np.round(z_i / self.quantization_step), -self.max_level, self.max_level)
+                symbols.append(levels.astype(np.int64) + self.max_level)
+            elif kind == 'bernoulli':
+                symbols.append((z_i > 0.5).astype(np.int64))
+            else:
+                symbols.append(np.argmax(z_i, -1)[:, None])
+
+            offset += size
+
+        return np.concatenate(symbols, -1)
+
+    def _from_symbols(self, symbols):
+        """ [B, T] integer symbols --> [B, latent] (dequantized) z. """
+        z, offset = [], 0
+        for kind, size in self._components():
+            if kind == 'gaussian':
+                levels = symbols[:, offset:offset + size] - self.max_level
+                z.append(torch.from_numpy(levels * self.quantization_step).float())
+                offset += size
+            elif kind == 'bernoulli':
+                z.append(torch.from_numpy(symbols[:, offset:offset + size]).float())
+                offset += size
+            else:
+                z.append(F.one_hot(torch.from_numpy(symbols[:, offset]), size).float())
+                offset += 1
+
+        z = torch.cat(z, -1)
+        return z.cuda() if self.model.config['cuda'] else z
+
+    def encode(self, x):
+        """ Compresses a batch of images.
+
+        :param x: the [B, C, H, W] input tensor
+        :returns: list of B byte strings
+        :rtype: list
+
+        """
+        z, _ = self.model.inference_posterior(x)
+        return rans.encode(self._to_symbols(z), self.cdfs, self.table_index, self.precision)
+
+    def decode(self, streams):
+        """ Decompresses a batch of byte strings.
+
+        :param streams: list of byte strings (as returned by encode)
+        :returns: the activated reconstructions
+        :rtype: torch.Tensor
+
+        """
+        symbols = rans.decode(streams, self.cdfs, self.table_index, self.precision)
+        with torch.no_grad():
+            return self.model.nll_activation(self.model.decode(self._from_symbols(symbols)))
+
+    def encode_stream(self, batches, f):
+        """ Compresses an iterable of image batches to a file object, every stream
+            is prefixed with its (uint32) length.
+
+        :param batches: iterable of [B, C, H, W] tensors, eg: (x for x, _ in loader)
+        :param f: file object opened in binary write mode
+        :returns: number of bytes written
+        :rtype: int
+
+        """
+        num_bytes = 0
+        for x in batches:
+            for stream in self.encode(x):
+                f.write(struct.pack('<I', len(stream)))
+                f.write(stream)
+                num_bytes += 4 + len(stream)
+
+        return num_bytes
+
+    def decode_stream(self, f, batch_size=64):
+        """ Decompresses a file written by encode_stream batch by batch.
+
+        :param f: file object opened in binary read mode
+        :param batch_size: number of images decoded per batch
+        :returns: generator of reconstructed batches
+        :rtype: generator
+
+        """
+        streams = []
+        while True:
+            header = f.read(4)
+            if len(header) == 4:
+                streams.append(f.read(struct.unpack('<I', header)[0]))
+
+            if len(streams) == batch_size or (len(header) < 4 and len(streams) > 0):
+                yield self.decode(streams)
+                streams = []
+
+            if len(header) < 4:
+                return
+
+
+def benchmark(model, batches, quantization_steps=(0.25, 0.5, 1.0), precision=16):
+    """ Measures the rate (bits per pixel) against the encode / decode throughput
+        (images per second) and the reconstruction error for every quantization step.
+
+    :param model: an (eval-mode) AbstractVAE
+    :param batches: list of [B, C, H, W] tensors
+    :param quantization_steps: gaussian bin widths to sweep (ignored by discrete latents)
+    :param precision: number of bits of the rANS frequencies
+    :returns: list of dicts with step, bpp, encode_ips, decode_ips and mse
+    :rtype: list
+
+    """
+    num_images = sum(x.size(0) for x in batches)
+    num_pixels = num_images * int(np.prod(model.input_shape[1:]))
+    results = []
+    for step in quantization_steps:
+        codec = LatentCodec(model, quantization_step=step, precision=precision)
+        begin = time.time()
+        streams = [codec.encode(x) for x in batches]
+        encode_time = time.time() - begin
+
+        begin = time.time()
+        reconstructions = [codec.decode(s) for s in streams]
+        decode_time = time.time() - begin
+
+        num_bits = 8 * sum(len(b) for s in streams for b in s)
+        mse = sum(float(F.mse_loss(r.view_as(x), x.type_as(r), reduction='sum'))
+                  for r, x in zip(reconstructions, batches)) / num_images
+        results.append({'step': step, 'bpp': num_bits / num_pixels,
+                        'encode_ips': num_images / encode_time,
+                        'decode_ips': num_images / decode_time,
+                        'mse': mse})
+
+    return results
@@ -0,0 +1,117 @@
+from __future__ import print_function
+import numpy as np
+
+
+# 64-bit state rANS (Duda, 2013; after ryg_rans' rans64) emitting 32-bit words:
+# the state lives in [RANS_L, 2^63) so at most one word is emitted / read per symbol.
+RANS_L = np.uint64(1 << 31)
+WORD_BITS = np.uint64(32)
+WORD_MASK = np.uint64((1 << 32) - 1)
+
+
+def quantize_pmf(pmf, precision=16):
+    """ Quantizes a probability mass function to integer frequencies summing to
+        2^precision, every symbol keeping a frequency of at least one.
+
+    :param pmf: [num_symbols] probabilities (need not be normalized)
+    :param precision: number of bits of the frequencies
+    :returns: [num_symbols + 1] cumulative frequency table
+    :rtype: np.array
+
+    """
+    total = 1 << precision
+    pmf = np.asarray(pmf, dtype=np.float64)
+    assert pmf.shape[0] <= total, "alphabet larger than 2^precision"
+    freqs = np.maximum(np.floor(pmf / pmf.sum() * (total - pmf.shape[0])), 0).astype(np.int64) + 1
+    freqs[np.argmax(freqs)] += total - freqs.sum()  # put the rounding error on the mode
+    return np.concatenate([[0], np.cumsum(freqs)]).astype(np.uint64)
+
+
+def stack_cdfs(cdfs):
+    """ Pads a list of cumulative frequency tables into a [num_tables, max_symbols + 1]
+        matrix (padding repeats the total, i.e. zero frequency symbols).
+
+    :param cdfs: list of cumulative frequency tables
+    :returns: the cdf matrix
+    :rtype: np.array
+
+    """
+    width = max(cdf.shape[0] for cdf in cdfs)
+    return np.stack([np.pad(cdf, (0, width - cdf.shape[0]), mode='edge') for cdf in cdfs], 0)
+
+
+def encode(symbols, cdfs, table_index, precision=16):
+    """ Encodes a batch of symbol sequences, one independent rANS stream per row.
+        The batch is coded in lock-step (vectorized over the rows).
+
+    :param symbols: [B, T] integer symbols
+    :param cdfs: [num_tables, max_symbols + 1] cumulative frequencies (see stack_cdfs)
+    :param table_index: [T] table used for each position
+    :param precision: number of bits of the frequencies
+    :returns: list of B byte strings
+    :rtype: list
+
+    """
+    symbols = np.asarray(symbols, dtype=np.int64)
+    batch_size, num_steps = symbols.shape
+    precision = np.uint64(precision)
+    x_max_base = (RANS_L >> precision) << WORD_BITS
+    state = np.full(batch_size, RANS_L, dtype=np.uint64)
+
+    words = np.zeros((num_steps, batch_size), dtype=np.uint32)
+    emitted = np.zeros((num_steps, batch_size), dtype=bool)
+    for step in range(num_steps - 1, -1, -1):  # LIFO: encode backwards, decode forwards
+        cdf = cdfs[table_index[step]]
+        start, freq = cdf[symbols[:, step]], cdf[symbols[:, step] + 1] - cdf[symbols[:, step]]
+        assert np.all(freq > 0), "symbol with zero frequency at step {}".format(step)
+        renorm = state >= x_max_base * freq
+        words[step, renorm] = (state[renorm] & WORD_MASK).astype(np.uint32)
+        emitted[step, renorm] = True
+        state = np.where(renorm, state >> WORD_BITS, state)
+        state = ((state // freq) << precision) + (state % freq) + start
+
+    streams = []
+    for b in range(batch_size):
+        # reading order: final state (hi, lo) then the words of steps 0, 1, ...
+        head = np.array([state[b] >> WORD_BITS, state[b] & WORD_MASK], dtype=np.uint32)
+        streams.append(np.concatenate([head, words[emitted[:, b], b]]).astype('<u4').tobytes())
+
+    return streams
+
+
+def decode(streams, cdfs, table_index, precision=16):
+    """ Decodes a batch of rANS streams produced by encode (vectorized over the rows).
+
+    :param streams: list of B byte strings
+    :param cdfs: [num_tables, max_symbols + 1] cumulative frequencies (see stack_cdfs)
+    :param table_index: [T] table used for each position
+    :param precision: number of bits of the frequencies
+    :returns: [B, T] symbols
+    :rtype: np.array
+
+    """
+    arrays = [np.frombuffer(s, dtype='<u4').astype(np.uint64) for s in streams]
+    batch_size, num_steps = len(arrays), len(table_index)
+    padded = np.zeros((batch_size, max(a.shape[0] for a in arrays) + 1), dtype=np.uint64)
+    for b, array in enumerate(arrays):
+        padded[b, 0:array.shape[0]] = array
+
+    precision = np.uint64(precision)
+    mask = (np.uint64(1) << precision) - np.uint64(1)
+    state = (padded[:, 0] << WORD_BITS) | padded[:, 1]
+    position = np.full(batch_size, 2, dtype=np.int64)
+    rows = np.arange(batch_size)
+
+    symbols = np.zeros((batch_size, num_steps), dtype=np.int64)
+    for step in range(num_steps):
+        cdf = cdfs[table_index[step]]
+        slot = state & mask
+        symbol = np.searchsorted(cdf, slot, side='right') - 1
+        start = cdf[symbol]
+        state = (cdf[symbol + 1] - start) * (state >> precision) + slot - start
+        renorm = state < RANS_L
+        state = np.where(renorm, (state << WORD_BITS) | padded[rows, position], state)
+        position += renorm
+        symbols[:, step] = symbol
+
+    return symbols
@@ -0,0 +1,340 @@
+from __future__ import print_function
+import io
+import json
+import time
+import asyncio
+import numpy as np
+import torch
+
+from concurrent.futures import ThreadPoolExecutor
+from helpers.distributions import nll as nll_fn
+
+
+class _ModelError(Exception):
+    """ An error raised by the model itself (a 500), not by the request (a 400). """
+
+
+class LatencyHistogram(object):
+    def __init__(self, min_latency=1e-4, max_latency=100.0, buckets_per_decade=10):
+        """ Log-spaced latency histogram (seconds) with approximate quantiles.
+
+        :param min_latency: upper bound of the first bucket
+        :param max_latency: upper bound of the last (finite) bucket
+        :param buckets_per_decade: resolution of the buckets
+        :returns: LatencyHistogram object
+        :rtype: object
+
+        """
+        num_decades = np.log10(max_latency / min_latency)
+        self.bounds = np.logspace(np.log10(min_latency), np.log10(max_latency),
+                                  int(num_decades * buckets_per_decade) + 1)
+        self.counts = np.zeros(self.bounds.shape[0] + 1, dtype=np.int64)
+        self.total = 0.0
+
+    def observe(self, latency):
+        self.counts[np.searchsorted(self.bounds, latency)] += 1
+        self.total += latency
+
+    def quantile(self, q):
+        """ Upper bound of the bucket holding the q-th quantile. """
+        count = self.counts.sum()
+        if count == 0:
+            return 0.0
+
+        bucket = int(np.searchsorted(np.cumsum(self.counts), q * count))
+        return float(self.bounds[min(bucket, self.bounds.shape[0] - 1)])
+
+    def summary(self):
+        count = int(self.counts.sum())
+        return {'count': count,
+                'mean': self.total / max(count, 1),
+                'p50': self.quantile(0.5),
+                'p95': self.quantile(0.95),
+                'p99': self.quantile(0.99)}
+
+
+class _Endpoint(object):
+    def __init__(self, name, fn, max_batch_size, max_wait, max_queue_size):
+        """ A micro-batched model call: requests are queued, coalesced into batches of
+            up to max_batch_size rows (waiting at most max_wait seconds for more)
+            and the results split back per request.
+
+        :param name: the endpoint name
+        :param fn: batched function (list of requests) --> list of results, run off the loop
+        :param max_batch_size: max rows per batch
+        :param max_wait: max seconds the first request of a batch waits for company
+        :param max_queue_size: max queued rows, further requests are rejected
+        :returns: _Endpoint object
+        :rtype: object
+
+        """
+        self.name = name
+        self.fn = fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_queue_size = max_queue_size
+        self.queue = None  # created on the serving loop
+        self.queued_rows = 0
+        self.num_rejected = 0
+        self.batch_sizes = []
+        self.latency = LatencyHistogram()
+
+    def stats(self):
+        return {'latency': self.latency.summary(),
+                'queued_rows': self.queued_rows,
+                'rejected': self.num_rejected,
+                'mean_batch_size': float(np.mean(self.batch_sizes)) if self.batch_sizes else 0.0}
+
+
+class InferenceServer(object):
+    def __init__(self, model, max_batch_size=64, max_wait=0.005, max_queue_size=1024):
+        """ Local asyncio HTTP server (TCP or unix socket) around an AbstractVAE that
+            coalesces concurrent requests into micro-batches. Payloads are .npy bytes:
+
+              POST /encode       [B, C, H, W] --> [B, latent] deterministic posterior
+              POST /reconstruct  [B, C, H, W] --> [B, C, H, W] activated reconstruction
+              POST /elbo         [B, C, H, W] --> [B] per-sample negative ELBO (nll + kl)
+                                 at the posterior mode, i.e. deterministic
+              POST /generate     json {"batch_size": n} --> [n, C, H, W]
+              GET  /stats        json latency histograms, queue depth and rejections
+
+            Requests beyond max_queue_size queued rows get a 503 (admission control),
+            single requests larger than max_batch_size get a 413, malformed ones
+            (eg: a payload not shaped [B, *input_shape]) a 400 and errors raised by the
+            model a 500. Model calls run on
+            a single worker thread so the (eval-mode) model is never entered concurrently.
+
+        :param model: the AbstractVAE
+        :param max_batch_size: max rows per forward pass
+        :param max_wait: max seconds to wait to fill a batch
+        :param max_queue_size: max queued rows per endpoint
+        :returns: InferenceServer object
+        :rtype: object
+
+        """
+        self.model = model.eval()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._server = None
+        self.endpoints = {
+            name: _Endpoint(name, fn, max_batch_size, max_wait, max_queue_size)
+            for name, fn in [('encode', self._encode),
+                             ('reconstruct', self._reconstruct),
+                             ('elbo', self._elbo),
+                             ('generate', self._generate)]
+        }
+
+    def _to_tensor(self, x):
+        x = torch.from_numpy(np.ascontiguousarray(x)).float()
+        return x.cuda() if self.model.config['cuda'] else x
+
+    def _encode(self, xs):
+        z, _ = self.model.inference_posterior(self._to_tensor(np.concatenate(xs, 0)))
+        return z.cpu().numpy()
+
+    def _reconstruct(self, xs):
+        return self.model.inference_reconstruct(
+            self._to_tensor(np.concatenate(xs, 0))).cpu().numpy()
+
+    def _elbo(self, xs):
+        x = self._to_tensor(np.concatenate(xs, 0))
+        z, params = self.model.inference_posterior(x)
+        with torch.no_grad():
+            decoded = self.model.decode(z)
+            elbo = nll_fn(x, decoded, self.model.config['nll_type']) + self.model.kld(params)
+
+        return elbo.cpu().numpy()
+
+    def _generate(self, batch_sizes):
+        with torch.no_grad():
+            return self.model.generate_synthetic_samples(int(sum(batch_sizes))).cpu().numpy()
+
+    @staticmethod
+    def _num_rows(name, payload):
+        return payload if name == 'generate' else payload.shape[0]
+
+    def _validate(self, name, payload):
+        """ Rejects (ValueError, a 400) a malformed request before it is queued so that
+            it can never fail the requests it would be co-batched with. """
+        if name == 'generate':
+            if payload <= 0:
+                raise ValueError("batch_size must be positive, got {}".format(payload))
+
+            return
+
+        expected_shape = tuple(self.model.input_shape)
+        if not isinstance(payload, np.ndarray) or payload.shape[1:] != expected_shape:
+            raise ValueError("expected a [B, {}] array, got {}".format(
+                ", ".join(str(s) for s in expected_shape), getattr(payload, 'shape', type(payload))))
+
+        if payload.dtype.kind not in 'biuf' or payload.shape[0] == 0:
+            raise ValueError("expected a non-empty numeric array, got {} rows of {}".format(
+                payload.shape[0], payload.dtype))
+
+    async def _batch_loop(self, endpoint):
+        """ Coalesces queued requests into batches and runs them on the worker thread. """
+        loop = asyncio.get_running_loop()
+        carry = None  # a request that did not fit the previous batch
+        while True:
+            pending = [carry if carry is not None else await endpoint.queue.get()]
+            carry = None
+            num_rows = self._num_rows(endpoint.name, pending[0][0])
+            deadline = loop.time() + endpoint.max_wait
+            while num_rows < endpoint.max_batch_size:
+                try:
+                    item = await asyncio.wait_for(endpoint.queue.get(), deadline - loop.time())
+                except asyncio.TimeoutError:
+                    break
+
+                item_rows = self._num_rows(endpoint.name, item[0])
+                if num_rows + item_rows > endpoint.max_batch_size:
+                    carry = item  # heads the next batch
+                    break
+
+                pending.append(item)
+                num_rows += item_rows
+
+            endpoint.queued_rows -= num_rows
+            endpoint.batch_sizes = endpoint.batch_sizes[-999:] + [num_rows]
+            payloads = [payload for payload, _ in pending]
+            try:
+                result = await loop.run_in_executor(self._executor, endpoint.fn, payloads)
+                offset = 0
+                for payload, future in pending:
+                    rows = self._num_rows(endpoint.name, payload)
+                    if not future.done():
+                        future.set_result(result[offset:offset + rows])
+
+                    offset += rows
+            except Exception as e:
+                error = _ModelError("{}: {}".format(type(e).__name__, e))
+                for _, future in pending:
+                    if not future.done():
+                        future.set_exception(error)
+
+    async def submit(self, name, payload):
+        """ Queues a request and waits for its result.
+
+        :param name: the endpoint name
+        :param payload: np.array of inputs, or the number of samples for generate
+        :returns: the result rows
+        :rtype: np.array
+
+        """
+        endpoint = self.endpoints[name]
+        if endpoint.queue is None:
+            raise RuntimeError("the server is not started, call start() before submit()")
+
+        self._validate(name, payload)
+        num_rows = self._num_rows(name, payload)
+        if num_rows > endpoint.max_batch_size:
+            raise ValueError("413 request of {} rows > max_batch_size".format(num_rows))
+
+        if endpoint.queued_rows + num_rows > endpoint.max_queue_size:
+            endpoint.num_rejected += 1
+            raise OverflowError("503 {} queue is full".format(name))
+
+        begin = time.time()
+        future = asyncio.get_running_loop().create_future()
+        endpoint.queued_rows += num_rows
+        endpoint.queue.put_nowait((payload, future))
+        result = await future
+        endpoint.latency.observe(time.time() - begin)
+        return result
+
+    def stats(self):
+        return {name: endpoint.stats() for name, endpoint in self.endpoints.items()}
+
+    @staticmethod
+    async def _write_response(writer, status, body, content_type):
+        reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 413: 'Payload Too Large',
+                   500: 'Internal Server Error', 503: 'Service Unavailable'}
+        writer.write("HTTP/1.1 {} {}\r\nContent-Type: {}\r\nContent-Length: {}\r\n\r\n".format(
+            status, reasons.get(status, 'Error'), content_type, len(body)).encode('latin-1'))
+        writer.write(body)
+        await writer.drain()
+
+    async def _handle(self, reader, writer):
+        """ Minimal HTTP/1.1 keep-alive handler. """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+
+                try:
+                    method, path = request_line.decode('latin-1').split()[0:2]
+                    headers = {}
+                    while True:
+                        line = (await reader.readline()).decode('latin-1').strip()
+                        if not line:
+                            break
+
+                        key, value = line.split(':', 1)
+                        headers[key.strip().lower()] = value.strip()
+
+                    content_length = int(headers.get('content-length', 0))
+                    if content_length < 0:
+                        raise ValueError("negative content-length")
+                except ValueError:  # malformed request, the rest of the stream can't be framed
+                    await self._write_response(writer, 400, b'malformed request', 'text/plain')
+                    break
+
+                body = await reader.readexactly(content_length)
+                status, response, content_type = await self._route(method, path.strip('/'), body)
+                await self._write_response(writer, status, response, content_type)
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            writer.close()
+
+    async def _route(self, method, name, body):
+        """ Dispatches a request, returns (status, body bytes, content type). """
+        if method == 'GET' and name == 'stats':
+            return 200, json.dumps(self.stats()).encode('utf-8'), 'application/json'
+
+        if method != 'POST' or name not in self.endpoints:
+            return 404, b'', 'text/plain'
+
+        try:
+            payload = int(json.loads(body.decode('utf-8'))['batch_size']) if name == 'generate' \
+                else np.load(io.BytesIO(body), allow_pickle=False)
+            result = await self.submit(name, payload)
+        except _ModelError as e:
+            return 500, str(e).encode('utf-8'), 'text/plain'
+        except OverflowError as e:
+            return 503, str(e).encode('utf-8'), 'text/plain'
+        except ValueError as e:
+            return 413 if str(e).startswith('413') else 400, str(e).encode('utf-8'), 'text/plain'
+        except Exception as e:
+            return 400, str(e).encode('utf-8'), 'text/plain'
+
+        buffer = io.BytesIO()
+        np.save(buffer, result, allow_pickle=False)
+        return 200, buffer.getvalue(), 'application/octet-stream'
+
+    async def start(self, host='127.0.0.1', port=8080, unix_socket=None):
+        """ Starts the batching loops and listens on host:port (or a unix socket).
+
+        :param host: the host to bind
+        :param port: the port to bind
+        :param unix_socket: path of a unix socket, used instead of host:port if set
+        :returns: the asyncio server
+        :rtype: asyncio.AbstractServer
+
+        """
+        for endpoint in self.endpoints.values():
+            endpoint.queue = asyncio.Queue()
+            asyncio.ensure_future(self._batch_loop(endpoint))
+
+        self._server = await asyncio.start_unix_server(self._handle, path=unix_socket) \
+            if unix_socket is not None else await asyncio.start_server(self._handle, host, port)
+        return self._server
+
+    def serve_forever(self, host='127.0.0.1', port=8080, unix_socket=None):
+        """ Blocking entry point. """
+        async def _serve():
+            server = await self.start(host, port, unix_socket)
+            async with server:
+                await server.serve_forever()
+
+        asyncio.run(_serve())
@@ -0,0 +1,209 @@
+from __future__ import print_function
+import torch
+
+from .normalization import scoped_eval
+from .reparameterizers.isotropic_gaussian import IsotropicGaussian
+from .reparameterizers.mixture import Mixture
+
+
+def continuous_slice(model):
+    """ The slice of z holding the continuous latent (None if there is none).
+
+    :param model: the AbstractVAE
+    :returns: slice or None
+    :rtype: slice
+
+    """
+    reparam_type = model.config['reparam_type']
+    if reparam_type in ['discrete', 'bernoulli']:
+        return None
+
+    if 'mixture' in reparam_type:  # z = [continuous, discrete]
+        return slice(0, model.reparameterizer.continuous.output_size)
+
+    return slice(0, model.reparameterizer.output_size)
+
+
+def gaussian_slice(model):
+    """ The slice of z holding the gaussian latent (None if there is none), i.e. the
+        dims that prior(scale_var=...) scales: beta / kumaraswamy latents ignore it.
+
+    :param model: the AbstractVAE
+    :returns: slice or None
+    :rtype: slice
+
+    """
+    reparameterizer = model.reparameterizer
+    if isinstance(reparameterizer, IsotropicGaussian):
+        return slice(0, reparameterizer.output_size)
+
+    if isinstance(reparameterizer, Mixture) and reparameterizer.continuous_key == 'gaussian':
+        return slice(0, reparameterizer.continuous.output_size)  # z = [continuous, discrete]
+
+    return None
+
+
+def slerp(z0, z1, t, eps=1e-7):
+    """ Spherical interpolation between the rows of z0 and z1, falls back
+        to a linear interpolation for (nearly) parallel vectors.
+
+    :param z0: [B, D] start
+    :param z1: [B, D] end
+    :param t: [T] interpolation weights in [0, 1]
+    :param eps: tolerance
+    :returns: [B, T, D] interpolations
+    :rtype: torch.Tensor
+
+    """
+    t = t.view(1, -1, 1)
+    z0_unit = z0 / (z0.norm(dim=-1, keepdim=True) + eps)
+    z1_unit = z1 / (z1.norm(dim=-1, keepdim=True) + eps)
+    omega = torch.acos(torch.clamp((z0_unit * z1_unit).sum(-1), -1 + eps, 1 - eps)).view(-1, 1, 1)
+    sin_omega = torch.sin(omega)
+    spherical = (torch.sin((1 - t) * omega) * z0.unsqueeze(1)
+                 + torch.sin(t * omega) * z1.unsqueeze(1)) / sin_omega
+    linear = (1 - t) * z0.unsqueeze(1) + t * z1.unsqueeze(1)
+    return torch.where(sin_omega.abs() > 1e-4, spherical, linear)
+
+
+class LatentGrid(object):
+    def __init__(self, model):
+        """ Builds traversal / interpolation / temperature grids as a single latent
+            tensor and decodes it in memory-bounded chunks. Every add_* call appends
+            a block of rows and a metadata entry (kind, rows and its grid shape).
+            Rows are indexed by dim -2: multi-sample priors (eg: MSGVAE) give [K, N, D] blocks.
+
+        :param model: the AbstractVAE (decoding runs in eval mode)
+        :returns: LatentGrid object
+        :rtype: object
+
+        """
+        self.model = model
+        self.blocks = []
+        self.metadata = []
+
+    def _append(self, z, kind, shape, **info):
+        begin = len(self)
+        self.blocks.append(z)
+        self.metadata.append(dict(kind=kind, begin=begin, end=begin + z.size(-2), shape=shape, **info))
+        return self
+
+    def add_traversal(self, z_base, dims=None, values=None):
+        """ Per-dimension traversals: for every base row and continuous dim, sweeps the dim
+            over values keeping the others fixed. Rows are ordered [base, dim, value].
+
+        :param z_base: [B, D] base latents, eg: from inference_posterior or sample_prior
+        :param dims: the dims to traverse (every continuous dim if None)
+        :param values: [V] values of the sweep (linspace(-3, 3, 10) if None)
+        :returns: self
+        :rtype: LatentGrid
+
+        """
+        if dims is None:
+            cont = continuous_slice(self.model)
+            assert cont is not None, "no continuous dims to traverse"
+            dims = list(range(cont.start, cont.stop))
+
+        values = torch.linspace(-3, 3, 10) if values is None else torch.as_tensor(values)
+        values = values.type_as(z_base)
+        num_base, num_dims, num_values = z_base.size(0), len(dims), values.size(0)
+        z = z_base.view(num_base, 1, 1, -1).repeat(1, num_dims, num_values, 1)
+        for i, dim in enumerate(dims):
+            z[:, i, :, dim] = values.view(1, -1)
+
+        return self._append(z.view(-1, z_base.size(-1)), 'traversal',
+                            (num_base, num_dims, num_values), dims=list(dims))
+
+    def add_interpolation(self, z0, z1, num_steps=10):
+        """ Spherical interpolation of the continuous latent between pairs of rows, a
+            discrete part (mixture) switches from z0 to z1 half-way. Rows are ordered [pair, step].
+
+        :param z0: [B, D] start latents
+        :param z1: [B, D] end latents
+        :param num_steps: number of interpolation steps (incl. both ends)
+        :returns: self
+        :rtype: LatentGrid
+
+        """
+        t = torch.linspace(0, 1, num_steps).type_as(z0)
+        z = torch.where((t.view(1, -1, 1) < 0.5), z0.unsqueeze(1), z1.unsqueeze(1))
+        cont = continuous_slice(self.model)
+        if cont is not None:
+            z = z.clone()
+            z[..., cont] = slerp(z0[:, cont], z1[:, cont], t)
+
+        return self._append(z.view(-1, z0.size(-1)), 'interpolation', (z0.size(0), num_steps))
+
+    def add_encoded_interpolation(self, x0, x1, num_steps=10):
+        """ Encodes pairs of inputs and interpolates between their posteriors.
+
+        :param x0: [B, ...] start inputs
+        :param x1: [B, ...] end inputs
+        :param num_steps: number of interpolation steps (incl. both ends)
+        :returns: self
+        :rtype: LatentGrid
+
+        """
+        z0, _ = self.model.inference_posterior(x0)
+        z1, _ = self.model.inference_posterior(x1)
+        return self.add_interpolation(z0, z1, num_steps)
+
+    def add_temperature_sweep(self, batch_size, scale_vars=(0.5, 0.75, 1.0, 1.25)):
+        """ Prior samples at several generative_scale_var temperatures. Rows are ordered
+            [temperature, sample]; the same base noise is re-used for every temperature
+            of a gaussian latent so that the rows only differ by temperature. Like the
+            prior, only the gaussian dims are scaled (beta / kumaraswamy stay in [0, 1]).
+
+        :param batch_size: number of samples per temperature
+        :param scale_vars: the prior scales
+        :returns: self
+        :rtype: LatentGrid
+
+        """
+        with torch.no_grad():
+            z = self.model.sample_prior(batch_size, scale_var=1.0)
+            gaussian = gaussian_slice(self.model)
+            blocks = []
+            for scale_var in scale_vars:
+                z_i = z.clone()
+                if gaussian is not None:
+                    z_i[..., gaussian] = z[..., gaussian] * scale_var
+
+                blocks.append(z_i)
+
+        return self._append(torch.cat(blocks, -2), 'temperature', (len(scale_vars), batch_size),
+                            scale_vars=list(scale_vars))
+
+    @property
+    def z(self):
+        """ The whole grid as a single [N, D] (or [K, N, D]) latent tensor, [N, D] blocks
+            of a multi-sample grid are shared by the K samples (as in the decoder). """
+        num_samples = [b.size(0) for b in self.blocks if b.dim() == 3]
+        return torch.cat([b.unsqueeze(0).expand(num_samples[0], *b.shape)
+                          if b.dim() == 2 and num_samples else b
+                          for b in self.blocks], -2)
+
+    def __len__(self):
+        return sum(b.size(-2) for b in self.blocks)
+
+    def decode(self, chunk_size=None):
+        """ Decodes the grid in chunks of at most chunk_size rows (batch_size if None),
+            streaming the activated (cpu) outputs.
+
+        :param chunk_size: max rows decoded at once
+        :returns: generator of (begin, end, decoded tensor)
+        :rtype: generator
+
+        """
+        chunk_size = chunk_size or self.model.config['batch_size']
+        with scoped_eval(self.model):
+            for block_begin, block in zip([m['begin'] for m in self.metadata], self.blocks):
+                for begin in range(0, block.size(-2), chunk_size):
+                    z = block[..., begin:begin + chunk_size, :]
+                    with torch.no_grad():
+                        decoded = self.model.generate_synthetic_samples(z.size(-2), z_samples=z)
+
+                    yield block_begin + begin, block_begin + begin + z.size(-2), decoded.cpu()
+
+    def decode_all(self, chunk_size=None):
+        return torch.cat([decoded for _, _, decoded in self.decode(chunk_size)], 0)
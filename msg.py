@@ -3,14 +3,17 @@ from __future__ import print_function
 import torch
 import torch.nn as nn
 from functools import partial
+from torch.func import functional_call, vmap
 
 from helpers.layers import str_to_activ_module, get_decoder
 from .reparameterizers.gumbel import GumbelSoftmax
 from .reparameterizers.mixture import Mixture
 from .reparameterizers.beta import Beta
+from .reparameterizers.kumaraswamy import Kumaraswamy
 from .reparameterizers.bernoulli import Bernoulli
 from .reparameterizers.isotropic_gaussian import IsotropicGaussian
 from .abstract_vae import AbstractVAE
+from .normalization import has_running_stats
 
 
 class MSGVAE(AbstractVAE):
@@ -25,11 +28,15 @@ class MSGVAE(AbstractVAE):
         super(MSGVAE, self).__init__(input_shape, **kwargs)
         reparam_dict = {
             'beta': Beta,
+            'kumaraswamy': Kumaraswamy,
             'bernoulli': Bernoulli,
             'discrete': GumbelSoftmax,
             'isotropic_gaussian': IsotropicGaussian,
             'mixture': partial(Mixture, num_discrete=self.config['discrete_size'],
-                               num_continuous=self.config['continuous_size'])
+                               num_continuous=self.config['continuous_size']),
+            'mixture_kumaraswamy': partial(Mixture, num_discrete=self.config['discrete_size'],
+                                           num_continuous=self.config['continuous_size'],
+                                           is_beta=True, use_kumaraswamy=True)
         }
         self.reparameterizer = reparam_dict[self.config['reparam_type']](config=self.config)
 
@@ -44,19 +51,15 @@ class MSGVAE(AbstractVAE):
                                                 activation_fn=self.activation_fn)
                                     for i in range(self.config['max_time_steps'])])
 
-        # over-ride the reparam prior
-        self.single_prior = self.reparameterizer.prior
-        self.reparameterizer.prior = self._prior_override
-
-    def _prior_override(self, batch_size, **kwargs):
-        """ Helper to generate many samples from the true prior
+    def sample_prior(self, batch_size, **kwargs):
+        """ Helper to generate many samples from the true prior in one call
 
         :param batch_size: the batch size to generate samples for
-        :returns: a list of priors
-        :rtype: [torch.Tensor]
+        :returns: prior samples of size [max_time_steps, batch_size, D]
+        :rtype: torch.Tensor
 
         """
-        return [self.single_prior(batch_size, **kwargs) for _ in range(self.config['max_time_steps'])]
+        return self.reparameterizer.prior(batch_size, num_samples=self.config['max_time_steps'], **kwargs)
 
     def has_discrete(self):
         """ Returns true if there is a discrete reparameterization.
@@ -67,51 +70,61 @@ class MSGVAE(AbstractVAE):
         """
         return isinstance(self.reparameterizer, GumbelSoftmax)
 
-    def kld(self, dist_list):
-        """ KL-Divergence of the distribution dict and the prior of that distribution.
-            NOTE: we use the last one because we calculate the analytical KL divergence
-                  which only necessisitates the parameters of the distribution.
+    def reparameterize(self, logits):
+        """ Reparameterize the logits into max_time_steps samples with a single call.
+            NOTE: the analytical KL only needs the distribution params, which are shared.
 
-        :param dist_list: the list of distributions.
-        :returns: tensor that is of dimension batch_size
-        :rtype: torch.Tensor
+        :param logits: unactivated encoded logits.
+        :returns: samples of size [max_time_steps, batch_size, D] and reparam dict
+        :rtype: torch.Tensor, dict
 
         """
-        return self.reparameterizer.kl(dist_list[-1])
+        return self.reparameterizer(logits, num_samples=self.config['max_time_steps'])
 
-    def reparameterize(self, logits):
-        """ Reparameterize the logits and returns a dict.
+    def _gate_ensemble(self, z):
+        """ Runs gate k on z[k] for every k as a single vmapped call over the stacked
+            gate weights (stacked per call so that the gradients reach every gate).
+            Gates with running statistics can't update them under vmap and are looped.
 
-        :param logits: unactivated encoded logits.
-        :returns: reparam dict
-        :rtype: dict
+        :param z: [num_samples, batch_size, D] latent samples, one per gate
+        :returns: [num_samples, batch_size, ...] gate logits
+        :rtype: torch.Tensor
 
         """
-        z_list, params_list = [], []
-        for _ in range(self.config['max_time_steps']):
-            z, params = self.reparameterizer(logits)
-            z_list.append(z); params_list.append(params)
+        if any(has_running_stats(m) for m in self.gates.modules()):
+            return torch.stack([gate(z_i) for gate, z_i in zip(self.gates, z)], 0)
 
-        return z_list, params_list
+        def stacked(named_tensors):
+            named_tensors = [dict(t) for t in named_tensors]
+            return {k: torch.stack([t[k] for t in named_tensors], 0) for k in named_tensors[0]}
 
-        # return zip(*[self.reparameterizer(logits)
-        #              for _ in range(self.config['max_time_steps'])])
+        params = stacked(gate.named_parameters() for gate in self.gates)
+        buffers = stacked(gate.named_buffers() for gate in self.gates)
+        return vmap(lambda p, b, z_i: functional_call(self.gates[0], (p, b), (z_i,)),
+                    randomness='different')(params, buffers, z)
 
     def decode(self, z):
         """ Decode a set of latent z back to x_mean.
+            The shared decoder runs once over all samples stacked along the batch
+            and the gates run as one batched ensemble, one gate per sample.
 
-        :param z: the latent tensor.
+        :param z: the latent samples, list of [B, D], a [K, B, D] tensor or a single [B, D] (eg: inference) tensor.
         :returns: decoded logits (unactivated).
         :rtype: torch.Tensor
 
         """
-        assert isinstance(z, (list, tuple)), "expecting a tuple or list"
-        gate_encodes = [torch.sigmoid(g(z_i)) for g, z_i in zip(self.gates, z)]
-        return torch.mean(torch.cat([(g_i * self.decoder(z_i.contiguous())).unsqueeze(0)
-                                     for z_i, g_i in zip(z, gate_encodes)], 0), 0)
-        # if self.training:
-        #     return torch.mean(torch.cat([(g_i * self.decoder(z_i.contiguous())).unsqueeze(0)
-        #                                  for z_i, g_i in zip(z, self.gate_encodes)], 0), 0)
+        z = torch.stack(z, 0) if isinstance(z, (list, tuple)) else z
+        if z.dim() == 2:  # a single latent is shared by every gate
+            z = z.unsqueeze(0).expand(self.config['max_time_steps'], *z.shape)
+
+        assert z.dim() == 3, "expecting [num_samples, batch_size, latent_size]"
+        num_samples, batch_size = z.size(0), z.size(1)
+        assert num_samples == len(self.gates), \
+            "expecting one sample per gate, got {} for {} gates".format(num_samples, len(self.gates))
 
+        # single pass of the shared decoder over [K * B, D]
+        decoded = self.decoder(z.contiguous().view(num_samples * batch_size, -1))
+        decoded = decoded.view(num_samples, batch_size, *decoded.shape[1:])
 
-        # return torch.mean(torch.cat([self.decoder(z_i.contiguous()).unsqueeze(0) for z_i in z], 0), 0)
+        # gate each sample with its own network and average
+        return torch.mean(torch.sigmoid(self._gate_ensemble(z)) * decoded, 0)
@@ -0,0 +1,68 @@
+from __future__ import print_function
+import functools
+import contextlib
+import torch.nn as nn
+
+
+def has_running_stats(module):
+    """ True for batch / instance norm layers that track running statistics.
+
+    :param module: the module
+    :returns: True/False
+    :rtype: bool
+
+    """
+    return isinstance(module, (nn.modules.batchnorm._BatchNorm,
+                               nn.modules.instancenorm._InstanceNorm)) \
+        and module.track_running_stats and module.running_mean is not None
+
+
+@contextlib.contextmanager
+def _eval_modules(modules):
+    """ Puts modules in eval mode, restoring each one's previous mode on exit. """
+    modes = [(m, m.training) for m in modules]
+    for m, _ in modes:
+        m.train(False)
+
+    try:
+        yield
+    finally:
+        for m, training in modes:  # parents first, so children end with their own mode
+            m.train(training)
+
+
+def frozen_normalization(module):
+    """ Puts every normalization layer of module with running statistics in eval mode
+        (restoring the previous modes on exit): outputs no longer depend on the batch
+        composition, so any number of samples can be decoded, and generation does not
+        update the running statistics. Other layers (eg: dropout) keep their mode.
+
+    :param module: the network
+    :returns: context manager
+    :rtype: contextlib.AbstractContextManager
+
+    """
+    return _eval_modules([m for m in module.modules() if has_running_stats(m)])
+
+
+def scoped_eval(module):
+    """ Puts every layer of module in eval mode (eg: no dropout, frozen normalization)
+        and restores each layer's previous mode on exit, unlike module.eval() which
+        would leave a training model in eval mode.
+
+    :param module: the network
+    :returns: context manager
+    :rtype: contextlib.AbstractContextManager
+
+    """
+    return _eval_modules(list(module.modules()))
+
+
+def with_frozen_normalization(fn):
+    """ Decorates a method of an nn.Module to run under frozen_normalization(self). """
+    @functools.wraps(fn)
+    def wrapper(self, *args, **kwargs):
+        with frozen_normalization(self):
+            return fn(self, *args, **kwargs)
+
+    return wrapper
@@ -9,6 +9,8 @@ import torch.distributions as D
 from torch.autograd import Variable
 
 from helpers.utils import float_type, one_hot, ones_like, long_type
+from .straight_through import straight_through_threshold
+from .divergences import kl_bernoulli_uniform, kl_bernoulli_bernoulli
 
 
 class Bernoulli(nn.Module):
@@ -28,7 +30,9 @@ class Bernoulli(nn.Module):
         return torch.distributions.Bernoulli(probs=uniform_probs)
 
     def prior(self, batch_size, **kwargs):
-        return self._prior_distribution(batch_size).sample()
+        num_samples = kwargs.get('num_samples', None)
+        sample_shape = () if num_samples is None else (num_samples,)
+        return self._prior_distribution(batch_size).sample(sample_shape)
 
     def _setup_anneal_params(self):
         """setup the annealing parameters; TODO: parameterize
@@ -55,18 +59,18 @@ class Bernoulli(nn.Module):
                 * (1 + math.cos(math.pi * -1 / self.last_epoch)) / 2
             self.tau = np.clip(updated_tau, self.clip_min, self.max_temp)
 
-    def reparmeterize(self, logits):
+    def reparmeterize(self, logits, num_samples=None):
         """ reparamterize the logits
 
         :param logits: non-activated logits
+        :param num_samples: number of samples per logit row (None for a single sample)
         :returns: reparameterized and hard outputs
         :rtype: torch.Tensor, torch.Tensor
 
         """
-        relaxed = D.RelaxedBernoulli(temperature=self.tau, logits=logits).rsample()
-        hard = relaxed.clone()
-        hard[relaxed < 0.5] = 0.0
-        hard[relaxed >= 0.5] = 1.0
+        sample_shape = () if num_samples is None else (num_samples,)
+        relaxed = D.RelaxedBernoulli(temperature=self.tau, logits=logits).rsample(sample_shape)
+        hard = straight_through_threshold(relaxed, 0.5)
         return relaxed, hard
 
     def mutual_info_analytic(self, params, eps=1e-9):
@@ -80,13 +84,11 @@ class Bernoulli(nn.Module):
 
     @staticmethod
     def _kld_bern_uniform(q_z, dim=-1, eps=1e-9):
-        return torch.mul(q_z, torch.log(q_z + eps) - np.log(0.5)) + \
-            torch.mul(1.0 - q_z, torch.log(1 - q_z + eps) - np.log(0.5))
+        return kl_bernoulli_uniform(q_z, eps=eps)
 
     @staticmethod
     def _kld_bern_bern(q_z, p_z, dim=-1, eps=1e-9):
-        return torch.mul(q_z, torch.log(q_z + eps) - torch.log(p_z + eps)) + \
-            torch.mul(1.0 - q_z, torch.log(1 - q_z + eps) - torch.log(p_z + eps))
+        return kl_bernoulli_bernoulli(q_z, p_z, eps=eps)
 
     def kl(self, dist_a, prior=None, eps=1e-9):
         if prior is None:  # use standard uniform prior
@@ -111,15 +113,29 @@ class Bernoulli(nn.Module):
     def log_likelihood(self, z, params):
         return D.Bernoulli(logits=params['discrete']['logits']).log_prob(z)
 
-    def forward(self, logits):
+    def inference(self, logits):
+        """ Deterministic, side-effect free reparameterization: returns the
+            mode, i.e. sigmoid(logits) >= 0.5, without sampling or annealing.
+
+        :param logits: unactivated logits.
+        :returns: binary tensor and (minimal) params.
+        :rtype: torch.Tensor, dict
+
+        """
+        z_hard = (logits >= 0).type_as(logits)
+        return z_hard, { 'z': z_hard, 'logits': logits,
+                         'discrete': {'z_hard': z_hard, 'logits': logits} }
+
+    def forward(self, logits, num_samples=None):
         self.cosine_anneal()  # anneal first
-        z, z_hard = self.reparmeterize(logits)
+        z, z_hard = self.reparmeterize(logits, num_samples=num_samples)
         params = {
             'z_hard': z_hard,
             'logits': logits,
             'tau_scalar': self.tau
         }
-        self.iteration += 1
+        if self.training:  # annealing is frozen outside of training
+            self.iteration += 1
 
         if self.training:
             # return the reparameterization
@@ -4,13 +4,13 @@ from __future__ import print_function
 import numpy as np
 import torch
 import torch.nn as nn
-import torch.distributions as D
 import pyro.distributions as PD
 import torch.nn.functional as F
 from torch.autograd import Variable
 
-from helpers.utils import zeros_like, ones_like, same_type
+from helpers.utils import same_type
 from helpers.utils import eps as eps_fn
+from .divergences import kl_beta_beta, kl_beta_symmetric_prior
 
 
 class Beta(nn.Module):
@@ -36,10 +36,12 @@ class Beta(nn.Module):
         Journal of Statistics, 5, 1450-1470.
 
         :param batch_size: the number of prior samples
-        :returns: prior
+        :returns: prior, [num_samples, batch_size, D] if num_samples is passed
         :rtype: torch.Tensor
 
         """
+        num_samples = kwargs.get('num_samples', None)
+        sample_shape = () if num_samples is None else (num_samples,)
         conc1 = Variable(
             same_type(self.config['half'], self.config['cuda'])(
                 batch_size, self.output_size
@@ -50,31 +52,34 @@ class Beta(nn.Module):
                 batch_size, self.output_size
             ).zero_() + 1/3
         )
-        return PD.Beta(conc1, conc2).sample()
+        return PD.Beta(conc1, conc2).sample(sample_shape)
 
-    def _reparametrize_beta(self, conc1, conc2):
+    def _reparametrize_beta(self, conc1, conc2, num_samples=None):
         """ Internal function to reparameterize beta distribution using concentrations.
 
         :param conc1: concentration 1
         :param conc2: concentration 2
+        :param num_samples: draw [num_samples, *conc1.shape] samples
         :returns: reparameterized sample, distribution params
         :rtype: torch.Tensor, dict
 
         """
+        sample_shape = () if num_samples is None else (num_samples,)
         if self.training:
             # rsample is CPU only ¯\_(ツ)_/¯, see https://tinyurl.com/y9e8mtcd
             # thus use pyro which DOES have a GPU version
-            beta = PD.Beta(conc1, conc2).rsample()
+            beta = PD.Beta(conc1, conc2).rsample(sample_shape)
             return beta, {'conc1': conc1, 'conc2': conc2}
 
         # can't use mean like in gaussian because beta mean can be > 1.0
-        return PD.Beta(conc1, conc2).sample(), {'conc1': conc1, 'conc2': conc2}
+        return PD.Beta(conc1, conc2).sample(sample_shape), {'conc1': conc1, 'conc2': conc2}
 
-    def reparmeterize(self, logits):
+    def reparmeterize(self, logits, num_samples=None):
         """ Given logits reparameterize to a beta using
             first half of features for mean and second half for std.
 
         :param logits: unactivated logits
+        :param num_samples: number of samples per logit row (None for a single sample)
         :returns: reparameterized tensor (if training), param dict
         :rtype: torch.Tensor, dict
 
@@ -91,7 +96,7 @@ class Beta(nn.Module):
         else:
             raise Exception("unknown number of dims for isotropic gauss reparam")
 
-        return self._reparametrize_beta(conc1, conc2)
+        return self._reparametrize_beta(conc1, conc2, num_samples=num_samples)
 
     def _kld_beta_kerman_prior(self, conc1, conc2):
         """ Internal function to do a KL-div against the prior.
@@ -102,10 +107,7 @@ class Beta(nn.Module):
         :rtype: torch.Tensor
 
         """
-        prior = PD.Beta(zeros_like(conc1) + 1/3,
-                        zeros_like(conc2) + 1/3)
-        beta = PD.Beta(conc1, conc2)
-        return torch.sum(D.kl_divergence(beta, prior), -1)
+        return torch.sum(kl_beta_symmetric_prior(conc1, conc2, prior_conc=1/3), -1)
 
     def kl(self, dist_a, prior=None):
         if prior == None:  # use standard reparamterizer
@@ -114,9 +116,9 @@ class Beta(nn.Module):
             )
 
         # we have two distributions provided (eg: VRNN)
-        return torch.sum(D.kl_divergence(
-            PD.Beta(dist_a['beta']['conc1'], dist_a['beta']['conc2']),
-            PD.Beta(prior['beta']['conc1'], prior['beta']['conc2'])
+        return torch.sum(kl_beta_beta(
+            dist_a['beta']['conc1'], dist_a['beta']['conc2'],
+            prior['beta']['conc1'], prior['beta']['conc2']
         ), -1)
 
 
@@ -129,11 +131,10 @@ class Beta(nn.Module):
         :rtype: torch.Tensor
 
         """
-        z_true = PD.Beta(params['beta']['conc1'],
-                         params['beta']['conc2'])
-        z_match = PD.Beta(params['q_z_given_xhat']['beta']['conc1'],
-                          params['q_z_given_xhat']['beta']['conc2'])
-        kl_proxy_to_xent = torch.sum(D.kl_divergence(z_match, z_true), dim=-1)
+        kl_proxy_to_xent = torch.sum(kl_beta_beta(
+            params['q_z_given_xhat']['beta']['conc1'], params['q_z_given_xhat']['beta']['conc2'],
+            params['beta']['conc1'], params['beta']['conc2']
+        ), dim=-1)
         return self.config['continuous_mut_info'] * kl_proxy_to_xent
 
     def log_likelihood(self, z, params):
@@ -148,15 +149,32 @@ class Beta(nn.Module):
         return PD.Beta(params['beta']['conc1'],
                        params['beta']['conc2']).log_prob(z)
 
-    def forward(self, logits):
+    def inference(self, logits):
+        """ Deterministic, side-effect free reparameterization. The sigmoid-ed
+            concentrations are < 1, thus the density is U-shaped and the mode sits
+            on the boundary, so the mean conc1 / (conc1 + conc2) is returned instead.
+
+        :param logits: unactivated logits.
+        :returns: mean tensor and (minimal) params.
+        :rtype: torch.Tensor, dict
+
+        """
+        eps = eps_fn(self.config['half'])
+        conc1 = torch.sigmoid(logits[..., 0:self.output_size] + eps)
+        conc2 = torch.sigmoid(logits[..., self.output_size:] + eps)
+        z = conc1 / (conc1 + conc2)
+        return z, { 'z': z, 'logits': logits, 'beta': {'conc1': conc1, 'conc2': conc2} }
+
+    def forward(self, logits, num_samples=None):
         """ Returns a reparameterized gaussian and it's params.
 
         :param logits: unactivated logits.
+        :param num_samples: if set returns [num_samples, B, D] samples.
         :returns: reparam tensor and params.
         :rtype: torch.Tensor, dict
 
         """
-        z, beta_params = self.reparmeterize(logits)
+        z, beta_params = self.reparmeterize(logits, num_samples=num_samples)
         beta_params['conc1_mean'] = torch.mean(beta_params['conc1'])
         beta_params['conc2_mean'] = torch.mean(beta_params['conc2'])
         return z, { 'z': z, 'logits': logits, 'beta':  beta_params }
@@ -8,10 +8,12 @@ import torch.nn.functional as F
 from copy import deepcopy
 from torch.autograd import Variable
 from functools import partial
+from collections import OrderedDict
 
 from helpers.utils import float_type, zeros, get_dtype
 from helpers.layers import get_encoder, str_to_activ_module
 from .beta import Beta
+from .kumaraswamy import Kumaraswamy
 from .bernoulli import Bernoulli
 from .gumbel import GumbelSoftmax
 from .mixture import Mixture
@@ -38,6 +40,170 @@ class ConcatReparameterizer(nn.Module):
         # to enumerate over for reparameterization
         self._input_sizing = [0] + list(np.cumsum([r.input_size for r in self.reparameterizers]))
 
+        # children of the same type + size are run as one call over the batch-stacked logits
+        self._groups = self._build_groups()
+        self._streams = None  # lazily created cuda streams, one per group
+
+    def _build_groups(self):
+        """ Helper to group the reparameterizers by (type, input_size).
+
+        :returns: list of lists of reparameterizer indices
+        :rtype: list
+
+        """
+        groups = OrderedDict()
+        for i, (reparam_str, reparam) in enumerate(zip(self.reparam_strs, self.reparameterizers)):
+            groups.setdefault((reparam_str, reparam.input_size), []).append(i)
+
+        return list(groups.values())
+
+    @staticmethod
+    def _split_params(params, num_splits, batch_size, num_samples=None):
+        """ Splits a (nested) param dict of a batch-stacked call into num_splits param dicts,
+            recomputing the '*_mean' summaries for each split.
+
+        :param params: the param dict
+        :param num_splits: the number of splits
+        :param batch_size: the batch size of a single split
+        :param num_samples: if set, [num_samples, B, D] sample tensors are split along dim 1
+        :returns: list of param dicts
+        :rtype: list
+
+        """
+        splits = [{} for _ in range(num_splits)]
+        for k, v in params.items():
+            if isinstance(v, dict):
+                v = ConcatReparameterizer._split_params(v, num_splits, batch_size, num_samples)
+            elif torch.is_tensor(v) and num_samples is not None and v.dim() == 3 \
+                 and v.size(1) == num_splits * batch_size:
+                v = torch.split(v, batch_size, dim=1)
+            elif torch.is_tensor(v) and v.dim() > 0 and v.size(0) == num_splits * batch_size:
+                v = torch.split(v, batch_size, dim=0)
+            else:
+                v = [v for _ in range(num_splits)]
+
+            for split, v_i in zip(splits, v):
+                split[k] = v_i
+
+        for split in splits:
+            for k in split.keys():
+                if k.endswith('_mean') and torch.is_tensor(split.get(k[:-len('_mean')], None)):
+                    split[k] = torch.mean(split[k[:-len('_mean')]])
+
+        return splits
+
+    @staticmethod
+    def _merge_params(params_list):
+        """ Inverse of _split_params: stacks a list of (nested) param dicts along the batch.
+
+        :param params_list: list of param dicts (or None)
+        :returns: a single param dict (or None)
+        :rtype: dict
+
+        """
+        if params_list[0] is None:
+            return None
+
+        merged = {}
+        for k, v in params_list[0].items():
+            if isinstance(v, dict):
+                merged[k] = ConcatReparameterizer._merge_params([p[k] for p in params_list])
+            elif torch.is_tensor(v) and v.dim() > 0:
+                merged[k] = torch.cat([p[k] for p in params_list], 0)
+            else:
+                merged[k] = v
+
+        return merged
+
+    def _sync_group_state(self, group):
+        """ Copies the annealing state (eg: tau in gumbel) of the group leader,
+            the only member which was called, to the rest of the group.
+
+        :param group: list of reparameterizer indices
+        :returns: None
+        :rtype: None
+
+        """
+        leader = self.reparameterizers[group[0]]
+        for idx in group[1:]:
+            for src, dst in zip(leader.modules(), self.reparameterizers[idx].modules()):
+                for attr in ['iteration', 'tau']:
+                    if hasattr(src, attr):
+                        setattr(dst, attr, getattr(src, attr))
+
+    def _reparameterize_group(self, group, logits, num_samples=None):
+        """ Reparameterizes all members of a group with one call of the group leader.
+
+        :param group: list of reparameterizer indices
+        :param logits: the input logits
+        :param num_samples: number of samples per logit row (None for a single sample)
+        :returns: list of reparameterized tensors, list of params
+        :rtype: list, list
+
+        """
+        logits_list = [logits[:, self._input_sizing[i]:self._input_sizing[i+1]] for i in group]
+        if len(group) == 1:
+            reparameterized_i, params = self.reparameterizers[group[0]](
+                logits_list[0], num_samples=num_samples)
+            return [reparameterized_i], [{**params, 'logits': logits_list[0]}]
+
+        batch_size = logits.size(0)
+        reparameterized, params = self.reparameterizers[group[0]](
+            torch.cat(logits_list, 0), num_samples=num_samples)
+        self._sync_group_state(group)
+        params_list = self._split_params(params, len(group), batch_size, num_samples)
+        batch_dim = 0 if num_samples is None else 1
+        return list(torch.split(reparameterized, batch_size, dim=batch_dim)), \
+            [{**params_i, 'logits': logits_i} for params_i, logits_i in zip(params_list, logits_list)]
+
+    @staticmethod
+    def _record_stream(obj, stream):
+        """ Marks every cuda tensor in a (nested) structure as in-use by stream.
+
+        :param obj: tensor / dict / list
+        :param stream: the cuda stream
+        :returns: None
+        :rtype: None
+
+        """
+        if torch.is_tensor(obj) and obj.is_cuda:
+            obj.record_stream(stream)
+        elif isinstance(obj, dict):
+            for v in obj.values():
+                ConcatReparameterizer._record_stream(v, stream)
+        elif isinstance(obj, (list, tuple)):
+            for v in obj:
+                ConcatReparameterizer._record_stream(v, stream)
+
+    def _run_groups(self, logits, num_samples=None):
+        """ Runs every group, concurrently on separate cuda streams when possible.
+
+        :param logits: the input logits
+        :param num_samples: number of samples per logit row (None for a single sample)
+        :returns: list of (reparameterized list, params list) per group
+        :rtype: list
+
+        """
+        if not logits.is_cuda or len(self._groups) == 1:
+            return [self._reparameterize_group(group, logits, num_samples) for group in self._groups]
+
+        if self._streams is None:
+            self._streams = [torch.cuda.Stream(device=logits.device) for _ in self._groups]
+
+        current_stream = torch.cuda.current_stream(logits.device)
+        outputs = []
+        for group, stream in zip(self._groups, self._streams):
+            stream.wait_stream(current_stream)
+            logits.record_stream(stream)
+            with torch.cuda.stream(stream):
+                outputs.append(self._reparameterize_group(group, logits, num_samples))
+
+        for stream, output in zip(self._streams, outputs):
+            current_stream.wait_stream(stream)
+            self._record_stream(output, current_stream)
+
+        return outputs
+
     def _generate_reparameterizers(self):
         """ Helper to generate all the required reparamterizers
 
@@ -47,11 +213,15 @@ class ConcatReparameterizer(nn.Module):
         """
         reparam_dict = {
             'beta': Beta,
+            'kumaraswamy': Kumaraswamy,
             'bernoulli': Bernoulli,
             'discrete': GumbelSoftmax,
             'isotropic_gaussian': IsotropicGaussian,
             'mixture': partial(Mixture, num_discrete=self.config['discrete_size'],
-                               num_continuous=self.config['continuous_size'])
+                               num_continuous=self.config['continuous_size']),
+            'mixture_kumaraswamy': partial(Mixture, num_discrete=self.config['discrete_size'],
+                                           num_continuous=self.config['continuous_size'],
+                                           is_beta=True, use_kumaraswamy=True)
         }
 
         # build the base reparameterizers
@@ -83,11 +253,10 @@ class ConcatReparameterizer(nn.Module):
         :rtype: torch.Tensor
 
         """
-        mi = None
-        for param, reparam in zip(dists, self.reparameterizers):
-            mi = reparam.mutual_info(param) if mi is None else mi + reparam.mutual_info(param)
-
-        return mi
+        # evaluated per child, not per group: some terms are reduced over the whole
+        # batch (eg: the gumbel entropy) and would be counted once per group member
+        mi = [reparam.mutual_info(dist) for reparam, dist in zip(self.reparameterizers, dists)]
+        return torch.stack(torch.broadcast_tensors(*mi), 0).sum(0)
 
 
     def kl(self, dists, priors=None):
@@ -102,41 +271,79 @@ class ConcatReparameterizer(nn.Module):
         priors = [None for _ in range(len(dists))] if priors is None else priors
         assert len(priors) == len(dists)
 
-        kl = None
-        for param, prior, reparam in zip(dists, priors, self.reparameterizers):
-            kl = reparam.kl(param, prior) if kl is None else kl + reparam.kl(param, prior)
+        kl = []
+        for group in self._groups:
+            leader = self.reparameterizers[group[0]]
+            kl_i = leader.kl(self._merge_params([dists[i] for i in group]),
+                             self._merge_params([priors[i] for i in group]))
+            kl.append(kl_i.view(len(group), -1).sum(0))
 
-        return kl
+        return torch.stack(kl, 0).sum(0)
 
-    def reparameterize(self, logits):
-        """ execute the reparameterization layer-by-layer returning ALL params and last reparam logits.
+    def reparameterize(self, logits, num_samples=None):
+        """ execute the reparameterization group-by-group returning ALL params (in child order).
 
         :param logits: the input logits
+        :param num_samples: if set returns [num_samples, B, D] samples
         :returns: concat reparam, list of params
         :rtype: torch.Tensor, list
 
+        """
+        params_list = [None for _ in self.reparameterizers]
+        reparameterized = [None for _ in self.reparameterizers]
+        for group, (reparameterized_g, params_g) in zip(self._groups, self._run_groups(logits, num_samples)):
+            for i, reparameterized_i, params_i in zip(group, reparameterized_g, params_g):
+                reparameterized[i] = reparameterized_i
+                params_list[i] = params_i
+
+        return torch.cat(reparameterized, -1), params_list
+
+    def inference(self, logits):
+        """ Deterministic, side-effect free reparameterization of every child.
+
+        :param logits: the input logits
+        :returns: concat reparam, list of (minimal) params
+        :rtype: torch.Tensor, list
+
         """
         params_list = []
         reparameterized = []
-
         for i, (begin, end) in enumerate(zip(self._input_sizing, self._input_sizing[1:])):
-            # print("reparaming from {} to {} for {}-th reparam which is a {} with shape {}".format(
-            #     begin, end, i, self.reparameterizers[i], logits[:, begin:end].shape))
-            reparameterized_i, params = self.reparameterizers[i](logits[:, begin:end])
+            reparameterized_i, params = self.reparameterizers[i].inference(logits[:, begin:end])
             reparameterized.append(reparameterized_i)
-            params_list.append({**params, 'logits': logits[:, begin:end]})
+            params_list.append(params)
 
         return torch.cat(reparameterized, -1), params_list
 
-    def forward(self, logits):
-        return self.reparameterize(logits)
+    def log_likelihood(self, z, params_list):
+        """ Log-likelihood of z under every child, reduced over the latent dim.
+
+        :param z: the concatenated latent z, [B, D] or [num_samples, B, D]
+        :param params_list: the list of params returned by reparameterize
+        :returns: log-likelihood of shape z.shape[0:-1]
+        :rtype: torch.Tensor
+
+        """
+        log_likelihood = []
+        z_list = torch.split(z, [int(r.output_size) for r in self.reparameterizers], dim=-1)
+        for z_i, params_i, reparam in zip(z_list, params_list, self.reparameterizers):
+            log_likelihood_i = reparam.log_likelihood(z_i, params_i)
+            if log_likelihood_i.dim() == z_i.dim():  # element-wise, eg: gaussian
+                log_likelihood_i = torch.sum(log_likelihood_i, -1)
+
+            log_likelihood.append(log_likelihood_i)
+
+        return torch.stack(log_likelihood, 0).sum(0)
+
+    def forward(self, logits, num_samples=None):
+        return self.reparameterize(logits, num_samples=num_samples)
 
     def prior(self, batch_size, **kwargs):
         """ Gen the first prior.
 
         :param batch_size: the batch size to generate
-        :returns: prior sample
+        :returns: prior sample, [num_samples, batch_size, D] if num_samples is passed
         :rtype: torch.Tensor
 
         """
-        return torch.cat([r.prior(batch_size) for r in self.reparameterizers], -1)
+        return torch.cat([r.prior(batch_size, **kwargs) for r in self.reparameterizers], -1)
@@ -0,0 +1,257 @@
+from __future__ import print_function
+import math
+import warnings
+import torch
+
+
+# Closed-form, element-wise KL-divergences and entropies used by the reparameterizers.
+# These replace constructing torch.distributions objects (and their argument
+# validation + broadcasting) on every call while matching their values / gradients.
+# NOTE: the gaussian functions take a scale, the reparameterizers pass their
+#       'logvar' param here exactly like they used to pass it to D.Normal.
+
+
+def _script(fn):
+    """ Use the TorchScript-ed (fused) version of fn when available.
+
+    :param fn: the function to script
+    :returns: scripted function or fn
+    :rtype: function
+
+    """
+    try:
+        with warnings.catch_warnings():  # newer torch versions deprecate scripting
+            warnings.simplefilter("ignore")
+            return torch.jit.script(fn)
+    except Exception:
+        return fn
+
+
+def _kl_normal_standard_normal(loc, scale):
+    var_ratio = scale.pow(2)
+    return 0.5 * (var_ratio + loc.pow(2) - 1 - var_ratio.log())
+
+
+def _kl_normal_normal(loc_p, scale_p, loc_q, scale_q):
+    var_ratio = (scale_p / scale_q).pow(2)
+    t1 = ((loc_p - loc_q) / scale_q).pow(2)
+    return 0.5 * (var_ratio + t1 - 1 - var_ratio.log())
+
+
+def _kl_categorical_uniform(log_q_z, log_p_z: float):
+    return log_q_z.exp() * (log_q_z - log_p_z)
+
+
+def _kl_categorical_categorical(logits_p, logits_q, dim: int = -1):
+    log_p = logits_p - torch.logsumexp(logits_p, dim=dim, keepdim=True)
+    log_q = logits_q - torch.logsumexp(logits_q, dim=dim, keepdim=True)
+    return torch.sum(log_p.exp() * (log_p - log_q), dim=dim)
+
+
+def _entropy_categorical(logits, dim: int = -1):
+    log_p = logits - torch.logsumexp(logits, dim=dim, keepdim=True)
+    log_p = torch.clamp(log_p, min=torch.finfo(log_p.dtype).min)
+    return -torch.sum(log_p * log_p.exp(), dim=dim)
+
+
+def _kl_bernoulli_uniform(q_z, eps: float = 1e-9):
+    log_half = math.log(0.5)
+    return q_z * (torch.log(q_z + eps) - log_half) \
+        + (1.0 - q_z) * (torch.log(1.0 - q_z + eps) - log_half)
+
+
+def _kl_bernoulli_bernoulli(q_z, p_z, eps: float = 1e-9):
+    return q_z * (torch.log(q_z + eps) - torch.log(p_z + eps)) \
+        + (1.0 - q_z) * (torch.log(1.0 - q_z + eps) - torch.log(1.0 - p_z + eps))
+
+
+def _kl_beta_beta(conc1_p, conc0_p, conc1_q, conc0_q):
+    sum_params_p = conc1_p + conc0_p
+    sum_params_q = conc1_q + conc0_q
+    t1 = torch.lgamma(conc1_q) + torch.lgamma(conc0_q) + torch.lgamma(sum_params_p)
+    t2 = torch.lgamma(conc1_p) + torch.lgamma(conc0_p) + torch.lgamma(sum_params_q)
+    t3 = (conc1_p - conc1_q) * torch.digamma(conc1_p)
+    t4 = (conc0_p - conc0_q) * torch.digamma(conc0_p)
+    t5 = (sum_params_q - sum_params_p) * torch.digamma(sum_params_p)
+    return t1 - t2 + t3 + t4 + t5
+
+
+def _kl_beta_symmetric_prior(conc1, conc0, prior_conc: float, prior_log_norm: float):
+    # prior_log_norm = 2 * lgamma(prior_conc) - lgamma(2 * prior_conc)
+    sum_params = conc1 + conc0
+    t2 = torch.lgamma(conc1) + torch.lgamma(conc0) - torch.lgamma(sum_params)
+    t3 = (conc1 - prior_conc) * torch.digamma(conc1)
+    t4 = (conc0 - prior_conc) * torch.digamma(conc0)
+    t5 = (2.0 * prior_conc - sum_params) * torch.digamma(sum_params)
+    return prior_log_norm - t2 + t3 + t4 + t5
+
+
+def _kl_kumaraswamy_beta(a, b, prior_alpha: float, prior_beta: float,
+                         prior_log_norm: float, num_terms: int):
+    # prior_log_norm = log B(prior_alpha, prior_beta), 0.5772... is the euler-mascheroni constant
+    ab = a * b
+    t1 = (a - prior_alpha) / a * (-0.5772156649015329 - torch.digamma(b) - 1.0 / b)
+    t2 = torch.log(ab) + prior_log_norm - (b - 1.0) / b
+    lgamma_b = torch.lgamma(b)
+    taylor = torch.zeros_like(a)
+    for m in range(1, num_terms + 1):
+        m_over_a = float(m) / a
+        beta_fn = torch.exp(torch.lgamma(m_over_a) + lgamma_b - torch.lgamma(m_over_a + b))
+        taylor = taylor + beta_fn / (float(m) + ab)
+
+    # remainder of the (slowly converging for small b) series: B(m/a, b) ~ Gamma(b) (m/a)^-b,
+    # so the terms behave as Gamma(b) a^b (m + ab/2)^-(1 + b), integrated from num_terms + 1/2
+    remainder = torch.exp(lgamma_b + b * torch.log(a)
+                          - b * torch.log(float(num_terms) + 0.5 + 0.5 * ab)) / b
+    return t1 + t2 + (prior_beta - 1.0) * b * (taylor + remainder)
+
+
+_kl_normal_standard_normal = _script(_kl_normal_standard_normal)
+_kl_normal_normal = _script(_kl_normal_normal)
+_kl_categorical_uniform = _script(_kl_categorical_uniform)
+_kl_categorical_categorical = _script(_kl_categorical_categorical)
+_entropy_categorical = _script(_entropy_categorical)
+_kl_bernoulli_uniform = _script(_kl_bernoulli_uniform)
+_kl_bernoulli_bernoulli = _script(_kl_bernoulli_bernoulli)
+_kl_beta_beta = _script(_kl_beta_beta)
+_kl_beta_symmetric_prior = _script(_kl_beta_symmetric_prior)
+_kl_kumaraswamy_beta = _script(_kl_kumaraswamy_beta)
+
+
+def kl_normal_standard_normal(loc, scale):
+    """ Element-wise KL(N(loc, scale) || N(0, 1))
+
+    :param loc: mean
+    :param scale: scale
+    :returns: element-wise kl-div
+    :rtype: torch.Tensor
+
+    """
+    return _kl_normal_standard_normal(loc, scale)
+
+
+def kl_normal_normal(loc_p, scale_p, loc_q, scale_q):
+    """ Element-wise KL(N(loc_p, scale_p) || N(loc_q, scale_q))
+
+    :param loc_p: mean of p
+    :param scale_p: scale of p
+    :param loc_q: mean of q
+    :param scale_q: scale of q
+    :returns: element-wise kl-div
+    :rtype: torch.Tensor
+
+    """
+    return _kl_normal_normal(loc_p, scale_p, loc_q, scale_q)
+
+
+def kl_categorical_uniform(log_q_z, dim=-1):
+    """ Element-wise KL(q || Cat(1/K)) given normalized log-probabilities.
+
+    :param log_q_z: normalized log-probabilities (log_softmax)
+    :param dim: the category dimension
+    :returns: element-wise kl-div, reduce over dim to get the KL
+    :rtype: torch.Tensor
+
+    """
+    return _kl_categorical_uniform(log_q_z, -math.log(log_q_z.size(dim)))
+
+
+def kl_categorical_categorical(logits_p, logits_q, dim=-1):
+    """ KL(Cat(logits_p) || Cat(logits_q)), reduced over dim.
+
+    :param logits_p: (un-normalized) logits of p
+    :param logits_q: (un-normalized) logits of q
+    :param dim: the category dimension
+    :returns: kl-div
+    :rtype: torch.Tensor
+
+    """
+    return _kl_categorical_categorical(logits_p, logits_q, dim)
+
+
+def entropy_categorical(logits, dim=-1):
+    """ Entropy of Cat(logits), reduced over dim.
+
+    :param logits: (un-normalized) logits
+    :param dim: the category dimension
+    :returns: entropy
+    :rtype: torch.Tensor
+
+    """
+    return _entropy_categorical(logits, dim)
+
+
+def kl_bernoulli_uniform(q_z, eps=1e-9):
+    """ Element-wise KL(Bern(q_z) || Bern(0.5))
+
+    :param q_z: probabilities of q
+    :param eps: tolerance
+    :returns: element-wise kl-div
+    :rtype: torch.Tensor
+
+    """
+    return _kl_bernoulli_uniform(q_z, eps)
+
+
+def kl_bernoulli_bernoulli(q_z, p_z, eps=1e-9):
+    """ Element-wise KL(Bern(q_z) || Bern(p_z))
+
+    :param q_z: probabilities of q
+    :param p_z: probabilities of p
+    :param eps: tolerance
+    :returns: element-wise kl-div
+    :rtype: torch.Tensor
+
+    """
+    return _kl_bernoulli_bernoulli(q_z, p_z, eps)
+
+
+def kl_beta_beta(conc1_p, conc0_p, conc1_q, conc0_q):
+    """ Element-wise KL(Beta(conc1_p, conc0_p) || Beta(conc1_q, conc0_q))
+
+    :param conc1_p: concentration 1 of p
+    :param conc0_p: concentration 0 of p
+    :param conc1_q: concentration 1 of q
+    :param conc0_q: concentration 0 of q
+    :returns: element-wise kl-div
+    :rtype: torch.Tensor
+
+    """
+    return _kl_beta_beta(conc1_p, conc0_p, conc1_q, conc0_q)
+
+
+def kl_beta_symmetric_prior(conc1, conc0, prior_conc=1/3):
+    """ Element-wise KL(Beta(conc1, conc0) || Beta(prior_conc, prior_conc)),
+        the prior normalizer is a constant so it is computed in python.
+
+    :param conc1: concentration 1
+    :param conc0: concentration 0
+    :param prior_conc: the prior concentration (1/3 is the Kerman prior)
+    :returns: element-wise kl-div
+    :rtype: torch.Tensor
+
+    """
+    prior_log_norm = 2 * math.lgamma(prior_conc) - math.lgamma(2 * prior_conc)
+    return _kl_beta_symmetric_prior(conc1, conc0, float(prior_conc), prior_log_norm)
+
+
+def kl_kumaraswamy_beta(a, b, prior_alpha=1/3, prior_beta=1/3, num_terms=20):
+    """ Element-wise KL(Kumaraswamy(a, b) || Beta(prior_alpha, prior_beta)),
+        the infinite series is truncated to num_terms plus an integral estimate
+        of the remainder (the series alone is badly biased for b < 1), see eqn. (12) of:
+
+        Nalisnick, E. & Smyth, P. (2017). Stick-Breaking Variational Autoencoders. ICLR.
+
+    :param a: kumaraswamy a
+    :param b: kumaraswamy b
+    :param prior_alpha: beta prior concentration 1
+    :param prior_beta: beta prior concentration 0
+    :param num_terms: number of terms of the taylor series to evaluate
+    :returns: element-wise kl-div
+    :rtype: torch.Tensor
+
+    """
+    prior_log_norm = math.lgamma(prior_alpha) + math.lgamma(prior_beta) \
+        - math.lgamma(prior_alpha + prior_beta)
+    return _kl_kumaraswamy_beta(a, b, float(prior_alpha), float(prior_beta),
+                                prior_log_norm, int(num_terms))
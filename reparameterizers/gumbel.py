@@ -8,9 +8,14 @@ import torch.distributions as D
 from torch.autograd import Variable
 
 from helpers.utils import float_type, one_hot, ones_like, long_type
+from .straight_through import straight_through_one_hot
+from .noise import get_noise_source
+from .divergences import kl_categorical_uniform, kl_categorical_categorical, entropy_categorical
 
 
 class GumbelSoftmax(nn.Module):
+    _num_instances = 0  # used to give each module its own RNG stream
+
     def __init__(self, config, dim=-1):
         """ Gumbel Softmax reparameterization of Categorical distribution.
 
@@ -28,21 +33,38 @@ class GumbelSoftmax(nn.Module):
         self.input_size = self.config['discrete_size']
         self.output_size = self.config['discrete_size']
 
+        # dedicated noise RNG stream per module and a re-usable noise buffer
+        self._noise_seed = None if self.config.get('seed', None) is None \
+            else self.config['seed'] + GumbelSoftmax._num_instances
+        self._noise_generators = {}
+        self._noise_buffer = None
+        self.noise_source = get_noise_source(self.config.get('noise_source', 'iid'))
+        GumbelSoftmax._num_instances += 1
+
+        # exact marginalization over all categories: never, auto or always
+        self.enumeration = self.config.get('discrete_enumeration', 'never')
+        self.max_enumeration_batch = self.config.get('max_enumeration_batch', 8192)
+        assert self.enumeration in ['never', 'auto', 'always']
+
     def prior(self, batch_size, **kwargs):
         """ Sample the prior for batch_size samples.
 
         :param batch_size: number of prior samples.
-        :returns: prior
+        :returns: prior, [num_samples, batch_size, D] if num_samples is passed
         :rtype: torch.Tensor
 
         """
+        num_samples = kwargs.get('num_samples', None)
+        sample_shape = (batch_size,) if num_samples is None else (num_samples * batch_size,)
         uniform_probs = float_type(self.config['cuda'])(1, self.output_size).zero_()
         uniform_probs += 1.0 / self.output_size
         cat = torch.distributions.Categorical(uniform_probs)
-        sample = cat.sample((batch_size,))
-        return Variable(
+        sample = cat.sample(sample_shape)
+        sample = Variable(
             one_hot(self.output_size, sample, use_cuda=self.config['cuda'])
         ).type(float_type(self.config['cuda']))
+        return sample if num_samples is None \
+            else sample.view(num_samples, batch_size, self.output_size)
 
     def get_reparameterizer_scalars(self):
         """ Returns any scalars used in reparameterization.
@@ -84,21 +106,24 @@ class GumbelSoftmax(nn.Module):
             # hard annealing
             # self.tau = np.maximum(0.9 * self.tau, self.min_temp)
 
-    def reparmeterize(self, logits):
+    def reparmeterize(self, logits, num_samples=None):
         """ Given logits reparameterize to a categorical
 
         :param logits: unactivated logits
+        :param num_samples: number of samples per logit row (None for a single sample)
         :returns: reparameterized tensor (if training), hard version, soft version.
         :rtype: torch.Tensor, torch.Tensor, torch.Tensor
 
         """
-        logits_shp = logits.size()
         log_q_z = F.log_softmax(logits, dim=self.dim)
-        z, z_hard = self.sample_gumbel(logits, self.tau,
+        sample_logits = logits if num_samples is None \
+            else logits.expand(num_samples, *logits.size())
+        z, z_hard = self.sample_gumbel(sample_logits, self.tau,
                                        hard=True,
                                        dim=self.dim,
-                                       use_cuda=logits.is_cuda)
-        return z.view(logits_shp), z_hard.view(logits_shp), log_q_z
+                                       use_cuda=logits.is_cuda,
+                                       noise=self._gumbel_noise(sample_logits, num_samples=num_samples))
+        return z.view_as(sample_logits), z_hard.view_as(sample_logits), log_q_z
 
     def mutual_info_analytic(self, params, eps=1e-9):
         """ I(z_d; x) ~ H(z_prior, z_d) + H(z_prior), i.e. analytic version.
@@ -112,7 +137,7 @@ class GumbelSoftmax(nn.Module):
         targets = torch.argmax(params['discrete']['z_hard'].type(long_type(self.config['cuda'])), dim=-1)
         crossent_loss = -F.cross_entropy(input=params['q_z_given_xhat']['discrete']['logits'],
                                          target=targets, reduce=False)
-        ent_loss = -torch.sum(D.OneHotCategorical(logits=params['discrete']['z_hard']).entropy(), -1)
+        ent_loss = -torch.sum(entropy_categorical(params['discrete']['z_hard']), -1)
         return ent_loss + crossent_loss
 
     def mutual_info_monte_carlo(self, params, eps=1e-9):
@@ -149,7 +174,7 @@ class GumbelSoftmax(nn.Module):
         # targets = torch.argmax(params['discrete']['log_q_z'], -1) # 3rd change, havent tried
         crossent_loss = -F.cross_entropy(input=params['q_z_given_xhat']['discrete']['logits'],
                                          target=targets, reduce=False)
-        ent_loss = -torch.sum(D.OneHotCategorical(logits=params['discrete']['z_hard']).entropy(), -1)
+        ent_loss = -torch.sum(entropy_categorical(params['discrete']['z_hard']), -1)
         return self.config['discrete_mut_info'] * (ent_loss + crossent_loss)
 
     @staticmethod
@@ -163,11 +188,7 @@ class GumbelSoftmax(nn.Module):
         :rtype: torch.Tensor
 
         """
-        shp = log_q_z.size()
-        p_z = 1.0 / shp[dim]
-        log_p_z = np.log(p_z)
-        kld_element = log_q_z.exp() * (log_q_z - log_p_z)
-        return kld_element
+        return kl_categorical_uniform(log_q_z, dim=dim)
 
     def kl(self, dist_a, prior=None):
         """ KL divergence of dist_a against a prior, if none then Cat(1/k)
@@ -184,38 +205,94 @@ class GumbelSoftmax(nn.Module):
             ), -1)
 
         # we have two distributions provided (eg: VRNN)
-        return D.kl_divergence(
-            D.OneHotCategorical(logits=dist_a['discrete']['log_q_z']),
-            D.OneHotCategorical(prior['discrete']['log_q_z'])
-        )
+        return kl_categorical_categorical(dist_a['discrete']['log_q_z'],
+                                          prior['discrete']['log_q_z'],
+                                          dim=self.dim)
+
+
+    def __getstate__(self):
+        """ Drops the (unpicklable) RNG streams and the noise buffer so that the module
+            can be deep-copied / pickled, both are lazily re-created on the next draw.
+
+        :returns: the state dict of the module object
+        :rtype: dict
+
+        """
+        state = self.__dict__.copy()
+        state['_noise_generators'] = {}
+        state['_noise_buffer'] = None
+        return state
+
+    def _noise_generator(self, device):
+        """ Returns (lazily creating) this module's RNG stream for device.
+
+        :param device: the torch.device to sample on
+        :returns: the generator
+        :rtype: torch.Generator
+
+        """
+        key = str(device)
+        if key not in self._noise_generators:
+            generator = torch.Generator(device=device)
+            if self._noise_seed is None:
+                generator.seed()
+            else:
+                generator.manual_seed(self._noise_seed)
+
+            self._noise_generators[key] = generator
+
+        return self._noise_generators[key]
+
+    def _gumbel_noise(self, x, eps=1e-9, num_samples=None):
+        """ Samples gumbel noise -ln(-ln(U + eps) + eps) directly on x's device and dtype
+            into a re-usable buffer. The buffer is safe to overwrite on the next call
+            as the (x + noise) op does not save its operands for backward.
+            In eval mode a fresh tensor is used so concurrent callers never share it.
+
+        :param x: the tensor whose size, device and dtype to match
+        :param eps: tolerance
+        :param num_samples: number of samples along the leading dim (None for a single sample)
+        :returns: gumbel noise of x.size()
+        :rtype: torch.Tensor
+
+        """
+        noise = None
+        if self.training:
+            if self._noise_buffer is None \
+               or self._noise_buffer.size() != x.size() \
+               or self._noise_buffer.device != x.device \
+               or self._noise_buffer.dtype != x.dtype:
+                self._noise_buffer = torch.empty(x.size(), device=x.device, dtype=x.dtype)
+
+            noise = self._noise_buffer
 
+        noise = self.noise_source.uniform(x.size(), x.device, x.dtype,
+                                          generator=self._noise_generator(x.device), out=noise,
+                                          num_samples=num_samples)
+        return noise.add_(eps).log_().neg_().add_(eps).log_().neg_()
 
     @staticmethod
-    def _gumbel_softmax(x, tau, eps=1e-9, dim=-1, use_cuda=False):
+    def _gumbel_softmax(x, tau, eps=1e-9, dim=-1, use_cuda=False, noise=None):
         """ Internal gumbel softmax call using temp tau: -ln(-ln(U + eps) + eps)
 
         :param x: input tensor
         :param tau: temperature
         :param eps: toleranace
         :param dim: dimension to operate over
-        :param use_cuda: whether or not to use cuda
+        :param use_cuda: unused, noise is generated on x's device
+        :param noise: pre-sampled gumbel noise (sampled here if None)
         :returns: gumbel annealed tensor
         :rtype: torch.Tensor
 
         """
-        noise = torch.rand(x.size())
-        noise.add_(eps).log_().neg_()
-        noise.add_(eps).log_().neg_()
-        if use_cuda:
-            noise = noise.cuda()
+        if noise is None:
+            noise = torch.empty(x.size(), device=x.device, dtype=x.dtype).uniform_()
+            noise.add_(eps).log_().neg_().add_(eps).log_().neg_()
 
-        noise = Variable(noise)
-        x = (x + noise) / tau
-        x = F.softmax(x + eps, dim=dim)
-        return x.view_as(x)
+        return F.softmax((x + noise) / tau, dim=dim)
 
     @staticmethod
-    def sample_gumbel(x, tau, hard=False, dim=-1, use_cuda=False):
+    def sample_gumbel(x, tau, hard=False, dim=-1, use_cuda=False, noise=None):
         """ Sample from the gumbel distribution and return hard and soft versions.
 
         :param x: the input tensor
@@ -223,19 +300,15 @@ class GumbelSoftmax(nn.Module):
         :param hard: whether to generate hard version (argmax)
         :param dim: dimension to operate over
         :param use_cuda: whether or not to use cuda
+        :param noise: pre-sampled gumbel noise (sampled here if None)
         :returns: soft, hard or soft, None
         :rtype: torch.Tensor, Optional(torch.Tensor, None)
 
         """
-        y = GumbelSoftmax._gumbel_softmax(x, tau, dim=dim, use_cuda=use_cuda)
-
-        if hard:
-            y_max, _ = torch.max(y, dim=dim, keepdim=True)
-            y_hard = Variable(
-                torch.eq(y_max.data, y.data).type(float_type(use_cuda))
-            )
-            y_hard_diff = y_hard - y
-            y_hard = y_hard_diff.detach() + y
+        y = GumbelSoftmax._gumbel_softmax(x, tau, dim=dim, use_cuda=use_cuda, noise=noise)
+
+        if hard:  # exact one-hot with straight-through gradients
+            y_hard = straight_through_one_hot(y, dim=dim)
             return y.view_as(x), y_hard.view_as(x)
 
         return y.view_as(x), None
@@ -243,31 +316,95 @@ class GumbelSoftmax(nn.Module):
     def log_likelihood(self, z, params):
         """ Log-likelihood of z induced under params.
 
-        :param z: inferred latent z
+        :param z: inferred latent z (indices or one-hot / relaxed samples), optionally [num_samples, B, ...]
         :param params: the params of the distribution
-        :returns: log-likelihood
+        :returns: log-likelihood, broadcast over the sample dim
         :rtype: torch.Tensor
 
         """
+        if z.is_floating_point():  # one-hot, grab indices
+            z = torch.argmax(z, dim=-1)
+
         return D.Categorical(logits=params['discrete']['logits']).log_prob(z)
 
-    def forward(self, logits):
+    def inference(self, logits):
+        """ Deterministic, side-effect free reparameterization: returns the one-hot
+            argmax of the logits, draws no noise and does not anneal / step the iteration.
+
+        :param logits: unactivated logits.
+        :returns: one-hot tensor and (minimal) params, enough for the kl.
+        :rtype: torch.Tensor, dict
+
+        """
+        index = torch.argmax(logits, dim=self.dim, keepdim=True)
+        z_hard = torch.zeros_like(logits).scatter_(self.dim, index, 1.0)
+        return z_hard, { 'z': z_hard, 'discrete': {'z_hard': z_hard, 'logits': logits,
+                                                   'log_q_z': F.log_softmax(logits, dim=self.dim)} }
+
+    def should_enumerate(self, batch_size):
+        """ Whether to enumerate (rather than sample) the categories for a batch.
+            Only used in training and never with the (sample based) mutual info;
+            auto enumerates small K as long as the K-times wider batch stays bounded.
+
+        :param batch_size: the batch size
+        :returns: True/False
+        :rtype: bool
+
+        """
+        if not self.training or self.enumeration == 'never' \
+           or self.config.get('discrete_mut_info', 0) > 0:
+            return False
+
+        if self.enumeration == 'always':
+            return True
+
+        return self.output_size <= 32 \
+            and self.output_size * batch_size <= self.max_enumeration_batch
+
+    def enumerate(self, logits):
+        """ Returns every one-hot code (instead of a sample) along with the params,
+            the caller decodes all codes and weights them by softmax(logits).
+
+        :param logits: unactivated [B, K] logits.
+        :returns: [K, B, K] one-hot codes and params (with 'enumerated' set).
+        :rtype: torch.Tensor, dict
+
+        """
+        self.anneal()  # keep the annealing schedule in sync with the sampling path
+        num_categories, batch_size = logits.size(-1), logits.size(0)
+        codes = torch.eye(num_categories, device=logits.device, dtype=logits.dtype)
+        codes = codes.unsqueeze(1).expand(num_categories, batch_size, num_categories)
+        params = {
+            'z_hard': codes,
+            'logits': logits,
+            'log_q_z': F.log_softmax(logits, dim=self.dim),
+            'tau_scalar': self.tau,
+            'enumerated': True
+        }
+        if self.training:
+            self.iteration += 1
+
+        return codes, { 'z': codes, 'discrete': params }
+
+    def forward(self, logits, num_samples=None):
         """ Returns a reparameterized categorical and it's params.
 
         :param logits: unactivated logits.
+        :param num_samples: if set returns [num_samples, B, D] samples (annealing steps once).
         :returns: reparam tensor and params.
         :rtype: torch.Tensor, dict
 
         """
         self.anneal()  # anneal first
-        z, z_hard, log_q_z = self.reparmeterize(logits)
+        z, z_hard, log_q_z = self.reparmeterize(logits, num_samples=num_samples)
         params = {
             'z_hard': z_hard,
             'logits': logits,
             'log_q_z': log_q_z,
             'tau_scalar': self.tau
         }
-        self.iteration += 1
+        if self.training:  # annealing is frozen outside of training
+            self.iteration += 1
 
         if self.training:
             # return the reparameterization
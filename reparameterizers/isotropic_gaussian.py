@@ -6,9 +6,11 @@ import torch.distributions as D
 import torch.nn.functional as F
 from torch.autograd import Variable
 
-from helpers.utils import zeros_like, ones_like, same_type, \
-    float_type, nan_check_and_break, is_half
+from helpers.utils import same_type, \
+    float_type, nan_check_and_break
 from helpers.utils import eps as eps_fn
+from .divergences import kl_normal_standard_normal, kl_normal_normal
+from .noise import get_noise_source
 
 
 class IsotropicGaussian(nn.Module):
@@ -26,46 +28,54 @@ class IsotropicGaussian(nn.Module):
         assert self.config['continuous_size'] % 2 == 0
         self.output_size = self.config['continuous_size'] // 2
 
+        # the base noise for eps, eg: iid, antithetic, sobol or crn
+        self.noise_source = get_noise_source(self.config.get('noise_source', 'iid'))
+
     def prior(self, batch_size, **kwargs):
         """ Sample the prior for batch_size samples.
 
         :param batch_size: number of prior samples.
-        :returns: prior
+        :returns: prior, [num_samples, batch_size, D] if num_samples is passed
         :rtype: torch.Tensor
 
         """
         scale_var = 1.0 if 'scale_var' not in kwargs else kwargs['scale_var']
+        num_samples = kwargs.get('num_samples', None)
+        shp = [batch_size, self.output_size] if num_samples is None \
+            else [num_samples, batch_size, self.output_size]
         return Variable(
             same_type(self.config['half'], self.config['cuda'])(
-                batch_size, self.output_size
+                *shp
             ).normal_(mean=0, std=scale_var)
         )
 
-    def _reparametrize_gaussian(self, mu, logvar):
+    def _reparametrize_gaussian(self, mu, logvar, num_samples=None):
         """ Internal member to reparametrize gaussian.
 
         :param mu: mean logits
         :param logvar: log-variance.
+        :param num_samples: draw [num_samples, *mu.shape] samples from one noise draw
         :returns: reparameterized tensor and param dict
         :rtype: torch.Tensor, dict
 
         """
+        sample_shape = [] if num_samples is None else [num_samples]
         if self.training: # returns a stochastic sample for training
             std = logvar.mul(0.5).exp()
-            eps = same_type(is_half(logvar), logvar.is_cuda)(
-                logvar.size()
-            ).normal_()
-            eps = Variable(eps)
+            eps = self.noise_source.normal(sample_shape + list(logvar.size()),
+                                           logvar.device, logvar.dtype, num_samples=num_samples)
             nan_check_and_break(logvar, "logvar")
             return eps.mul(std).add_(mu), {'mu': mu, 'logvar': logvar}
 
-        return mu, {'mu': mu, 'logvar': logvar}
+        z = mu if num_samples is None else mu.expand(num_samples, *mu.size())
+        return z, {'mu': mu, 'logvar': logvar}
 
-    def reparmeterize(self, logits):
+    def reparmeterize(self, logits, num_samples=None):
         """ Given logits reparameterize to a gaussian using
             first half of features for mean and second half for std.
 
         :param logits: unactivated logits
+        :param num_samples: number of samples per logit row (None for a single [B, D] sample)
         :returns: reparameterized tensor (if training), param dict
         :rtype: torch.Tensor, dict
 
@@ -85,7 +95,7 @@ class IsotropicGaussian(nn.Module):
         else:
             raise Exception("unknown number of dims for isotropic gauss reparam")
 
-        return self._reparametrize_gaussian(mu, sigma)
+        return self._reparametrize_gaussian(mu, sigma, num_samples=num_samples)
 
     def get_reparameterizer_scalars(self):
         """ Returns any scalars used in reparameterization.
@@ -105,11 +115,10 @@ class IsotropicGaussian(nn.Module):
         :rtype: torch.Tensor
 
         """
-        z_true = D.Normal(params['gaussian']['mu'],
-                          params['gaussian']['logvar'])
-        z_match = D.Normal(params['q_z_given_xhat']['gaussian']['mu'],
-                           params['q_z_given_xhat']['gaussian']['logvar'])
-        kl_proxy_to_xent = torch.sum(D.kl_divergence(z_match, z_true), dim=-1)
+        kl_proxy_to_xent = torch.sum(kl_normal_normal(
+            params['q_z_given_xhat']['gaussian']['mu'], params['q_z_given_xhat']['gaussian']['logvar'],
+            params['gaussian']['mu'], params['gaussian']['logvar']
+        ), dim=-1)
         return self.config['continuous_mut_info'] * kl_proxy_to_xent
 
     @staticmethod
@@ -122,9 +131,7 @@ class IsotropicGaussian(nn.Module):
         :rtype: torch.Tensor
 
         """
-        standard_normal = D.Normal(zeros_like(mu), ones_like(logvar))
-        normal = D.Normal(mu, logvar)
-        return torch.sum(D.kl_divergence(normal, standard_normal), -1)
+        return torch.sum(kl_normal_standard_normal(mu, logvar), -1)
 
     def kl(self, dist_a, prior=None):
         """ KL divergence of dist_a against a prior, if none then N(0, 1)
@@ -141,11 +148,27 @@ class IsotropicGaussian(nn.Module):
             )
 
         # we have two distributions provided (eg: VRNN)
-        return torch.sum(D.kl_divergence(
-            D.Normal(dist_a['gaussian']['mu'], dist_a['gaussian']['logvar']),
-            D.Normal(prior['gaussian']['mu'], prior['gaussian']['logvar'])
+        return torch.sum(kl_normal_normal(
+            dist_a['gaussian']['mu'], dist_a['gaussian']['logvar'],
+            prior['gaussian']['mu'], prior['gaussian']['logvar']
         ), -1)
 
+    @staticmethod
+    def sampled_scale_params(params):
+        """ Returns params whose 'logvar' holds the std, exp(logvar / 2), used by the sampler:
+            log_likelihood (like the KLs) reads the 'logvar' entry as the scale.
+
+        :param params: the params of the distribution (eg: of a mixture)
+        :returns: params with the gaussian scale replaced
+        :rtype: dict
+
+        """
+        if 'gaussian' not in params:
+            return params
+
+        gaussian = dict(params['gaussian'], logvar=params['gaussian']['logvar'].mul(0.5).exp())
+        return dict(params, gaussian=gaussian)
+
     def log_likelihood(self, z, params):
         """ Log-likelihood of z induced under params.
 
@@ -158,15 +181,29 @@ class IsotropicGaussian(nn.Module):
         return D.Normal(params['gaussian']['mu'],
                         params['gaussian']['logvar']).log_prob(z)
 
-    def forward(self, logits):
+    def inference(self, logits):
+        """ Deterministic, side-effect free reparameterization: returns mu
+            (a view of the logits) and skips the noise and mean statistics.
+
+        :param logits: unactivated logits.
+        :returns: mu and (minimal) params.
+        :rtype: torch.Tensor, dict
+
+        """
+        mu = logits[..., 0:self.output_size]
+        logvar = logits[..., self.output_size:]
+        return mu, { 'z': mu, 'logits': logits, 'gaussian': {'mu': mu, 'logvar': logvar} }
+
+    def forward(self, logits, num_samples=None):
         """ Returns a reparameterized gaussian and it's params.
 
         :param logits: unactivated logits.
+        :param num_samples: if set returns [num_samples, B, D] samples.
         :returns: reparam tensor and params.
         :rtype: torch.Tensor, dict
 
         """
-        z, gauss_params = self.reparmeterize(logits)
+        z, gauss_params = self.reparmeterize(logits, num_samples=num_samples)
         gauss_params['mu_mean'] = torch.mean(gauss_params['mu'])
         gauss_params['logvar_mean'] = torch.mean(gauss_params['logvar'])
         return z, { 'z': z, 'logits': logits, 'gaussian':  gauss_params }
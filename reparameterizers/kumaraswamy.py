@@ -0,0 +1,242 @@
+# coding: utf-8
+
+from __future__ import print_function
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.distributions as D
+
+from helpers.utils import same_type
+from helpers.utils import eps as eps_fn
+from .divergences import kl_kumaraswamy_beta
+from .noise import get_noise_source
+
+
+class Kumaraswamy(nn.Module):
+    def __init__(self, config):
+        """ Kumaraswamy distribution: a drop-in, fast alternative to Beta.
+            Samples are drawn with the closed-form inverse-CDF (no rejection
+            sampling / implicit gradients) and the KL to the Kerman Beta prior
+            uses the (remainder corrected) series of Nalisnick & Smyth (2017).
+
+        :param config: argparse
+        :returns: Kumaraswamy module
+        :rtype: nn.Module
+
+        """
+        super(Kumaraswamy, self).__init__()
+        self.config = config
+        self.input_size = self.config['continuous_size']
+        assert self.config['continuous_size'] % 2 == 0
+        self.output_size = self.config['continuous_size'] // 2
+
+        # the Kerman prior, Beta(1/3, 1/3), and the number of terms of the KL series
+        self.prior_concentration = 1/3
+        self.num_kl_terms = self.config.get('kumaraswamy_kl_terms', 20)
+        self._prior_dists = {}  # device --> scalar beta, built once and re-used
+        self.noise_source = get_noise_source(self.config.get('noise_source', 'iid'))
+
+    def _prior_dist(self, device):
+        """ Returns the (cached) scalar Beta prior for the device.
+
+        :param device: the torch device
+        :returns: the prior distribution
+        :rtype: torch.distributions.Beta
+
+        """
+        if device not in self._prior_dists:
+            conc = torch.tensor(self.prior_concentration, device=device)
+            self._prior_dists[device] = D.Beta(conc, conc, validate_args=False)
+
+        return self._prior_dists[device]
+
+    def prior(self, batch_size, **kwargs):
+        """ Returns samples from the Kerman beta prior.
+
+        Kerman, J. (2011). Neutral noninformative and informative
+        conjugate beta and gamma prior distributions. Electronic
+        Journal of Statistics, 5, 1450-1470.
+
+        :param batch_size: the number of prior samples
+        :returns: prior, [num_samples, batch_size, D] if num_samples is passed
+        :rtype: torch.Tensor
+
+        """
+        num_samples = kwargs.get('num_samples', None)
+        sample_shape = (batch_size, self.output_size) if num_samples is None \
+            else (num_samples, batch_size, self.output_size)
+        device = torch.device('cuda') if self.config['cuda'] else torch.device('cpu')
+        prior = self._prior_dist(device).sample(sample_shape)
+        return prior.type(same_type(self.config['half'], self.config['cuda']))
+
+    def _activate(self, logits):
+        """ Internal helper to split + activate the logits into (a, b).
+            Softplus is used (rather than the sigmoid in Beta) as a, b << 1
+            leads to a degenerate inverse-CDF and a slowly converging KL series.
+
+        :param logits: unactivated logits
+        :returns: a, b
+        :rtype: torch.Tensor, torch.Tensor
+
+        """
+        eps = eps_fn(self.config['half'])
+        feature_size = logits.size(-1)
+        assert feature_size % 2 == 0 and feature_size // 2 == self.output_size
+        a = F.softplus(logits[..., 0:self.output_size]) + eps
+        b = F.softplus(logits[..., self.output_size:]) + eps
+        return a, b
+
+    def _inverse_cdf(self, a, b, u):
+        """ Inverse CDF: x = (1 - (1 - u)^(1/b))^(1/a), evaluated in log-space.
+
+        :param a: kumaraswamy a
+        :param b: kumaraswamy b
+        :param u: uniform samples in (0, 1)
+        :returns: kumaraswamy samples
+        :rtype: torch.Tensor
+
+        """
+        eps = eps_fn(self.config['half'])
+        log_one_minus_x_pow_a = torch.log1p(-u) / b
+        x = torch.exp(torch.log(-torch.expm1(log_one_minus_x_pow_a)) / a)
+        return torch.clamp(x, eps, 1.0 - eps)
+
+    def _reparametrize_kumaraswamy(self, a, b, num_samples=None):
+        """ Internal function to reparameterize a kumaraswamy using the inverse-CDF.
+
+        :param a: kumaraswamy a
+        :param b: kumaraswamy b
+        :param num_samples: draw [num_samples, *a.shape] samples
+        :returns: reparameterized sample, distribution params
+        :rtype: torch.Tensor, dict
+
+        """
+        eps = eps_fn(self.config['half'])
+        sample_shape = a.shape if num_samples is None else (num_samples, *a.shape)
+        u = self.noise_source.uniform(sample_shape, a.device, a.dtype,
+                                      num_samples=num_samples).clamp_(eps, 1.0 - eps)
+        z = self._inverse_cdf(a, b, u)
+        if not self.training:  # no gradients in eval, unlike Beta the sample stays stochastic
+            z = z.detach()
+
+        return z, {'a': a, 'b': b}
+
+    def reparmeterize(self, logits, num_samples=None):
+        """ Given logits reparameterize to a kumaraswamy using
+            first half of features for a and second half for b.
+
+        :param logits: unactivated logits
+        :param num_samples: number of samples per logit row (None for a single sample)
+        :returns: reparameterized tensor, param dict
+        :rtype: torch.Tensor, dict
+
+        """
+        if logits.dim() not in [2, 3]:
+            raise Exception("unknown number of dims for kumaraswamy reparam")
+
+        a, b = self._activate(logits)
+        return self._reparametrize_kumaraswamy(a, b, num_samples=num_samples)
+
+    def _log_prob(self, z, a, b):
+        """ log p(z) = log a + log b + (a - 1) log z + (b - 1) log(1 - z^a)
+
+        :param z: the samples
+        :param a: kumaraswamy a
+        :param b: kumaraswamy b
+        :returns: element-wise log-likelihood
+        :rtype: torch.Tensor
+
+        """
+        eps = eps_fn(self.config['half'])
+        z = torch.clamp(z, eps, 1.0 - eps)
+        log_z = torch.log(z)
+        return torch.log(a) + torch.log(b) + (a - 1) * log_z \
+            + (b - 1) * torch.log(-torch.expm1(a * log_z))
+
+    def _mc_kld(self, params_q, params_p):
+        """ Single sample KL(q || p) between two kumaraswamys (no closed form exists).
+
+        :param params_q: the kumaraswamy params of q
+        :param params_p: the kumaraswamy params of p
+        :returns: batch_size tensor of kld
+        :rtype: torch.Tensor
+
+        """
+        z, _ = self._reparametrize_kumaraswamy(params_q['a'], params_q['b'])
+        return torch.sum(self._log_prob(z, params_q['a'], params_q['b'])
+                         - self._log_prob(z, params_p['a'], params_p['b']), -1)
+
+    def _kld_kumaraswamy_kerman_prior(self, a, b):
+        """ Internal function to do a KL-div against the prior.
+
+        :param a: kumaraswamy a
+        :param b: kumaraswamy b
+        :returns: batch_size tensor of kld against prior.
+        :rtype: torch.Tensor
+
+        """
+        return torch.sum(kl_kumaraswamy_beta(
+            a, b, prior_alpha=self.prior_concentration,
+            prior_beta=self.prior_concentration,
+            num_terms=self.num_kl_terms
+        ), -1)
+
+    def kl(self, dist_a, prior=None):
+        if prior == None:  # use standard reparamterizer
+            return self._kld_kumaraswamy_kerman_prior(
+                dist_a['kumaraswamy']['a'], dist_a['kumaraswamy']['b']
+            )
+
+        # we have two distributions provided (eg: VRNN)
+        return self._mc_kld(dist_a['kumaraswamy'], prior['kumaraswamy'])
+
+    def mutual_info(self, params, eps=1e-9):
+        """ I(z_d; x) ~ H(z_prior, z_d) + H(z_prior)
+
+        :param params: parameters of distribution
+        :param eps: tolerance
+        :returns: batch_size mutual information (prop-to) tensor.
+        :rtype: torch.Tensor
+
+        """
+        kl_proxy_to_xent = self._mc_kld(params['q_z_given_xhat']['kumaraswamy'],
+                                        params['kumaraswamy'])
+        return self.config['continuous_mut_info'] * kl_proxy_to_xent
+
+    def log_likelihood(self, z, params):
+        """ Log-likelihood of z induced under params.
+
+        :param z: inferred latent z
+        :param params: the params of the distribution
+        :returns: log-likelihood
+        :rtype: torch.Tensor
+
+        """
+        return self._log_prob(z, params['kumaraswamy']['a'], params['kumaraswamy']['b'])
+
+    def inference(self, logits):
+        """ Deterministic, side-effect free reparameterization using the
+            closed-form median (1 - 2^(-1/b))^(1/a).
+
+        :param logits: unactivated logits.
+        :returns: median tensor and (minimal) params.
+        :rtype: torch.Tensor, dict
+
+        """
+        a, b = self._activate(logits)
+        z = self._inverse_cdf(a, b, torch.full_like(a, 0.5))
+        return z, { 'z': z, 'logits': logits, 'kumaraswamy': {'a': a, 'b': b} }
+
+    def forward(self, logits, num_samples=None):
+        """ Returns a reparameterized kumaraswamy and it's params.
+
+        :param logits: unactivated logits.
+        :param num_samples: if set returns [num_samples, B, D] samples.
+        :returns: reparam tensor and params.
+        :rtype: torch.Tensor, dict
+
+        """
+        z, kumaraswamy_params = self.reparmeterize(logits, num_samples=num_samples)
+        kumaraswamy_params['a_mean'] = torch.mean(kumaraswamy_params['a'])
+        kumaraswamy_params['b_mean'] = torch.mean(kumaraswamy_params['b'])
+        return z, { 'z': z, 'logits': logits, 'kumaraswamy': kumaraswamy_params }
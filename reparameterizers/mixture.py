@@ -10,13 +10,14 @@ from torch.autograd import Variable
 
 from helpers.utils import float_type, ones_like
 from .beta import Beta
+from .kumaraswamy import Kumaraswamy
 from .gumbel import GumbelSoftmax
 from .isotropic_gaussian import IsotropicGaussian
 
 
 class Mixture(nn.Module):
     ''' continuous + discrete reparaterization '''
-    def __init__(self, num_discrete, num_continuous, config, is_beta=False):
+    def __init__(self, num_discrete, num_continuous, config, is_beta=False, use_kumaraswamy=False):
         super(Mixture, self).__init__()
         warnings.warn("\n\nMixture is depricated, use concat_reparam or sequential_reparam.\n")
         self.config = config
@@ -25,7 +26,14 @@ class Mixture(nn.Module):
         self.num_continuous_input = num_continuous
 
         # setup the continuous & discrete reparameterizer
-        self.continuous = IsotropicGaussian(config) if not is_beta else Beta(config)
+        # is_beta + use_kumaraswamy swaps the beta for its fast kumaraswamy approximation
+        if not is_beta:
+            self.continuous, self.continuous_key = IsotropicGaussian(config), 'gaussian'
+        elif use_kumaraswamy:
+            self.continuous, self.continuous_key = Kumaraswamy(config), 'kumaraswamy'
+        else:
+            self.continuous, self.continuous_key = Beta(config), 'beta'
+
         self.discrete = GumbelSoftmax(config)
 
         self.input_size = num_continuous + num_discrete
@@ -43,7 +51,7 @@ class Mixture(nn.Module):
     def prior(self, batch_size, **kwargs):
         disc = self.discrete.prior(batch_size, **kwargs)
         cont = self.continuous.prior(batch_size, **kwargs)
-        return torch.cat([cont, disc], 1)
+        return torch.cat([cont, disc], -1)
 
     def mutual_info(self, params):
         dinfo = self.discrete.mutual_info(params)
@@ -51,22 +59,40 @@ class Mixture(nn.Module):
         return dinfo - cinfo
 
     def log_likelihood(self, z, params):
-        cont = self.continuous.log_likelihood(z[:, 0:self.continuous.output_size], params)
-        disc = self.discrete.log_likelihood(z[:, self.continuous.output_size:], params)
-        return torch.cat([cont, disc], 1)
+        cont = self.continuous.log_likelihood(z[..., 0:self.continuous.output_size], params)
+        disc = self.discrete.log_likelihood(z[..., self.continuous.output_size:], params)
+        return torch.cat([cont, disc.unsqueeze(-1)], -1)
 
-    def reparmeterize(self, logits):
+    def reparmeterize(self, logits, num_samples=None):
         continuous_logits = logits[:, 0:self.num_continuous_input]
         discrete_logits = logits[:, self.num_continuous_input:]
 
-        continuous_reparam, continuous_params = self.continuous(continuous_logits)
-        discrete_reparam, disc_params = self.discrete(discrete_logits)
+        continuous_reparam, continuous_params = self.continuous(continuous_logits, num_samples=num_samples)
+        discrete_reparam, disc_params = self.discrete(discrete_logits, num_samples=num_samples)
+        merged = torch.cat([continuous_reparam, discrete_reparam], -1)
+
+        # use a separate key for gaussian, beta or kumaraswamy
+        params = {self.continuous_key: continuous_params[self.continuous_key],
+                  'discrete': disc_params['discrete'],
+                  'logits': logits,
+                  'z': merged}
+        return merged, params
+
+    def inference(self, logits):
+        """ Deterministic, side-effect free reparameterization of both halves.
+
+        :param logits: unactivated logits.
+        :returns: merged tensor and (minimal) params.
+        :rtype: torch.Tensor, dict
+
+        """
+        continuous_reparam, continuous_params = self.continuous.inference(
+            logits[:, 0:self.num_continuous_input])
+        discrete_reparam, disc_params = self.discrete.inference(
+            logits[:, self.num_continuous_input:])
         merged = torch.cat([continuous_reparam, discrete_reparam], -1)
 
-        # use a separate key for gaussian or beta
-        continuous_value = continuous_params['gaussian'] if not self.is_beta else continuous_params['beta']
-        continuous_key = 'gaussian' if not self.is_beta else 'beta'
-        params = {continuous_key: continuous_value,
+        params = {self.continuous_key: continuous_params[self.continuous_key],
                   'discrete': disc_params['discrete'],
                   'logits': logits,
                   'z': merged}
@@ -78,5 +104,5 @@ class Mixture(nn.Module):
         assert continuous_kl.shape == disc_kl.shape, "need to reduce kl to [#batch] before mixture"
         return continuous_kl + disc_kl
 
-    def forward(self, logits):
-        return self.reparmeterize(logits)
+    def forward(self, logits, num_samples=None):
+        return self.reparmeterize(logits, num_samples=num_samples)
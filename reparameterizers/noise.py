@@ -0,0 +1,278 @@
+from __future__ import print_function
+import math
+import time
+import torch
+import numpy as np
+
+from torch.quasirandom import SobolEngine
+from helpers.distributions import nll as nll_fn
+
+
+# Pluggable base-noise sources for the reparameterizers. Every source produces
+# uniforms in (0, 1) which the reparameterizers map through the inverse-CDF of
+# their base distribution (eg: gaussian eps or gumbel noise). The leading dim of
+# the requested shape (num_samples if set, else the batch) indexes the draws;
+# num_samples is passed along so sources can tell the sample dim from the batch.
+
+
+def _clamp_uniform(u, eps=1e-6):
+    return u.clamp_(eps, 1.0 - eps)
+
+
+class IIDNoise(object):
+    """ Standard i.i.d. noise, the default. """
+
+    def uniform(self, shape, device, dtype, generator=None, out=None, num_samples=None):
+        out = torch.empty(shape, device=device, dtype=dtype) if out is None else out
+        return out.uniform_(generator=generator)
+
+    def normal(self, shape, device, dtype, generator=None, out=None, num_samples=None):
+        out = torch.empty(shape, device=device, dtype=dtype) if out is None else out
+        return out.normal_(generator=generator)
+
+
+class AntitheticNoise(IIDNoise):
+    """ Antithetic pairs along the sample dim: u and 1 - u (i.e. eps and -eps).
+        Pairs only make sense between samples of the same example, thus single
+        sample draws (num_samples=None, the leading dim is the batch) are i.i.d.
+    """
+
+    @staticmethod
+    def _half_shape(shape, num_samples):
+        assert num_samples % 2 == 0, "antithetic noise needs an even num_samples"
+        assert shape[0] == num_samples, "the leading dim must be the sample dim"
+        return [num_samples // 2] + list(shape[1:])
+
+    def uniform(self, shape, device, dtype, generator=None, out=None, num_samples=None):
+        if num_samples is None:
+            return super(AntitheticNoise, self).uniform(shape, device, dtype, generator=generator, out=out)
+
+        half = super(AntitheticNoise, self).uniform(
+            self._half_shape(shape, num_samples), device, dtype, generator=generator)
+        u = torch.cat([half, 1.0 - half], 0)
+        return u if out is None else out.copy_(u)
+
+    def normal(self, shape, device, dtype, generator=None, out=None, num_samples=None):
+        if num_samples is None:
+            return super(AntitheticNoise, self).normal(shape, device, dtype, generator=generator, out=out)
+
+        half = super(AntitheticNoise, self).normal(
+            self._half_shape(shape, num_samples), device, dtype, generator=generator)
+        eps = torch.cat([half, -half], 0)
+        return eps if out is None else out.copy_(eps)
+
+
+class SobolNoise(IIDNoise):
+    def __init__(self, scramble=True, seed=None):
+        """ Scrambled Sobol (quasi-random) points along the sample dim: the num_samples
+            draws are successive points of the sequence and the remaining dims (batch and
+            latent) are its dimensions, so the samples of every example are stratified.
+            Single sample draws (num_samples=None, the leading dim is the batch) are i.i.d.
+            Engines are kept per dimensionality so successive calls continue the sequence.
+
+        :param scramble: use Owen scrambling (randomized QMC)
+        :param seed: the scrambling seed
+        :returns: SobolNoise object
+        :rtype: object
+
+        """
+        self.scramble = scramble
+        self.seed = seed
+        self._engines = {}
+
+    def _draw(self, num_points, dimension):
+        """ Draws num_points points of dimension, chunking over SobolEngine.MAXDIM.
+
+        :param num_points: number of points
+        :param dimension: dimension of every point
+        :returns: [num_points, dimension] tensor
+        :rtype: torch.Tensor
+
+        """
+        points = []
+        for offset in range(0, dimension, SobolEngine.MAXDIM):
+            chunk_dim = min(SobolEngine.MAXDIM, dimension - offset)
+            key = (dimension, offset)
+            if key not in self._engines:
+                seed = None if self.seed is None else self.seed + offset
+                self._engines[key] = SobolEngine(chunk_dim, scramble=self.scramble, seed=seed)
+
+            points.append(self._engines[key].draw(num_points, dtype=torch.float64))
+
+        return torch.cat(points, -1)
+
+    def uniform(self, shape, device, dtype, generator=None, out=None, num_samples=None):
+        if num_samples is None:
+            return super(SobolNoise, self).uniform(shape, device, dtype, generator=generator, out=out)
+
+        shape = list(shape)
+        assert shape[0] == num_samples, "the leading dim must be the sample dim"
+        dimension = int(np.prod(shape[1:])) if len(shape) > 1 else 1
+        u = _clamp_uniform(self._draw(shape[0], dimension)).view(shape).to(device=device, dtype=dtype)
+        return u if out is None else out.copy_(u)
+
+    def normal(self, shape, device, dtype, generator=None, out=None, num_samples=None):
+        if num_samples is None:
+            return super(SobolNoise, self).normal(shape, device, dtype, generator=generator, out=out)
+
+        u = self.uniform(shape, device, torch.float64, num_samples=num_samples)  # double keeps the tails
+        eps = (math.sqrt(2.0) * torch.erfinv(2.0 * u - 1.0)).to(dtype)
+        return eps if out is None else out.copy_(eps)
+
+
+class CommonRandomNumbers(IIDNoise):
+    _num_instances = 0  # seed offset of the streams created by name, one per module
+
+    def __init__(self, seed=0):
+        """ Common random numbers for A/B evaluation: a dedicated, seeded stream
+            that replays the same noise after every reset(), e.g. share one
+            instance between two models and reset() before evaluating each.
+            Built by name (noise_source='crn') every module gets its own stream.
+
+        :param seed: the seed of the stream
+        :returns: CommonRandomNumbers object
+        :rtype: object
+
+        """
+        self.seed = seed
+        self._generators = {}
+
+    @classmethod
+    def from_name(cls):
+        """ A stream seeded with the next per-module offset (see get_noise_source). """
+        seed = cls._num_instances
+        cls._num_instances += 1
+        return cls(seed=seed)
+
+    def __getstate__(self):
+        """ Drops the (unpicklable) generators, they are re-created from the seed. """
+        state = self.__dict__.copy()
+        state['_generators'] = {}
+        return state
+
+    def reset(self):
+        for generator in self._generators.values():
+            generator.manual_seed(self.seed)
+
+    def _generator(self, device):
+        device = torch.device(device)
+        if device not in self._generators:
+            self._generators[device] = torch.Generator(device=device)
+            self._generators[device].manual_seed(self.seed)
+
+        return self._generators[device]
+
+    def uniform(self, shape, device, dtype, generator=None, out=None, num_samples=None):
+        return super(CommonRandomNumbers, self).uniform(
+            shape, device, dtype, generator=self._generator(device), out=out, num_samples=num_samples)
+
+    def normal(self, shape, device, dtype, generator=None, out=None, num_samples=None):
+        return super(CommonRandomNumbers, self).normal(
+            shape, device, dtype, generator=self._generator(device), out=out, num_samples=num_samples)
+
+
+def get_noise_source(noise_source):
+    """ Returns a noise source from a name (or passes through a noise source object).
+
+    :param noise_source: one of iid, antithetic, sobol, crn or a noise source object
+    :returns: the noise source
+    :rtype: object
+
+    """
+    if not isinstance(noise_source, str):
+        return noise_source
+
+    noise_dict = {
+        'iid': IIDNoise,
+        'antithetic': AntitheticNoise,
+        'sobol': SobolNoise,
+        'crn': CommonRandomNumbers.from_name
+    }
+    return noise_dict[noise_source]()
+
+
+def _multi_sample_elbo(model, x, num_samples):
+    """ Mean num_samples-sample ELBO of the minibatch: the latents are drawn with a
+        single reparameterizer call (so the noise sources see the sample dim) and
+        decoded as one [num_samples * B] batch.
+
+    :param model: the VAE (an AbstractVAE)
+    :param x: the input minibatch
+    :param num_samples: the number of latent samples per example
+    :returns: scalar negative ELBO
+    :rtype: torch.Tensor
+
+    """
+    z, params = model.reparameterizer(model.encode(x), num_samples=num_samples)
+    decoded = model.decode(z.contiguous().view(num_samples * x.size(0), -1))
+    x_repeated = x.repeat(num_samples, *[1] * (x.dim() - 1))
+    nll = nll_fn(x_repeated, decoded, model.config['nll_type']).view(num_samples, -1).mean(0)
+    return torch.mean(nll + model.config['kl_beta'] * model.kld(params))
+
+
+def benchmark_gradient_variance(model, x, noise_sources, num_repeats=16, num_samples=2):
+    """ Measures the variance of the (num_samples-sample) ELBO gradient w.r.t. all params
+        over num_repeats evaluations on the same minibatch for each noise source, along
+        with the wall-clock cost, so estimators can be compared per unit of compute
+        (lower variance_x_seconds is better).
+
+    :param model: the VAE (an AbstractVAE)
+    :param x: the input minibatch
+    :param noise_sources: dict of name --> noise source (or noise source name)
+    :param num_repeats: number of gradient evaluations per source
+    :param num_samples: latent samples per example, antithetic needs an even number >= 2
+    :returns: dict of name --> {'grad_variance', 'seconds', 'variance_x_seconds'}
+    :rtype: dict
+
+    """
+    noise_sources = {name: get_noise_source(noise_source) for name, noise_source in noise_sources.items()}
+    assert num_samples >= 2 or not any(isinstance(noise_source, AntitheticNoise)
+                                       for noise_source in noise_sources.values()), \
+        "antithetic noise is i.i.d. for a single sample, use num_samples >= 2"
+
+    reparameterizers = [m for m in model.modules() if hasattr(m, 'noise_source')]
+    original_sources = [r.noise_source for r in reparameterizers]
+    params = [p for p in model.parameters() if p.requires_grad]
+    was_training = model.training
+    model.train()
+
+    results = {}
+    try:
+        for name, noise_source in noise_sources.items():
+            for reparam in reparameterizers:
+                reparam.noise_source = noise_source
+
+            # welford running mean / variance of the flattened gradient
+            mean, m2, elapsed = None, None, 0.0
+            for i in range(num_repeats):
+                model.zero_grad()
+                if x.is_cuda:
+                    torch.cuda.synchronize()
+
+                start = time.time()
+                _multi_sample_elbo(model, x, num_samples).backward()
+                if x.is_cuda:
+                    torch.cuda.synchronize()
+
+                elapsed += time.time() - start
+                grad = torch.cat([p.grad.detach().view(-1) for p in params if p.grad is not None]).double()
+                if mean is None:
+                    mean, m2 = grad.clone(), torch.zeros_like(grad)
+                else:
+                    delta = grad - mean
+                    mean += delta / (i + 1)
+                    m2 += delta * (grad - mean)
+
+            grad_variance = (torch.sum(m2) / max(num_repeats - 1, 1)).item()
+            seconds = elapsed / num_repeats
+            results[name] = {'grad_variance': grad_variance,
+                             'seconds': seconds,
+                             'variance_x_seconds': grad_variance * seconds}
+    finally:
+        for reparam, noise_source in zip(reparameterizers, original_sources):
+            reparam.noise_source = noise_source
+
+        model.zero_grad()
+        model.train(was_training)
+
+    return results
@@ -0,0 +1,205 @@
+from __future__ import print_function
+import threading
+import contextlib
+import torch
+
+
+def module_version(module):
+    """ Returns a cheap fingerprint of the weights of a module: the in-place version
+        counters of all params + buffers, which are bumped by optimizer steps,
+        load_state_dict, running-stat updates, etc. along with their storage, device
+        and dtype, which change when .to() / .cuda() / .half() create fresh tensors.
+
+    :param module: the nn.Module
+    :returns: tuple of (data_ptr, device, dtype, version) per tensor
+    :rtype: tuple
+
+    """
+    return tuple((t.data_ptr(), t.device, t.dtype, t._version)
+                 for t in list(module.parameters()) + list(module.buffers()))
+
+
+@contextlib.contextmanager
+def stochastic_sampling(reparameterizer):
+    """ Puts the reparameterizer (only) in training mode to draw stochastic samples
+        from an inference API, restoring the modes and every scalar state on exit,
+        eg: the gumbel / bernoulli iteration counters and annealed temperatures.
+
+    :param reparameterizer: the reparameterizer module
+    :returns: None
+    :rtype: None
+
+    """
+    states = [(m, {k: v for k, v in vars(m).items() if isinstance(v, (int, float))})
+              for m in reparameterizer.modules()]
+    reparameterizer.train(True)
+    try:
+        yield
+    finally:
+        for m, state in states:
+            m.__dict__.update(state)
+
+
+def hard_samples(z, params):
+    """ Replaces the relaxed discrete part of z (its trailing dims, eg: of a mixture)
+        by the exact one-hot / binary samples of a training-mode reparameterizer.
+
+    :param z: the reparameterized tensor
+    :param params: the params of the reparameterizer
+    :returns: z with a hard discrete part
+    :rtype: torch.Tensor
+
+    """
+    if 'discrete' not in params:
+        return z
+
+    z_hard = params['discrete']['z_hard']
+    return torch.cat([z[..., 0:z.size(-1) - z_hard.size(-1)], z_hard], -1)
+
+
+class AncestralPriorSampler(object):
+    def __init__(self, reparameterizer, pool_size=0, chunk_size=256):
+        """ Prior-sampling engine for generation heavy workloads: batches many
+            requests into a single (ancestral) prior call and optionally keeps a
+            pool of pre-generated samples, filled from a background thread and
+            thrown away whenever the weights of the reparameterizer change.
+
+        :param reparameterizer: the (eg: sequential) reparameterizer to sample from
+        :param pool_size: number of samples to keep pre-generated, 0 disables the pool
+        :param chunk_size: number of samples generated per prior call by the pool thread
+        :returns: AncestralPriorSampler object
+        :rtype: object
+
+        """
+        self.reparameterizer = reparameterizer
+        self.pool_size = pool_size
+        self.chunk_size = chunk_size
+
+        self._pool = []             # list of [N_i, D] tensors
+        self._pool_count = 0
+        self._pool_version = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._thread = None
+        self._running = False
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _generate(self, batch_size):
+        with torch.no_grad():
+            return self.reparameterizer.prior(batch_size)
+
+    def _can_pool(self):
+        """ Only pool in eval mode: in train mode the chain updates running stats (eg: BN). """
+        return self.pool_size > 0 and not self.reparameterizer.training
+
+    def _take_from_pool(self, batch_size):
+        """ Pops batch_size samples from the pool (lock must be held).
+
+        :param batch_size: the number of samples
+        :returns: [batch_size, D] tensor or None if the pool is stale / too small
+        :rtype: torch.Tensor
+
+        """
+        if self._pool_version != module_version(self.reparameterizer):
+            self._pool, self._pool_count = [], 0  # weights changed, pool is stale
+            self._wakeup.notify()
+            return None
+
+        if self._pool_count < batch_size:
+            return None
+
+        pool = torch.cat(self._pool, 0)
+        samples, remaining = pool[0:batch_size], pool[batch_size:]
+        self._pool = [remaining] if remaining.size(0) > 0 else []
+        self._pool_count = remaining.size(0)
+        self._wakeup.notify()
+        return samples
+
+    def sample(self, batch_size):
+        """ Returns batch_size prior samples, from the pool when possible.
+
+        :param batch_size: the number of samples
+        :returns: prior samples
+        :rtype: torch.Tensor
+
+        """
+        if self._can_pool():
+            with self._lock:
+                samples = self._take_from_pool(batch_size)
+
+            if samples is not None:
+                return samples
+
+        return self._generate(batch_size)
+
+    def sample_many(self, batch_sizes):
+        """ Serves many requests with a single prior call.
+
+        :param batch_sizes: list of request sizes
+        :returns: list of prior samples, one per request
+        :rtype: list
+
+        """
+        samples = self.sample(int(sum(batch_sizes)))
+        return list(torch.split(samples, list(batch_sizes), dim=0))
+
+    def _fill_pool(self):
+        """ Background loop: (re)fills the pool whenever it is below pool_size or stale. """
+        while True:
+            with self._lock:
+                while self._running and (not self._can_pool() or (
+                        self._pool_count >= self.pool_size
+                        and self._pool_version == module_version(self.reparameterizer))):
+                    self._wakeup.wait(timeout=1.0)  # also polls for weight updates
+
+                if not self._running:
+                    return
+
+            version = module_version(self.reparameterizer)
+            chunk = self._generate(self.chunk_size)
+
+            with self._lock:
+                if version != module_version(self.reparameterizer):
+                    continue  # weights changed mid-generation
+
+                if version != self._pool_version:
+                    self._pool, self._pool_count, self._pool_version = [], 0, version
+
+                self._pool.append(chunk)
+                self._pool_count += chunk.size(0)
+
+    def start(self):
+        """ Starts the background pool thread (no-op without a pool).
+
+        :returns: self
+        :rtype: AncestralPriorSampler
+
+        """
+        if self.pool_size > 0 and self._thread is None:
+            self._running = True
+            self._thread = threading.Thread(target=self._fill_pool, daemon=True)
+            self._thread.start()
+
+        return self
+
+    def stop(self):
+        """ Stops the background pool thread and clears the pool.
+
+        :returns: None
+        :rtype: None
+
+        """
+        with self._lock:
+            self._running = False
+            self._wakeup.notify_all()
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        self._pool, self._pool_count, self._pool_version = [], 0, None
@@ -12,10 +12,12 @@ from functools import partial
 from helpers.utils import float_type, ones_like
 from helpers.layers import get_encoder, str_to_activ_module
 from .beta import Beta
+from .kumaraswamy import Kumaraswamy
 from .bernoulli import Bernoulli
 from .gumbel import GumbelSoftmax
 from .mixture import Mixture
 from .isotropic_gaussian import IsotropicGaussian
+from .prior_sampler import stochastic_sampling, hard_samples
 
 
 class SequentialReparameterizer(nn.Module):
@@ -65,11 +67,15 @@ class SequentialReparameterizer(nn.Module):
         """
         reparam_dict = {
             'beta': Beta,
+            'kumaraswamy': Kumaraswamy,
             'bernoulli': Bernoulli,
             'discrete': GumbelSoftmax,
             'isotropic_gaussian': IsotropicGaussian,
             'mixture': partial(Mixture, num_discrete=self.config['discrete_size'],
-                               num_continuous=self.config['continuous_size'])
+                               num_continuous=self.config['continuous_size']),
+            'mixture_kumaraswamy': partial(Mixture, num_discrete=self.config['discrete_size'],
+                                           num_continuous=self.config['continuous_size'],
+                                           is_beta=True, use_kumaraswamy=True)
         }
 
         # build the base reparameterizers
@@ -140,35 +146,123 @@ class SequentialReparameterizer(nn.Module):
 
         return kl
 
-    def reparameterize(self, logits):
+    @staticmethod
+    def _unflatten_params(params, num_samples, batch_size):
+        """ Views every [num_samples * B, ...] tensor of a (nested) param dict as [num_samples, B, ...].
+
+        :param params: the param dict
+        :param num_samples: the number of samples
+        :param batch_size: the batch size
+        :returns: param dict
+        :rtype: dict
+
+        """
+        unflattened = {}
+        for k, v in params.items():
+            if isinstance(v, dict):
+                v = SequentialReparameterizer._unflatten_params(v, num_samples, batch_size)
+            elif torch.is_tensor(v) and v.dim() > 0 and v.size(0) == num_samples * batch_size:
+                v = v.view(num_samples, batch_size, *v.shape[1:])
+
+            unflattened[k] = v
+
+        return unflattened
+
+    def reparameterize(self, logits, num_samples=None):
         """ execute the reparameterization layer-by-layer returning ALL params and last logits.
+            With num_samples the first reparameterizer draws K samples and the rest of the chain
+            runs once over the flattened [K * B, D] samples, thus the params (and KLs) of every
+            level after the first are per-sample, i.e. [K, B, ...].
 
         :param logits: the input logits
+        :param num_samples: if set returns [num_samples, B, D] samples
         :returns: last logits, list of params
         :rtype: torch.Tensor, list
 
         """
         params_list = []
-        for reparam in self.reparameterizers:
+        logits, params = self.reparameterizers[0](logits, num_samples=num_samples)
+        params_list.append({**params, 'logits': logits})
+        if num_samples is not None:
+            batch_size = logits.size(1)
+            logits = logits.contiguous().view(num_samples * batch_size, -1)
+
+        for reparam in self.reparameterizers[1:]:
             logits, params = reparam(logits)
-            params_list.append({**params, 'logits': logits})
+            if num_samples is not None:
+                params = self._unflatten_params(params, num_samples, batch_size)
+
+            params_list.append({**params, 'logits': logits if num_samples is None
+                                else logits.view(num_samples, batch_size, -1)})
+
+        if num_samples is not None:
+            logits = logits.view(num_samples, batch_size, -1)
 
         return logits, params_list
 
-    def forward(self, logits):
-        return self.reparameterize(logits)
+    def log_likelihood(self, z, params_list):
+        """ Log-likelihood of the ancestral chain: the sum over levels of the log-likelihood
+            of each intermediate sample (params['z']) and of z for the last level.
+
+        :param z: the last latent z, [B, D] or [num_samples, B, D]
+        :param params_list: the list of params returned by reparameterize
+        :returns: log-likelihood of shape z.shape[0:-1]
+        :rtype: torch.Tensor
+
+        """
+        log_likelihood = []
+        z_list = [params['z'] for params in params_list[0:-1]] + [z]
+        for z_i, params_i, reparam in zip(z_list, params_list, self.reparameterizers):
+            reparam_obj = reparam[-1] if isinstance(reparam, nn.Sequential) else reparam
+            log_likelihood_i = reparam_obj.log_likelihood(z_i, params_i)
+            if log_likelihood_i.dim() == z_i.dim():  # element-wise, eg: gaussian
+                log_likelihood_i = torch.sum(log_likelihood_i, -1)
+
+            log_likelihood.append(log_likelihood_i)
+
+        return torch.stack(log_likelihood, 0).sum(0)
+
+    def inference(self, logits):
+        """ Deterministic, side-effect free pass through the chain: the inter-projection
+            nets run as usual and every reparameterizer uses its inference path.
+
+        :param logits: the input logits
+        :returns: last reparam, list of (minimal) params
+        :rtype: torch.Tensor, list
+
+        """
+        params_list = []
+        for reparam in self.reparameterizers:
+            if isinstance(reparam, nn.Sequential):  # projection --> reparam
+                logits = reparam[0:-1](logits)
+                reparam = reparam[-1]
+
+            logits, params = reparam.inference(logits)
+            params_list.append(params)
+
+        return logits, params_list
+
+    def forward(self, logits, num_samples=None):
+        return self.reparameterize(logits, num_samples=num_samples)
 
     def prior(self, batch_size, **kwargs):
-        """ Gen the first prior.
+        """ Ancestral sample: draw the first prior and sample every conditional of the
+            rest of the chain (without gradients and restoring the annealing state).
+            See AncestralPriorSampler for batched / pooled sampling.
 
         :param batch_size: the batch size to generate
-        :returns: prior sample
+        :returns: prior sample, [num_samples, batch_size, D] if num_samples is passed
         :rtype: torch.Tensor
 
         """
-        prior = self.reparameterizers[0].prior(batch_size)
-        if len(self.reparameterizers) > 1:
+        num_samples = kwargs.get('num_samples', None)
+        with torch.no_grad():
+            prior = self.reparameterizers[0].prior(batch_size, num_samples=num_samples)
+            prior = prior.view(-1, prior.size(-1))  # flatten the samples into the batch
             for reparam in self.reparameterizers[1:]:
-                prior, _ = reparam(prior)
+                with stochastic_sampling(reparam[-1]):
+                    prior, params = reparam[-1](reparam[0:-1](prior))
+
+                prior = hard_samples(prior, params)
 
-        return prior
+        return prior if num_samples is None else prior.view(num_samples, batch_size, -1)
@@ -0,0 +1,57 @@
+from __future__ import print_function
+import torch
+
+
+class StraightThroughOneHot(torch.autograd.Function):
+    """ Exact one-hot of the argmax in the forward pass and an identity
+        gradient in the backward pass, i.e. (hard - soft).detach() + soft
+        without keeping any of those intermediates alive: nothing is saved
+        for backward and ties resolve to a single index.
+    """
+
+    @staticmethod
+    def forward(ctx, soft, dim=-1):
+        index = torch.argmax(soft, dim=dim, keepdim=True)
+        return torch.zeros_like(soft).scatter_(dim, index, 1.0)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        return grad_output, None
+
+
+class StraightThroughThreshold(torch.autograd.Function):
+    """ Binarizes the input at threshold in the forward pass and passes
+        the gradient straight through in the backward pass.
+    """
+
+    @staticmethod
+    def forward(ctx, soft, threshold=0.5):
+        return (soft >= threshold).type_as(soft)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        return grad_output, None
+
+
+def straight_through_one_hot(soft, dim=-1):
+    """ Hard one-hot sample with straight-through gradients.
+
+    :param soft: the relaxed sample
+    :param dim: the dimension to one-hot over
+    :returns: one-hot tensor of soft.size()
+    :rtype: torch.Tensor
+
+    """
+    return StraightThroughOneHot.apply(soft, dim)
+
+
+def straight_through_threshold(soft, threshold=0.5):
+    """ Hard binary sample with straight-through gradients.
+
+    :param soft: the relaxed sample
+    :param threshold: values >= threshold map to 1
+    :returns: binary tensor of soft.size()
+    :rtype: torch.Tensor
+
+    """
+    return StraightThroughThreshold.apply(soft, threshold)
@@ -0,0 +1,354 @@
+from __future__ import print_function
+import os
+import json
+import numpy as np
+import torch
+
+from ..reparameterizers.divergences import kl_normal_normal
+
+
+def _to_numpy(x):
+    if torch.is_tensor(x):
+        x = x.detach().cpu().numpy()
+
+    x = np.ascontiguousarray(x, dtype=np.float32)  # also accepts (nested) lists
+    return x.reshape(x.shape[0], -1)
+
+
+def _squared_distances(x, centroids):
+    """ ||x - c||^2 for every row of x and every centroid, [N, C]. """
+    return np.maximum((x ** 2).sum(-1, keepdims=True) - 2 * x @ centroids.T
+                      + (centroids ** 2).sum(-1)[None, :], 0)
+
+
+def _assign(x, centroids, chunk_size=65536):
+    return np.concatenate([np.argmin(_squared_distances(x[i:i+chunk_size], centroids), -1)
+                           for i in range(0, x.shape[0], chunk_size)], 0)
+
+
+def kmeans(x, num_clusters, num_iters=20, seed=0):
+    """ Plain lloyd's k-means, empty clusters are re-seeded with random points.
+
+    :param x: [N, D] float32 array
+    :param num_clusters: number of centroids
+    :param num_iters: number of iterations
+    :param seed: the seed
+    :returns: [num_clusters, D] centroids
+    :rtype: np.array
+
+    """
+    rng = np.random.RandomState(seed)
+    centroids = x[rng.choice(x.shape[0], num_clusters, replace=x.shape[0] < num_clusters)].copy()
+    for _ in range(num_iters):
+        assignment = _assign(x, centroids)
+        counts = np.bincount(assignment, minlength=num_clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, x)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        centroids[empty] = x[rng.choice(x.shape[0], int(empty.sum()))]
+
+    return centroids
+
+
+class GaussianIVFPQIndex(object):
+    def __init__(self, dim, num_lists=256, num_subquantizers=8, store_posteriors=True):
+        """ IVF-PQ approximate nearest-neighbour index over gaussian posterior means:
+            a coarse k-means quantizer picks the inverted lists and the residuals
+            are product-quantized to num_subquantizers bytes per item. When the
+            posteriors are stored, the candidates can be re-ranked exactly by the
+            KL between the query and item posteriors.
+
+        :param dim: the latent size
+        :param num_lists: number of inverted lists (coarse centroids)
+        :param num_subquantizers: number of PQ sub-spaces (bytes per item), must divide dim
+        :param store_posteriors: also store (float16) mu / logvar for KL re-ranking
+        :returns: GaussianIVFPQIndex object
+        :rtype: object
+
+        """
+        assert dim % num_subquantizers == 0, "num_subquantizers must divide dim"
+        self.dim = dim
+        self.num_lists = num_lists
+        self.num_subquantizers = num_subquantizers
+        self.store_posteriors = store_posteriors
+        self.sub_dim = dim // num_subquantizers
+
+        self.centroids = None       # [num_lists, dim]
+        self.codebooks = None       # [num_subquantizers, 256, sub_dim]
+        self.codes = np.zeros((0, num_subquantizers), dtype=np.uint8)
+        self.list_ids = np.zeros((0,), dtype=np.int32)
+        self.ids = np.zeros((0,), dtype=np.int64)
+        self.mu = np.zeros((0, dim), dtype=np.float16)
+        self.logvar = np.zeros((0, dim), dtype=np.float16)
+        self._inverted_lists = None  # (order, offsets), re-built lazily after adds
+
+    def __len__(self):
+        return self.ids.shape[0]
+
+    @property
+    def is_trained(self):
+        return self.centroids is not None
+
+    def train(self, mu, num_iters=20, seed=0, min_points_per_centroid=8):
+        """ Learns the coarse quantizer and the PQ codebooks, on a representative
+            sample of the data (eg: a random subset of the encoded shards).
+
+        :param mu: [N, dim] training means
+        :param min_points_per_centroid: required training points per list / PQ code
+        :param num_iters: k-means iterations
+        :param seed: the seed
+        :returns: self
+        :rtype: GaussianIVFPQIndex
+
+        """
+        mu = _to_numpy(mu)
+        min_points = max(self.num_lists, 256) * min_points_per_centroid
+        assert mu.shape[0] >= min_points, \
+            "train needs >= {} points, got {}".format(min_points, mu.shape[0])
+        self.centroids = kmeans(mu, self.num_lists, num_iters, seed)
+        residuals = mu - self.centroids[_assign(mu, self.centroids)]
+        self.codebooks = np.stack([
+            kmeans(residuals[:, m*self.sub_dim:(m+1)*self.sub_dim], 256, num_iters, seed + m + 1)
+            for m in range(self.num_subquantizers)], 0)
+        return self
+
+    def _encode(self, mu):
+        """ Coarse assignment and PQ codes of mu. """
+        list_ids = _assign(mu, self.centroids)
+        residuals = mu - self.centroids[list_ids]
+        codes = np.stack([_assign(residuals[:, m*self.sub_dim:(m+1)*self.sub_dim], self.codebooks[m])
+                          for m in range(self.num_subquantizers)], 1).astype(np.uint8)
+        return list_ids.astype(np.int32), codes
+
+    def add(self, mu, logvar=None, ids=None):
+        """ Incrementally adds items, the index must be trained first.
+
+        :param mu: [N, dim] posterior means
+        :param logvar: [N, dim] posterior 'logvar' params (required if store_posteriors)
+        :param ids: optional [N] external ids, sequential otherwise
+        :returns: the ids of the added items
+        :rtype: np.array
+
+        """
+        assert self.is_trained, "call train() on a representative sample before add()"
+        mu = _to_numpy(mu)
+        ids = np.arange(len(self), len(self) + mu.shape[0]) if ids is None \
+            else np.asarray(ids, dtype=np.int64)
+        list_ids, codes = self._encode(mu)
+        self.codes = np.concatenate([self.codes, codes], 0)
+        self.list_ids = np.concatenate([self.list_ids, list_ids], 0)
+        self.ids = np.concatenate([self.ids, ids], 0)
+        if self.store_posteriors:
+            assert logvar is not None, "logvar is required to store posteriors"
+            self.mu = np.concatenate([self.mu, mu.astype(np.float16)], 0)
+            self.logvar = np.concatenate([self.logvar, _to_numpy(logvar).astype(np.float16)], 0)
+
+        self._inverted_lists = None
+        return ids
+
+    def add_shards(self, shards):
+        """ Extends the (trained) index from encoded shards.
+
+        :param shards: iterable of (mu, logvar) tuples or paths of .npz files with mu / logvar
+        :returns: self
+        :rtype: GaussianIVFPQIndex
+
+        """
+        for shard in shards:
+            if isinstance(shard, str):
+                shard = np.load(shard)
+                shard = (shard['mu'], shard['logvar'] if 'logvar' in shard else None)
+
+            self.add(*shard)
+
+        return self
+
+    @staticmethod
+    def _posterior(model, x):
+        """ Deterministic gaussian posterior (mu, logvar) of x from an (eval-mode) model. """
+        _, params = model.inference_posterior(x)
+        return params['gaussian']['mu'], params['gaussian']['logvar']
+
+    def encode_and_add(self, model, x, ids=None):
+        mu, logvar = self._posterior(model, x)
+        return self.add(mu, logvar, ids=ids)
+
+    def _lists(self):
+        if self._inverted_lists is None:
+            order = np.argsort(self.list_ids, kind='stable')
+            offsets = np.concatenate([[0], np.cumsum(np.bincount(self.list_ids, minlength=self.num_lists))])
+            self._inverted_lists = (order, offsets)
+
+        return self._inverted_lists
+
+    def _candidates(self, mu, nprobe):
+        """ PQ (asymmetric) distances of every item in the nprobe closest lists of each query.
+
+        :param mu: [Q, dim] query means
+        :param nprobe: number of inverted lists to scan
+        :returns: [Q, C] distances and item rows, inf / -1 padded
+        :rtype: np.array, np.array
+
+        """
+        order, offsets = self._lists()
+        num_queries = mu.shape[0]
+        probes = np.argsort(_squared_distances(mu, self.centroids), -1)[:, 0:nprobe]
+
+        # [Q, P, M, 256] lookup tables of the query residuals: |r|^2 - 2 r.c + |c|^2
+        residuals = (mu[:, None, :] - self.centroids[probes]).reshape(
+            num_queries, probes.shape[1], self.num_subquantizers, self.sub_dim)
+        tables = (residuals ** 2).sum(-1)[..., None] \
+            - 2 * np.matmul(residuals[..., None, :], self.codebooks.transpose(0, 2, 1))[..., 0, :] \
+            + (self.codebooks ** 2).sum(-1)[None, None]
+
+        # flatten the probed lists: one entry per (query, probe, item)
+        lengths = (offsets[probes + 1] - offsets[probes]).reshape(-1)
+        segment_starts = np.cumsum(lengths) - lengths
+        within = np.arange(int(lengths.sum())) - np.repeat(segment_starts, lengths)
+        rows = order[np.repeat(offsets[probes].reshape(-1), lengths) + within]
+        query_probe = np.repeat(np.arange(lengths.shape[0]), lengths)
+        table_index = (query_probe[:, None] * self.num_subquantizers
+                       + np.arange(self.num_subquantizers)[None, :]) * 256 + self.codes[rows]
+        dists = np.take(tables.reshape(-1), table_index).sum(-1)
+
+        # scatter into [Q, C] padded rows
+        per_query = lengths.reshape(num_queries, -1).sum(-1)
+        query = query_probe // probes.shape[1]
+        position = np.arange(rows.shape[0]) - np.repeat(np.cumsum(per_query) - per_query, per_query)
+        padded_dists = np.full((num_queries, max(int(per_query.max()), 1)), np.inf, dtype=np.float32)
+        padded_rows = np.full(padded_dists.shape, -1, dtype=np.int64)
+        padded_dists[query, position], padded_rows[query, position] = dists, rows
+        return padded_dists, padded_rows
+
+    @staticmethod
+    def _top(dists, rows, k):
+        """ The k smallest dists (and their rows) of every query, sorted. """
+        if dists.shape[1] > k:
+            top = np.argpartition(dists, k - 1, -1)[:, 0:k]
+            dists, rows = np.take_along_axis(dists, top, -1), np.take_along_axis(rows, top, -1)
+
+        top = np.argsort(dists, -1)
+        return np.take_along_axis(dists, top, -1), np.take_along_axis(rows, top, -1)
+
+    def _rerank(self, mu, logvar, rows):
+        """ KL(query posterior || item posterior) of the candidate rows, inf for the padding.
+            The 'logvar' params are mapped to the std used by the sampler, exp(logvar / 2).
+
+        :param mu: [Q, dim] query means
+        :param logvar: [Q, dim] query 'logvar' params
+        :param rows: [Q, C] candidate rows, -1 padded
+        :returns: [Q, C] KLs
+        :rtype: np.array
+
+        """
+        valid = rows >= 0
+        safe_rows = np.where(valid, rows, 0)
+        kl = torch.sum(kl_normal_normal(
+            torch.from_numpy(mu[:, None, :]),
+            torch.from_numpy(logvar[:, None, :]).mul(0.5).exp(),
+            torch.from_numpy(self.mu[safe_rows].astype(np.float32)),
+            torch.from_numpy(self.logvar[safe_rows].astype(np.float32)).mul(0.5).exp()), -1).numpy()
+        return np.where(valid, kl, np.inf).astype(np.float32)
+
+    def search(self, mu, k=10, nprobe=8, logvar=None, rerank_factor=4, chunk_size=256):
+        """ Approximate top-k search by (PQ) euclidean distance of the means, optionally
+            re-ranking rerank_factor * k candidates by KL(query posterior || item posterior).
+            Queries are processed as vectorized chunks of chunk_size.
+
+        :param mu: [Q, dim] query means
+        :param k: number of neighbours
+        :param nprobe: number of inverted lists to scan
+        :param logvar: [Q, dim] query 'logvar' params, enables the KL re-rank
+        :param rerank_factor: candidates per neighbour considered by the re-rank
+        :param chunk_size: number of queries processed at once (bounds the memory)
+        :returns: distances (or KLs) [Q, k] and ids [Q, k], -1 padded
+        :rtype: np.array, np.array
+
+        """
+        mu = _to_numpy(mu)
+        rerank = logvar is not None and self.store_posteriors
+        logvar = _to_numpy(logvar) if rerank else None
+        num_candidates = k * rerank_factor if rerank else k
+
+        all_dists = np.full((mu.shape[0], k), np.inf, dtype=np.float32)
+        all_ids = np.full((mu.shape[0], k), -1, dtype=np.int64)
+        if len(self) == 0:
+            return all_dists, all_ids
+
+        for begin in range(0, mu.shape[0], chunk_size):
+            end = min(begin + chunk_size, mu.shape[0])
+            dists, rows = self._top(*self._candidates(mu[begin:end], nprobe), num_candidates)
+            if rerank:
+                dists, rows = self._top(self._rerank(mu[begin:end], logvar[begin:end], rows), rows, k)
+
+            dists, rows = dists[:, 0:k], rows[:, 0:k]
+            all_dists[begin:end, 0:dists.shape[1]] = np.where(rows >= 0, dists, np.inf)
+            all_ids[begin:end, 0:rows.shape[1]] = np.where(rows >= 0, self.ids[np.maximum(rows, 0)], -1)
+
+        return all_dists, all_ids
+
+    def search_by_image(self, model, x, k=10, nprobe=8, rerank=True):
+        """ Encodes x and searches in one call.
+
+        :param model: an AbstractVAE with an isotropic gaussian latent
+        :param x: the input tensor
+        :param k: number of neighbours
+        :param nprobe: number of inverted lists to scan
+        :param rerank: re-rank by KL between posteriors
+        :returns: distances [B, k] and ids [B, k]
+        :rtype: np.array, np.array
+
+        """
+        mu, logvar = self._posterior(model, x)
+        return self.search(mu, k=k, nprobe=nprobe, logvar=logvar if rerank else None)
+
+    def save(self, path):
+        """ Serializes to a directory of .npy files, stored sorted by inverted list
+            so that load(..., mmap_mode='r') readers scan contiguous memory.
+
+        :param path: the directory
+        :returns: None
+        :rtype: None
+
+        """
+        os.makedirs(path, exist_ok=True)
+        order, offsets = self._lists()
+        arrays = {'centroids': self.centroids, 'codebooks': self.codebooks,
+                  'codes': self.codes[order], 'list_ids': self.list_ids[order],
+                  'ids': self.ids[order], 'offsets': offsets}
+        if self.store_posteriors:
+            arrays.update({'mu': self.mu[order], 'logvar': self.logvar[order]})
+
+        for name, array in arrays.items():
+            np.save(os.path.join(path, name + '.npy'), array)
+
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'dim': self.dim, 'num_lists': self.num_lists,
+                       'num_subquantizers': self.num_subquantizers,
+                       'store_posteriors': self.store_posteriors}, f)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """ Loads a saved index, memory-mapping the arrays (shared between reader
+            processes through the page cache). Adding to it copies into memory.
+
+        :param path: the directory
+        :param mmap_mode: np.load mmap mode, None to read into memory
+        :returns: the index
+        :rtype: GaussianIVFPQIndex
+
+        """
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+
+        index = cls(**meta)
+        load = lambda name: np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode)
+        index.centroids, index.codebooks = np.asarray(load('centroids')), np.asarray(load('codebooks'))
+        index.codes, index.list_ids, index.ids = load('codes'), load('list_ids'), load('ids')
+        if index.store_posteriors:
+            index.mu, index.logvar = load('mu'), load('logvar')
+
+        # stored sorted by list: the identity order + the saved offsets
+        index._inverted_lists = (np.arange(index.ids.shape[0]), np.asarray(load('offsets')))
+        return index
@@ -0,0 +1,233 @@
+from __future__ import print_function
+import os
+import json
+import threading
+import numpy as np
+import torch
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+# popcount of every byte, used when numpy has no bitwise_count (numpy < 2.0)
+_POPCOUNT_LUT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def popcount(words):
+    """ Number of set bits of every uint64 word.
+
+    :param words: uint64 array
+    :returns: array of bit counts (same shape)
+    :rtype: np.array
+
+    """
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words)
+
+    words = np.ascontiguousarray(words)
+    return _POPCOUNT_LUT[words.view(np.uint8)].reshape(*words.shape, 8).sum(-1)
+
+
+def pack_codes(codes, threshold=0.5):
+    """ Packs binary / one-hot codes into uint64 words (LSB first).
+
+    :param codes: [N, num_bits] tensor or array, values > threshold are set
+    :param threshold: binarization threshold
+    :returns: [N, ceil(num_bits / 64)] uint64 array
+    :rtype: np.array
+
+    """
+    if torch.is_tensor(codes):
+        codes = codes.detach().cpu().numpy()
+
+    codes = np.asarray(codes).reshape(codes.shape[0], -1) > threshold
+    packed = np.packbits(codes, axis=1, bitorder='little')
+    num_words = (codes.shape[1] + 63) // 64
+    padded = np.zeros((codes.shape[0], num_words * 8), dtype=np.uint8)
+    padded[:, 0:packed.shape[1]] = packed
+    return padded.view(np.uint64)
+
+
+class HammingStore(object):
+    def __init__(self, path, num_bits, initial_capacity=1024, num_threads=None):
+        """ Memory-mapped store of bit-packed binary latents (eg: bernoulli or hard gumbel
+            codes used as semantic hashes) answering top-k hamming queries with popcount.
+            Re-opens an existing store at path, the num_bits must match.
+
+        :param path: directory holding codes.u64 and meta.json
+        :param num_bits: the latent size in bits
+        :param initial_capacity: number of rows allocated for a new store
+        :param num_threads: number of search threads (cpu count if None)
+        :returns: HammingStore object
+        :rtype: object
+
+        """
+        self.path = path
+        self.num_bits = num_bits
+        self.num_words = (num_bits + 63) // 64
+        self.num_threads = os.cpu_count() if num_threads is None else num_threads
+        self._lock = threading.RLock()
+        os.makedirs(path, exist_ok=True)
+
+        meta = self._read_meta()
+        if meta is not None:
+            assert meta['num_bits'] == num_bits, \
+                "store has {} bits, requested {}".format(meta['num_bits'], num_bits)
+            self.count, self.capacity = meta['count'], meta['capacity']
+        else:
+            self.count, self.capacity = 0, max(1, initial_capacity)
+            self._resize_file(self.capacity)
+            self._write_meta()
+
+        self._open_memmap()
+
+    @property
+    def _codes_path(self):
+        return os.path.join(self.path, 'codes.u64')
+
+    @property
+    def _meta_path(self):
+        return os.path.join(self.path, 'meta.json')
+
+    def _read_meta(self):
+        if not os.path.isfile(self._meta_path):
+            return None
+
+        with open(self._meta_path, 'r') as f:
+            return json.load(f)
+
+    def _write_meta(self):
+        tmp_path = self._meta_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'num_bits': self.num_bits,
+                       'count': self.count,
+                       'capacity': self.capacity}, f)
+
+        os.replace(tmp_path, self._meta_path)  # atomic for concurrent readers
+
+    def _resize_file(self, capacity):
+        with open(self._codes_path, 'ab') as f:
+            f.truncate(capacity * self.num_words * 8)
+
+    def _open_memmap(self):
+        self._codes = np.memmap(self._codes_path, dtype=np.uint64, mode='r+',
+                                shape=(self.capacity, self.num_words))
+
+    def __len__(self):
+        return self.count
+
+    def add(self, codes):
+        """ Appends codes, growing the file (geometrically) as required.
+
+        :param codes: [N, num_bits] binary codes or [N, num_words] packed uint64 codes
+        :returns: the ids of the inserted rows
+        :rtype: np.array
+
+        """
+        packed = codes if isinstance(codes, np.ndarray) and codes.dtype == np.uint64 \
+            else pack_codes(codes)
+        assert packed.shape[1] == self.num_words, "expected {} words".format(self.num_words)
+
+        with self._lock:
+            begin, end = self.count, self.count + packed.shape[0]
+            if end > self.capacity:
+                self._codes.flush()
+                del self._codes
+                self.capacity = max(end, 2 * self.capacity)
+                self._resize_file(self.capacity)
+                self._open_memmap()
+
+            self._codes[begin:end] = packed
+            self.count = end
+            self._write_meta()
+
+        return np.arange(begin, end)
+
+    def encode_and_add(self, model, x):
+        """ Encodes x with the (eval-mode) model's deterministic posterior and adds the codes.
+
+        :param model: an AbstractVAE with a binary / one-hot latent
+        :param x: the input tensor
+        :returns: the ids of the inserted rows
+        :rtype: np.array
+
+        """
+        z, _ = model.inference_posterior(x)
+        return self.add(z)
+
+    def flush(self):
+        with self._lock:
+            self._codes.flush()
+            self._write_meta()
+
+    def close(self):
+        self.flush()
+        del self._codes
+
+    @staticmethod
+    def _search_shard(codes_map, queries, begin, end, k, chunk_size):
+        """ Top-k over rows [begin, end) of codes_map for every (packed) query.
+
+        :returns: distances [Q, k'] and ids [Q, k']
+        :rtype: np.array, np.array
+
+        """
+        best_dist, best_ids = None, None
+        for chunk_begin in range(begin, end, chunk_size):
+            chunk_end = min(chunk_begin + chunk_size, end)
+            codes = np.asarray(codes_map[chunk_begin:chunk_end])
+            dist = popcount(queries[:, None, :] ^ codes[None, :, :]).sum(-1, dtype=np.int32)
+            ids = np.broadcast_to(np.arange(chunk_begin, chunk_end), dist.shape)
+            if best_dist is not None:
+                dist = np.concatenate([best_dist, dist], 1)
+                ids = np.concatenate([best_ids, ids], 1)
+
+            if dist.shape[1] > k:
+                top = np.argpartition(dist, k - 1, axis=1)[:, 0:k]
+                dist, ids = np.take_along_axis(dist, top, 1), np.take_along_axis(ids, top, 1)
+
+            best_dist, best_ids = dist, ids
+
+        return best_dist, best_ids
+
+    def search(self, queries, k=10, chunk_size=None):
+        """ Multi-threaded top-k hamming nearest neighbours.
+
+        :param queries: [Q, num_bits] binary codes or [Q, num_words] packed uint64 codes
+        :param k: number of neighbours
+        :param chunk_size: rows scanned per step per thread (bounded [Q, chunk, words] xor)
+        :returns: hamming distances [Q, k] and ids [Q, k], sorted by distance
+        :rtype: np.array, np.array
+
+        """
+        queries = queries if isinstance(queries, np.ndarray) and queries.dtype == np.uint64 \
+            else pack_codes(queries)
+        with self._lock:  # rows appended after this point are not searched
+            count, codes_map = self.count, self._codes
+
+        k = min(k, count)
+        if k == 0:
+            return np.zeros((queries.shape[0], 0), np.int32), np.zeros((queries.shape[0], 0), np.int64)
+
+        chunk_size = chunk_size or max(1, (1 << 22) // (queries.shape[0] * self.num_words))
+        bounds = np.linspace(0, count, min(self.num_threads, count) + 1).astype(np.int64)
+        with ThreadPoolExecutor(max_workers=len(bounds) - 1) as pool:  # numpy releases the GIL
+            shards = list(pool.map(lambda b: self._search_shard(codes_map, queries, b[0], b[1], k, chunk_size),
+                                   zip(bounds[0:-1], bounds[1:])))
+
+        dist = np.concatenate([s[0] for s in shards], 1)
+        ids = np.concatenate([s[1] for s in shards], 1)
+        order = np.argsort(dist, axis=1, kind='stable')[:, 0:k]
+        return np.take_along_axis(dist, order, 1), np.take_along_axis(ids, order, 1)
+
+    def search_by_image(self, model, x, k=10):
+        """ Encodes x and searches in one call.
+
+        :param model: an AbstractVAE with a binary / one-hot latent
+        :param x: the input tensor
+        :param k: number of neighbours
+        :returns: hamming distances [B, k] and ids [B, k]
+        :rtype: np.array, np.array
+
+        """
+        z, _ = model.inference_posterior(x)
+        return self.search(z, k=k)
@@ -6,6 +6,7 @@ from helpers.layers import str_to_activ_module
 from .reparameterizers.gumbel import GumbelSoftmax
 from .reparameterizers.mixture import Mixture
 from .reparameterizers.beta import Beta
+from .reparameterizers.kumaraswamy import Kumaraswamy
 from .reparameterizers.bernoulli import Bernoulli
 from .reparameterizers.isotropic_gaussian import IsotropicGaussian
 from .abstract_vae import AbstractVAE
@@ -23,11 +24,15 @@ class SimpleVAE(AbstractVAE):
         super(SimpleVAE, self).__init__(input_shape, **kwargs)
         reparam_dict = {
             'beta': Beta,
+            'kumaraswamy': Kumaraswamy,
             'bernoulli': Bernoulli,
             'discrete': GumbelSoftmax,
             'isotropic_gaussian': IsotropicGaussian,
             'mixture': partial(Mixture, num_discrete=self.config['discrete_size'],
-                               num_continuous=self.config['continuous_size'])
+                               num_continuous=self.config['continuous_size']),
+            'mixture_kumaraswamy': partial(Mixture, num_discrete=self.config['discrete_size'],
+                                           num_continuous=self.config['continuous_size'],
+                                           is_beta=True, use_kumaraswamy=True)
         }
         self.reparameterizer = reparam_dict[self.config['reparam_type']](config=self.config)
 
@@ -9,10 +9,14 @@ import numpy as np
 from copy import deepcopy
 
 from .abstract_vae import AbstractVAE
+from .codebook import install_codebook_linear
+from .normalization import with_frozen_normalization
 from .reparameterizers.gumbel import GumbelSoftmax
 from .reparameterizers.mixture import Mixture
 from .reparameterizers.beta import Beta
+from .reparameterizers.kumaraswamy import Kumaraswamy
 from .reparameterizers.isotropic_gaussian import IsotropicGaussian
+from .reparameterizers.prior_sampler import stochastic_sampling
 from helpers.distributions import nll_activation as nll_activation_fn
 from helpers.distributions import nll as nll_fn
 from helpers.layers import get_encoder, get_decoder, Identity, EMA
@@ -222,13 +226,15 @@ class VRNNMemory(nn.Module):
 
 
 class VRNN(AbstractVAE):
-    def __init__(self, input_shape, n_layers=2, bidirectional=False, **kwargs):
+    def __init__(self, input_shape, n_layers=2, bidirectional=False,
+                 extra_input_shapes=None, **kwargs):
         """ Implementation of the Variational Recurrent
             Neural Network (VRNN) from https://arxiv.org/abs/1506.02216
 
         :param input_shape: the input dimension
         :param n_layers: number of RNN / equivalent layers
         :param bidirectional: whether the model is bidirectional or not
+        :param extra_input_shapes: shapes of any extra inputs passed to encode (*xargs)
         :returns: VRNN object
         :rtype: AbstractVAE
 
@@ -236,6 +242,7 @@ class VRNN(AbstractVAE):
         super(VRNN, self).__init__(input_shape, **kwargs)
         self.bidirectional = bidirectional
         self.n_layers = n_layers
+        self.extra_input_shapes = [] if extra_input_shapes is None else extra_input_shapes
 
         # build the reparameterizer
         if self.config['reparam_type'] == "isotropic_gaussian":
@@ -247,14 +254,20 @@ class VRNN(AbstractVAE):
         elif self.config['reparam_type'] == "beta":
             print("using beta reparameterizer")
             self.reparameterizer = Beta(self.config)
+        elif self.config['reparam_type'] == "kumaraswamy":
+            print("using kumaraswamy reparameterizer")
+            self.reparameterizer = Kumaraswamy(self.config)
         elif "mixture" in self.config['reparam_type']:
+            use_kumaraswamy = 'kumaraswamy' in self.config['reparam_type']
+            is_beta = 'beta' in self.config['reparam_type'] or use_kumaraswamy
             print("using mixture reparameterizer with {} + discrete".format(
-                'beta' if 'beta' in self.config['reparam_type'] else 'isotropic_gaussian'
+                'kumaraswamy' if use_kumaraswamy else 'beta' if is_beta else 'isotropic_gaussian'
             ))
             self.reparameterizer = Mixture(num_discrete=self.config['discrete_size'],
                                            num_continuous=self.config['continuous_size'],
                                            config=self.config,
-                                           is_beta='beta' in self.config['reparam_type'])
+                                           is_beta=is_beta,
+                                           use_kumaraswamy=use_kumaraswamy)
         else:
             raise Exception("unknown reparameterization type")
 
@@ -339,7 +352,8 @@ class VRNN(AbstractVAE):
 
         # feature-extracting transformations
         self.phi_x = self._build_phi_x_model()
-        self.phi_x_i = []
+        self.phi_x_i = nn.ModuleList([self._lazy_build_phi_x(shp)
+                                      for shp in self.extra_input_shapes])
         self.phi_z = nn.Sequential(
             self._get_dense_net_map('phi_z')(
                 self.reparameterizer.output_size, self.config['latent_size'],
@@ -353,6 +367,11 @@ class VRNN(AbstractVAE):
             # self.activation_fn()
         )
 
+        # hard one-hot codes are a row-gather of the first phi_z layer at inference
+        discrete_offset = self._discrete_input_offset()
+        if discrete_offset is not None:
+            install_codebook_linear(self.phi_z, self.reparameterizer.output_size, discrete_offset)
+
         # prior
         self.prior = self._get_dense_net_map('prior')(
             self.config['latent_size'], self.reparameterizer.input_size,
@@ -374,6 +393,30 @@ class VRNN(AbstractVAE):
                                  rnn=self._lazy_rnn_lambda,
                                  cuda=self.config['cuda'])
 
+        # build everything that used to be built on the first forward pass
+        self._build_lazy_modules()
+
+    def _build_lazy_modules(self):
+        """ Shape inference pass that materializes the encoder and the RNN
+            up-front, so that optimizers see every parameter and checkpoints
+            load into a fresh model without a dummy forward pass.
+
+            Every feature extractor (phi_x, phi_x_i, phi_z) projects to
+            latent_size and the merged RNN state is latent_size, thus:
+              x_features = latent_size * (1 + #extra_inputs)
+              encoder    : [x_features, final_state] --> reparameterizer.input_size
+              rnn        : [x_features, phi_z]       --> latent_size
+
+        :returns: None
+        :rtype: None
+
+        """
+        latent_size = self.config['latent_size']
+        x_features_size = latent_size * (1 + len(self.phi_x_i))
+        self._lazy_build_encoder(x_features_size + latent_size)
+        if not hasattr(self, 'rnn'):
+            self.rnn = self._build_rnn_memory_model(input_size=x_features_size + latent_size)
+
     def build_decoder(self, reupsample=True):
         """ helper function to build convolutional or dense decoder
 
@@ -427,7 +470,7 @@ class VRNN(AbstractVAE):
         :rtype: bool
 
         """
-        return self.config['reparam_type'] == 'mixture' \
+        return 'mixture' in self.config['reparam_type'] \
             or self.config['reparam_type'] == 'discrete'
 
     def _build_rnn_memory_model(self, input_size, model_type='lstm', bias=True, dropout=0):
@@ -565,6 +608,72 @@ class VRNN(AbstractVAE):
 
         return decoded_t, params_t
 
+    def step_with_state(self, x_i, state):
+        """ Single step forward pass from an explicit (h, c) state,
+            restores the current memory state afterwards.
+
+        :param x_i: input tensor
+        :param state: the LSTM state tuple, each [num_directions * n_layers, batch, h_dim]
+        :returns: decoded logits, params and the updated state tuple
+        :rtype: torch.Tensor, dict, (torch.Tensor, torch.Tensor)
+
+        """
+        previous_state = getattr(self.memory, 'state', None)
+        self.memory.state = state
+        decoded_t, params_t = self.step(x_i)
+        next_state = self.memory.get_state()
+
+        # don't let the buffer grow and swap back the original state
+        self.memory.clear()
+        if previous_state is not None:
+            self.memory.state = previous_state
+
+        return decoded_t, params_t, next_state
+
+    def inference_step(self, x_i, state):
+        """ Deterministic, side-effect free single step: the state is passed in and
+            returned explicitly, self.memory is never touched and the reparameterizer
+            uses its inference path, so a shared (eval-mode) model is thread-safe.
+
+        :param x_i: input tensor
+        :param state: the LSTM state tuple, each [num_directions * n_layers, batch, h_dim]
+        :returns: decoded logits, (minimal) posterior params and the updated state tuple
+        :rtype: torch.Tensor, dict, (torch.Tensor, torch.Tensor)
+
+        """
+        with torch.no_grad():
+            final_state = torch.mean(state[0], 0)
+            x_i = (x_i - .5) * 2. if self.config['decoder_layer_type'] == 'pixelcnn' else x_i
+
+            # posterior from the explicit state
+            phi_x_t = self._extract_features(x_i)
+            enc_t = self.encoder(torch.cat([phi_x_t, final_state], dim=-1))
+            z_t, params_t = self.reparameterizer.inference(enc_t)
+
+            # decode and update the explicit state
+            phi_z_t = self.phi_z(z_t)
+            decoded_t = self.decoder(torch.cat([phi_z_t, final_state], -1))
+            rnn_input_t = torch.cat([phi_x_t, phi_z_t], -1).unsqueeze(0)
+            _, next_state = self.rnn(rnn_input_t.contiguous(), state)
+
+        return decoded_t, params_t, next_state
+
+    def init_session_state(self, batch_size=1, cuda=False):
+        """ Returns a fresh zero state usable with step_with_state.
+
+        :param batch_size: number of streams
+        :param cuda: cuda flag
+        :returns: state-tuple usable with step_with_state and inference_step
+        :rtype: (torch.Tensor, torch.Tensor)
+
+        """
+        num_directions = 2 if self.bidirectional else 1
+        return tuple(
+            same_type(self.config['half'], cuda)(
+                num_directions * self.n_layers, batch_size, self.config['latent_size']
+            ).zero_()
+            for _ in range(2)
+        )
 
     def decode(self, z_t, produce_output=False, reset_state=False):
         """ decodes using VRNN
@@ -599,21 +708,20 @@ class VRNN(AbstractVAE):
 
     def _extract_features(self, x, *xargs):
         """ accepts x and any number of extra x items and returns
-            each of them projected through it's own NN,
-            creating any networks as needed
+            each of them projected through it's own NN
 
         :param x: the input tensor
         :returns: the extracted features
         :rtype: torch.Tensor
 
         """
+        # the encoder and rnn are sized from len(phi_x_i) at construction
+        assert len(xargs) == len(self.phi_x_i), \
+            "got {} extra inputs but the model was built for {}, pass extra_input_shapes".format(
+                len(xargs), len(self.phi_x_i))
+
         phi_x_t = self.phi_x(x)
         for i, x_item in enumerate(xargs):
-            if len(self.phi_x_i) < i + 1:
-                # add a new model at runtime if needed
-                self.phi_x_i.append(self._lazy_build_phi_x(x_item.size()[1:]))
-                print("increased length of feature extractors to {}".format(len(self.phi_x_i)))
-
             # use the model and concat on the feature dimension
             phi_x_i = self.phi_x_i[i](x_item)
             phi_x_t = torch.cat([phi_x_t, phi_x_i], -1)
@@ -697,8 +805,9 @@ class VRNN(AbstractVAE):
         dec_logits_t = self.decoder(dec_input_t)
         return self.nll_activation(dec_logits_t)
 
+    @with_frozen_normalization
     def generate_synthetic_samples(self, batch_size, **kwargs):
-        """ generate batch_size samples.
+        """ generate batch_size samples (normalization layers use running statistics).
 
         :param batch_size: the size of the batch to generate
         :returns: generated tensor
@@ -751,6 +860,91 @@ class VRNN(AbstractVAE):
         # TODO: factor generations for multi-input
         return torch.cat(decoded_list, 0)
 
+    @staticmethod
+    def _branch(tensor, num_branches, dim=0):
+        """ Repeats every entry along dim num_branches times (b0, b0, .., b1, b1, ..).
+
+        :param tensor: the tensor to branch
+        :param num_branches: number of copies of each entry
+        :param dim: the batch dimension
+        :returns: tensor with dim of size tensor.size(dim) * num_branches
+        :rtype: torch.Tensor
+
+        """
+        shp = list(tensor.shape)
+        expanded = tensor.unsqueeze(dim + 1).expand(*shp[0:dim + 1], num_branches, *shp[dim + 1:])
+        return expanded.reshape(*shp[0:dim], shp[dim] * num_branches, *shp[dim + 1:])
+
+    def _latent_log_likelihood(self, z, params):
+        """ Per-sample log-likelihood of z under the reparameterized params,
+            with gaussians scored under the std exp(logvar / 2) they are sampled with.
+
+        :param z: the latent sample
+        :param params: the reparameterization params
+        :returns: log-likelihood of size [batch_size]
+        :rtype: torch.Tensor
+
+        """
+        params = IsotropicGaussian.sampled_scale_params(params)
+        log_likelihood = self.reparameterizer.log_likelihood(z, params)
+        return log_likelihood.view(log_likelihood.size(0), -1).sum(-1)
+
+    @with_frozen_normalization
+    def rollout(self, num_continuations, num_steps=None, state=None):
+        """ Samples num_continuations trajectories per sequence from a shared
+            prefix state using the learned prior p(z_t | h_{t-1}).
+
+            Everything that only depends on the prefix (the merged state and the
+            prior network) is computed once per sequence and broadcast; the
+            hidden state is only materialized per-branch at the first RNN update,
+            which is where the branches diverge. Normalization layers use their
+            running statistics and the reparameterizer state is left untouched.
+
+        :param num_continuations: number of continuations per sequence (N)
+        :param num_steps: rollout length, defaults to max_time_steps
+        :param state: prefix (h, c) state, defaults to the current memory state
+        :returns: trajectories [B, N, T, *input_shape] and log-likelihoods [B, N]
+        :rtype: torch.Tensor, torch.Tensor
+
+        """
+        num_steps = self.config['max_time_steps'] if num_steps is None else num_steps
+        state = self.memory.get_state() if state is None else state
+        batch_size = state[0].size(1)
+
+        trajectories = []
+        log_likelihood = None
+        with torch.no_grad(), stochastic_sampling(self.reparameterizer):
+            # shared prefix computation, run once per sequence
+            final_state = torch.mean(state[0], 0)
+            prior_logits = self._clamp_variance(self.prior(final_state.contiguous()))
+            final_state = self._branch(final_state, num_continuations)
+            prior_logits = self._branch(prior_logits, num_continuations)
+
+            for t in range(num_steps):
+                if t > 0:  # per-branch prior from the diverged state
+                    final_state = torch.mean(state[0], 0)
+                    prior_logits = self._clamp_variance(self.prior(final_state.contiguous()))
+
+                z_t, params_t = self.reparameterizer(prior_logits)
+                log_likelihood_t = self._latent_log_likelihood(z_t, params_t)
+                log_likelihood = log_likelihood_t if log_likelihood is None \
+                    else log_likelihood + log_likelihood_t
+
+                # decode the sample conditioned on the state
+                phi_z_t = self.phi_z(z_t)
+                x_t = self._decode_pixelcnn_or_normal(torch.cat([phi_z_t, final_state], -1))
+                trajectories.append(x_t)
+
+                # update the per-branch state
+                if t == 0:
+                    state = tuple(self._branch(s, num_continuations, dim=1) for s in state)
+
+                rnn_input_t = torch.cat([self._extract_features(x_t), phi_z_t], -1).unsqueeze(0)
+                _, state = self._lazy_rnn_lambda(rnn_input_t.contiguous(), state)
+
+        trajectories = torch.stack(trajectories, 1)
+        return trajectories.view(batch_size, num_continuations, *trajectories.shape[1:]), \
+            log_likelihood.view(batch_size, num_continuations)
 
     def posterior(self, *x_args):
         """ encode the set of input tensor args
@@ -0,0 +1,247 @@
+from __future__ import print_function
+import os
+import uuid
+import shutil
+import tempfile
+import threading
+import torch
+
+from collections import OrderedDict
+
+
+class _PendingStep(object):
+    def __init__(self, session_id, x_t):
+        """ Container for a step that is waiting to be batched.
+
+        :param session_id: the session to step
+        :param x_t: the input frame
+        :returns: _PendingStep object
+        :rtype: object
+
+        """
+        self.session_id = session_id
+        self.x_t = x_t
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class VRNNSessionCache(object):
+    def __init__(self, model, max_sessions=1024, spill_dir=None):
+        """ Serves many independent streams from a single VRNN.
+            Per-session LSTM state is kept in a bounded LRU store,
+            least-recently used sessions are spilled to disk and
+            concurrent steps are coalesced into one forward pass.
+
+        :param model: the VRNN model (expected to be in eval mode)
+        :param max_sessions: max number of sessions to keep in memory
+        :param spill_dir: directory to spill evicted states to (tempdir if None)
+        :returns: VRNNSessionCache object
+        :rtype: object
+
+        """
+        self.model = model
+        self.max_sessions = max_sessions
+        self._owns_spill_dir = spill_dir is None
+        self.spill_dir = tempfile.mkdtemp(prefix='vrnn_sessions_') \
+            if spill_dir is None else spill_dir
+        os.makedirs(self.spill_dir, exist_ok=True)
+
+        self._states = OrderedDict()  # session_id --> (h, c), most recent last
+        self._spilled = set()         # session_ids living on disk
+        self._pending = []            # steps waiting to be batched
+        self._store_lock = threading.RLock()
+        self._pending_lock = threading.Lock()
+        self._model_lock = threading.Lock()  # serializes batching, not the (stateless) model
+
+    def __len__(self):
+        with self._store_lock:
+            return len(self._states) + len(self._spilled)
+
+    def _spill_path(self, session_id):
+        return os.path.join(self.spill_dir, '{}.pt'.format(session_id))
+
+    def _put(self, session_id, state):
+        """ Insert / refresh a state and evict the LRU sessions to disk.
+
+        :param session_id: the session id
+        :param state: the (h, c) tuple for this session
+        :returns: None
+        :rtype: None
+
+        """
+        with self._store_lock:
+            self._states[session_id] = state
+            self._states.move_to_end(session_id)
+            while len(self._states) > self.max_sessions:
+                evicted_id, evicted_state = self._states.popitem(last=False)
+                torch.save(tuple(s.cpu() for s in evicted_state),
+                           self._spill_path(evicted_id))
+                self._spilled.add(evicted_id)
+
+    def _get(self, session_id):
+        """ Returns the state of a session, loading it from disk if spilled.
+
+        :param session_id: the session id
+        :returns: the (h, c) tuple
+        :rtype: (torch.Tensor, torch.Tensor)
+
+        """
+        with self._store_lock:
+            if session_id in self._states:
+                self._states.move_to_end(session_id)
+                return self._states[session_id]
+
+            if session_id not in self._spilled:
+                raise KeyError("unknown session {}".format(session_id))
+
+            path = self._spill_path(session_id)
+            state = torch.load(path)
+            if self.model.config['cuda']:
+                state = tuple(s.cuda() for s in state)
+
+            os.remove(path)
+            self._spilled.remove(session_id)
+            self._put(session_id, state)
+            return state
+
+    def open_session(self, session_id=None):
+        """ Opens a new session with a zero initial state.
+
+        :param session_id: optional session id, generated if None
+        :returns: the session id
+        :rtype: str
+
+        """
+        session_id = uuid.uuid4().hex if session_id is None else session_id
+        with self._store_lock:
+            assert session_id not in self._states and session_id not in self._spilled, \
+                "session {} already open".format(session_id)
+            self._put(session_id, self.model.init_session_state(
+                1, cuda=self.model.config['cuda']))
+
+        return session_id
+
+    def close(self, session_id=None):
+        """ Closes a session, or every session (and the spill dir) if None.
+
+        :param session_id: the session id to close
+        :returns: None
+        :rtype: None
+
+        """
+        with self._store_lock:
+            if session_id is not None:
+                self._states.pop(session_id, None)
+                if session_id in self._spilled:
+                    os.remove(self._spill_path(session_id))
+                    self._spilled.remove(session_id)
+
+                return
+
+            self._states.clear()
+            self._spilled.clear()
+            if self._owns_spill_dir:
+                shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+    def __contains__(self, session_id):
+        with self._store_lock:
+            return session_id in self._states or session_id in self._spilled
+
+    def step_many(self, inputs):
+        """ Steps a set of distinct sessions with a single batched forward pass.
+
+        :param inputs: dict of session_id --> x_t (with or without a leading batch dim of 1)
+        :returns: dict of session_id --> decoded logits [1, ...]
+        :rtype: dict
+
+        """
+        with self._model_lock:
+            return self._step_many(inputs)
+
+    def _step_many(self, inputs):
+        """ step_many without the model lock, the caller must hold it. """
+        session_ids = list(inputs.keys())
+        states = [self._get(session_id) for session_id in session_ids]
+        h = torch.cat([state[0] for state in states], 1)
+        c = torch.cat([state[1] for state in states], 1)
+        x = torch.cat([inputs[session_id].unsqueeze(0)
+                       if inputs[session_id].dim() == len(self.model.input_shape)
+                       else inputs[session_id] for session_id in session_ids], 0)
+
+        decoded, _, (h_next, c_next) = self.model.inference_step(x, (h, c))
+
+        # clone so that evicting a session frees its memory
+        for i, session_id in enumerate(session_ids):
+            self._put(session_id, (h_next[:, i:i+1].clone(),
+                                   c_next[:, i:i+1].clone()))
+
+        return {session_id: decoded[i:i+1] for i, session_id in enumerate(session_ids)}
+
+    def _run_pending(self):
+        """ Drains the pending queue, batching one step per session per round.
+
+        :returns: None
+        :rtype: None
+
+        """
+        with self._pending_lock:
+            pending, self._pending = self._pending, []
+
+        while len(pending) > 0:
+            batch, remaining = OrderedDict(), []
+            for item in pending:  # a session can only appear once per forward
+                if item.session_id not in self:  # never fail the co-batched steps
+                    item.error = KeyError("unknown session {}".format(item.session_id))
+                    item.done.set()
+                elif item.session_id in batch:
+                    remaining.append(item)
+                else:
+                    batch[item.session_id] = item
+
+            if len(batch) == 0:  # every step failed the session check
+                break
+
+            try:
+                results = self._step_many({k: v.x_t for k, v in batch.items()})
+                for session_id, item in batch.items():
+                    item.result = results[session_id]
+            except Exception as e:
+                if len(batch) == 1:
+                    next(iter(batch.values())).error = e
+                else:  # retry one by one so that only the faulty steps fail
+                    for session_id, item in batch.items():
+                        try:
+                            item.result = self._step_many({session_id: item.x_t})[session_id]
+                        except Exception as item_e:
+                            item.error = item_e
+
+            for item in batch.values():
+                item.done.set()
+
+            pending = remaining
+
+    def step(self, session_id, x_t):
+        """ Steps a single session. Safe to call from many threads:
+            concurrent calls are coalesced into one batched forward.
+
+        :param session_id: the session id
+        :param x_t: the input frame
+        :returns: decoded logits [1, ...]
+        :rtype: torch.Tensor
+
+        """
+        item = _PendingStep(session_id, x_t)
+        with self._pending_lock:
+            self._pending.append(item)
+
+        # whoever grabs the model runs everyone's pending steps
+        while not item.done.is_set():
+            with self._model_lock:
+                if not item.done.is_set():
+                    self._run_pending()
+
+        if item.error is not None:
+            raise item.error
+
+        return item.result